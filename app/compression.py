@@ -0,0 +1,276 @@
+import gzip
+import logging
+import mimetypes
+import os
+import tempfile
+import zlib
+
+from typing import Callable, List, Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Already compressed payloads only cost CPU to compress again, arbitrary binary media keeps its strong ETag
+SKIP_CONTENT_TYPES = ('image/', 'audio/', 'video/', 'application/zip', 'application/gzip', 'application/octet-stream')
+
+# Suffixes of precompressed static variants, in order of preference
+STATIC_VARIANTS = {'br': '.br', 'gzip': '.gz'}
+# Variants are written under this suffix first, then renamed into place
+TEMP_SUFFIX = '.tmp'
+
+
+def _accepted_encodings(headers: Headers) -> List[str]:
+    """
+    Returns encodings allowed by Accept-Encoding, ignoring q weights apart from q=0
+    """
+    encodings = []
+    for item in headers.get('accept-encoding', '').split(','):
+        coding, _, params = item.strip().partition(';')
+        params = params.replace(' ', '')
+        if coding and params not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            encodings.append(coding.strip().lower())
+
+    return encodings
+
+
+def _available_encodings() -> List[str]:
+    encodings = []
+    if Settings.COMPRESS_BROTLI and brotli is not None:
+        encodings.append('br')
+    encodings.append('gzip')
+
+    return encodings
+
+
+def accepted_encodings(headers: Headers, available: List[str]) -> List[str]:
+    """
+    Returns `available` encodings the client accepts, keeping their order of preference
+    """
+    accepted = _accepted_encodings(headers)
+    return [encoding for encoding in available if encoding in accepted or '*' in accepted]
+
+
+class _Compressor:
+    """
+    Incremental compressor, `compress` output is flushed so streamed chunks reach the client immediately
+    """
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._brotli = brotli.Compressor(quality=Settings.BROTLI_QUALITY)
+        else:
+            # wbits 31 writes a gzip header and trailer
+            self._zlib = zlib.compressobj(Settings.COMPRESS_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == 'br':
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b'') -> bytes:
+        if self.encoding == 'br':
+            return self._brotli.process(data) + self._brotli.finish()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_FINISH)
+
+
+class CompressionMiddleware:
+    """
+    Compresses responses with brotli or gzip depending on Accept-Encoding
+
+    Responses below Settings.COMPRESS_MIN_SIZE, already encoded ones, partial content and media are sent as is.
+    Body chunks of at least Settings.COMPRESS_THREAD_MIN_SIZE are compressed in the threadpool.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        encodings = accepted_encodings(Headers(scope=scope), _available_encodings())
+        if not encodings:
+            await self.app(scope, receive, send)
+            return
+
+        await _CompressionResponder(self.app, encodings[0])(scope, receive, send)
+
+
+class _CompressionResponder:
+    def __init__(self, app: ASGIApp, encoding: str):
+        self.app = app
+        self.encoding = encoding
+        self.send: Optional[Send] = None
+        self.start_message: Optional[Message] = None
+        self.compressor: Optional[_Compressor] = None
+        # Set once we know whether the response gets compressed
+        self.passthrough: Optional[bool] = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    def _skip(self, headers: Headers) -> bool:
+        if self.start_message['status'] in (204, 206, 304):
+            return True
+        if 'content-encoding' in headers:
+            return True
+
+        return headers.get('content-type', '').startswith(SKIP_CONTENT_TYPES)
+
+    async def _compress(self, fn: Callable[[bytes], bytes], body: bytes) -> bytes:
+        # Calls are awaited one at a time, so the compressor is never used by two threads at once
+        if len(body) >= Settings.COMPRESS_THREAD_MIN_SIZE:
+            return await run_in_threadpool(fn, body)
+        return fn(body)
+
+    async def send_compressed(self, message: Message) -> None:
+        if message['type'] == 'http.response.start':
+            # Hold back headers until the first body chunk tells how large the response is
+            self.start_message = message
+            self.passthrough = True if self._skip(Headers(raw=message['headers'])) else None
+            if self.passthrough:
+                await self.send(message)
+            return
+
+        if message['type'] != 'http.response.body' or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+        if self.passthrough is None:
+            if not more_body and len(body) < Settings.COMPRESS_MIN_SIZE:
+                self.passthrough = True
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+
+            self.passthrough = False
+            self.compressor = _Compressor(self.encoding)
+
+            headers = MutableHeaders(raw=self.start_message['headers'])
+            headers['Content-Encoding'] = self.encoding
+            headers.add_vary_header('Accept-Encoding')
+            if headers.get('etag', '').startswith('"'):
+                # Encoded bytes differ from the identity representation, weak validators still match
+                headers['ETag'] = 'W/' + headers['etag']
+            del headers['Content-Length']
+
+            if not more_body:
+                body = await self._compress(self.compressor.finish, body)
+                headers['Content-Length'] = str(len(body))
+                await self.send(self.start_message)
+                await self.send({'type': 'http.response.body', 'body': body})
+                return
+
+            await self.send(self.start_message)
+
+        body = await self._compress(self.compressor.compress if more_body else self.compressor.finish, body)
+
+        await self.send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    """
+    Replaces `path` with `data` at once, other workers serving or writing it never see a partial file
+    """
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.',
+                                     suffix=TEMP_SUFFIX)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def precompress_static(directory: str) -> None:
+    """
+    Writes missing or outdated .gz (and .br when brotli is installed) variants next to static files
+    """
+
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith(tuple(STATIC_VARIANTS.values()) + (TEMP_SUFFIX,)):
+                continue
+
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = None
+
+                for encoding, suffix in STATIC_VARIANTS.items():
+                    if encoding == 'br' and brotli is None:
+                        continue
+
+                    variant = path + suffix
+                    if os.path.exists(variant) and os.path.getmtime(variant) >= os.path.getmtime(path):
+                        continue
+
+                    if data is None:
+                        data = f.read()
+
+                    if encoding == 'br':
+                        compressed = brotli.compress(data, quality=11)
+                    else:
+                        compressed = gzip.compress(data, compresslevel=9, mtime=0)
+
+                    try:
+                        _write_atomic(variant, compressed)
+                    except OSError as e:
+                        logger.warning('Failed to write %s: %s', variant, e)
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    Static files served from precompressed .br/.gz variants when the client accepts them
+    """
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        if not Settings.STATIC_PRECOMPRESS:
+            return super().file_response(full_path, stat_result, scope, status_code)
+
+        available = [encoding for encoding in STATIC_VARIANTS if encoding != 'br' or brotli is not None]
+        for encoding in accepted_encodings(request_headers, available):
+            variant = str(full_path) + STATIC_VARIANTS[encoding]
+            try:
+                variant_stat = os.stat(variant)
+            except FileNotFoundError:
+                continue
+            if variant_stat.st_mtime < stat_result.st_mtime:
+                # Original changed since the variant was written
+                continue
+
+            media_type, _ = mimetypes.guess_type(str(full_path))
+            response = FileResponse(variant, status_code=status_code, stat_result=variant_stat,
+                                    method=scope['method'], media_type=media_type or 'text/plain')
+            response.headers['Content-Encoding'] = encoding
+            break
+        else:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result,
+                                    method=scope['method'])
+
+        response.headers.add_vary_header('Accept-Encoding')
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+
+        return response
@@ -1,4 +1,10 @@
-from app.sql.database import SessionLocal
+from typing import Callable, Union
+
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.settings import Settings
+from app.sql.database import Session, SessionLocal, AsyncSessionLocal
 
 
 def get_db():
@@ -7,3 +13,30 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_session():
+    """
+    Yields an AsyncSession if Settings.DB_ASYNC is enabled, otherwise a regular Session
+
+    Meant for async endpoints, which should call CRUD functions through `run_db`
+    """
+    if Settings.DB_ASYNC:
+        async with AsyncSessionLocal() as db:
+            yield db
+    else:
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            await run_in_threadpool(db.close)
+
+
+async def run_db(db: Union[Session, AsyncSession], fn: Callable, *args, **kwargs):
+    """
+    Runs CRUD function `fn` with `db` as its session without blocking the event loop
+    """
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args, **kwargs)
+
+    return await run_in_threadpool(fn, db, *args, **kwargs)
@@ -0,0 +1,29 @@
+from typing import Dict, Optional
+
+from fastapi import Response, status
+
+ETAG_HEADER = 'ETag'
+
+
+def make_etag(version: int) -> str:
+    # Weak, compressed and identity bodies differ, so 304s and compressed responses carry the same validator
+    return f'W/"{version}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+
+    # If-None-Match uses weak comparison
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+    etag = etag[2:] if etag.startswith('W/') else etag
+    return '*' in tags or etag in tags
+
+
+def not_modified(etag: str, headers: Optional[Dict[str, str]] = None) -> Response:
+    """
+    Returns an empty 304 carrying `etag` and `headers`, which should be the headers the 200 would have had
+    """
+
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={**(headers or {}), ETAG_HEADER: etag})
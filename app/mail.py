@@ -1,29 +1,208 @@
+import functools
+import logging
 import smtplib
 import ssl
+import threading
+import time
 
 from email.message import EmailMessage
 from email.utils import formataddr, formatdate, make_msgid
-from typing import Optional
+from typing import List, Optional
 
 from app.settings import Settings
+from app.metrics import MAIL_SECONDS
+from app.sql import models as sql_models
+from app.sql.database import Session, SessionLocal
+from app.sql.crud import mail as crud_mail
 
-context = ssl.create_default_context()
+logger = logging.getLogger(__name__)
 
 
-def send_mail(to_addr: str, subject: str, message: str, to_name: Optional[str] = None) -> None:
-    with smtplib.SMTP_SSL(Settings.SMTP_SERVER, Settings.SMTP_PORT, context=context) as server:
-        server.login(Settings.SMTP_USER, Settings.SMTP_PASS)
+@functools.lru_cache(maxsize=None)
+def _ssl_context() -> ssl.SSLContext:
+    # Loading CA certificates is slow, so it waits for the first connection instead of import
+    return ssl.create_default_context()
 
-        msg = EmailMessage()
 
-        # We have to add Date and Message-ID fields ourselves to pass DKIM verification
-        msg['Date'] = formatdate()
-        msg['Message-ID'] = make_msgid(domain=Settings.MAIN_DOMAIN)
+def _build_message(mail: sql_models.Mail) -> EmailMessage:
+    msg = EmailMessage()
 
-        msg['Subject'] = subject
-        msg['From'] = formataddr((Settings.MAIL_FROM_NAME, Settings.SMTP_USER))
-        msg['To'] = formataddr((to_name, to_addr))
+    # We have to add Date and Message-ID fields ourselves to pass DKIM verification
+    msg['Date'] = formatdate()
+    msg['Message-ID'] = make_msgid(domain=Settings.MAIN_DOMAIN)
 
-        msg.set_content(f"<html><pre>{message}</pre></html>", subtype='html')
+    msg['Subject'] = mail.subject
+    msg['From'] = formataddr((Settings.MAIL_FROM_NAME, Settings.SMTP_USER))
+    msg['To'] = formataddr((mail.to_name, mail.to_addr))
 
-        server.send_message(msg, Settings.SMTP_USER, to_addr)
+    msg.set_content(f"<html><pre>{mail.message}</pre></html>", subtype='html')
+
+    return msg
+
+
+def _is_permanent(error: Exception) -> bool:
+    """
+    Whether the server refused the mail with a 5xx reply, sending it again would fail the same way
+    """
+
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPDataError):
+        return error.smtp_code >= 500
+
+    return False
+
+
+class SMTPConnection:
+    """
+    Long-lived authenticated SMTP connection
+
+    Reconnects when the server drops the connection or it sat idle longer than the server likely keeps it open.
+    """
+
+    def __init__(self):
+        self._server: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+
+    def _connect(self) -> smtplib.SMTP:
+        if Settings.SMTP_SSL:
+            server = smtplib.SMTP_SSL(Settings.SMTP_SERVER, Settings.SMTP_PORT,
+                                      context=_ssl_context(), timeout=Settings.SMTP_TIMEOUT)
+        else:
+            server = smtplib.SMTP(Settings.SMTP_SERVER, Settings.SMTP_PORT, timeout=Settings.SMTP_TIMEOUT)
+
+        if Settings.SMTP_PASS:
+            server.login(Settings.SMTP_USER, Settings.SMTP_PASS)
+
+        return server
+
+    def close(self) -> None:
+        if not self._server:
+            return
+
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._server = None
+
+    def close_if_idle(self) -> None:
+        if self._server and time.monotonic() - self._last_used > Settings.SMTP_IDLE_TIMEOUT:
+            self.close()
+
+    def send(self, msg: EmailMessage, to_addr: str) -> None:
+        self.close_if_idle()
+
+        if self._server:
+            try:
+                self._server.send_message(msg, Settings.SMTP_USER, to_addr)
+                self._last_used = time.monotonic()
+                return
+            except smtplib.SMTPServerDisconnected:
+                self._server = None
+
+        self._server = self._connect()
+        self._server.send_message(msg, Settings.SMTP_USER, to_addr)
+        self._last_used = time.monotonic()
+
+
+class MailDispatcher:
+    """
+    Background workers draining the outbound mail queue, each holding its own SMTP connection
+    """
+
+    def __init__(self):
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        if self._threads:
+            return
+
+        self._stop.clear()
+        for i in range(Settings.MAIL_WORKERS):
+            thread = threading.Thread(target=self._work, name=f'mail-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wakeup.set()
+
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    def _work(self) -> None:
+        conn = SMTPConnection()
+        try:
+            while not self._stop.is_set():
+                try:
+                    sent = self.drain(conn)
+                except Exception:
+                    logger.exception('Failed to drain mail queue')
+                    sent = 0
+
+                # Keep going while there is a backlog, otherwise wait for new mail
+                if not sent:
+                    conn.close_if_idle()
+                    self._wakeup.wait(Settings.MAIL_POLL_INTERVAL)
+                    self._wakeup.clear()
+        finally:
+            conn.close()
+
+    def drain(self, conn: SMTPConnection) -> int:
+        """
+        Delivers up to Settings.MAIL_BATCH_SIZE due mails, returns the number of mails claimed
+        """
+
+        claimed = 0
+        # Mails failing now are left for later drains, even when they are due again right away
+        started = time.time()
+        with SessionLocal() as db:
+            while claimed < Settings.MAIL_BATCH_SIZE and not self._stop.is_set():
+                # Claimed right before sending, so the lease only has to outlast one send
+                mail = crud_mail.claim_mail(db, Settings.MAIL_LEASE_TIME, started)
+                if not mail:
+                    break
+                claimed += 1
+
+                start = time.perf_counter()
+                try:
+                    conn.send(_build_message(mail), mail.to_addr)
+                except (smtplib.SMTPException, OSError) as e:
+                    MAIL_SECONDS.observe(time.perf_counter() - start, result='failure')
+                    logger.warning('Failed to send mail %d to %s: %s', mail.id, mail.to_addr, e)
+
+                    retry_at = None
+                    if _is_permanent(e):
+                        # The connection is still usable after a refused recipient or message
+                        logger.warning('Giving up on mail %d, the server refused it permanently', mail.id)
+                    else:
+                        conn.close()
+                        if mail.attempts < Settings.MAIL_MAX_ATTEMPTS:
+                            delay = min(Settings.MAIL_RETRY_DELAY * 2 ** (mail.attempts - 1),
+                                        Settings.MAIL_RETRY_MAX_DELAY)
+                            retry_at = time.time() + delay
+                    crud_mail.retry_mail(db, mail, str(e), retry_at)
+                else:
+                    MAIL_SECONDS.observe(time.perf_counter() - start, result='success')
+                    crud_mail.del_mail(db, mail)
+
+        return claimed
+
+
+dispatcher = MailDispatcher()
+
+
+def queue_mail(db: Session, to_addr: str, subject: str, message: str, to_name: Optional[str] = None) -> None:
+    """
+    Stores mail in the outbound queue, it is delivered by the dispatcher in the background
+    """
+
+    crud_mail.add_mail(db, to_addr, subject, message, to_name)
+    dispatcher.notify()
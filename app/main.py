@@ -1,20 +1,35 @@
-from fastapi import FastAPI, Request, status
-from fastapi.responses import HTMLResponse, JSONResponse
+import hmac
+import math
+
+from typing import Optional
+
+from fastapi import FastAPI, Header, HTTPException, Request, status
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 from fastapi.exceptions import RequestValidationError
 from fastapi.encoders import jsonable_encoder
 
 from app.settings import Settings
-from app.routers import users, sets
-from app.sql.database import Base, engine
+from app.routers import users, sets, media, study
+from app.sql.database import engine, async_engine
+from app.sql import migrations
 from app.models import Result
+from app import metrics, passwords
+from app.http import ETAG_HEADER
+from app.ratelimit import RateLimited
+from app.mail import dispatcher
+from app.sweeper import sweeper
+from app.compression import CompressionMiddleware, PrecompressedStaticFiles, precompress_static
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+metrics.instrument_engine(engine)
+if async_engine is not None:
+    metrics.instrument_engine(async_engine.sync_engine)
+metrics.Gauge('db_pool_connections_checked_out', 'Database connections in use', lambda: engine.pool.checkedout())
 
 app = FastAPI(title='Flashcard API')
 
+STATIC_DIRECTORY = 'app/static'
+
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -24,19 +39,91 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
             code=status.HTTP_422_UNPROCESSABLE_ENTITY, message='JSON validation error'))
     )
 
+
+@app.exception_handler(passwords.HashQueueFull)
+async def hash_queue_full_handler(request: Request, exc: passwords.HashQueueFull):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content=jsonable_encoder(Result(
+            code=status.HTTP_503_SERVICE_UNAVAILABLE, message='Server busy, try again later')),
+        headers={'Retry-After': '1'}
+    )
+
+
+@app.exception_handler(RateLimited)
+async def rate_limited_handler(request: Request, exc: RateLimited):
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content=jsonable_encoder(Result(
+            code=status.HTTP_429_TOO_MANY_REQUESTS, message='Too many requests, try again later')),
+        headers={'Retry-After': str(math.ceil(exc.retry_after))}
+    )
+
+
+@app.on_event('startup')
+def startup():
+    if Settings.DB_AUTO_MIGRATE:
+        migrations.upgrade(engine)
+    else:
+        migrations.check_schema(engine)
+
+    if Settings.STATIC_PRECOMPRESS:
+        precompress_static(STATIC_DIRECTORY)
+    dispatcher.start()
+    sweeper.start()
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    dispatcher.stop()
+    sweeper.stop()
+    passwords.shutdown()
+
+    # aiosqlite connections run on their own threads, which keep the process alive until closed
+    if async_engine is not None:
+        await async_engine.dispose()
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=Settings.ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[sets.NEXT_CURSOR_HEADER, ETAG_HEADER, 'Content-Range'],
 )
 
+# Added after CORS so it wraps it and compresses CORS responses too
+app.add_middleware(CompressionMiddleware)
+
+# Added last so it wraps everything else and times whole requests
+if Settings.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+
 app.include_router(users.router)
 app.include_router(sets.router)
+app.include_router(study.router)
+app.include_router(media.router)
+
+app.mount(Settings.STATIC_PATH, PrecompressedStaticFiles(
+    directory=STATIC_DIRECTORY), name='static')
+
+
+if Settings.METRICS_ENABLED:
+    @app.get('/metrics', include_in_schema=False)
+    async def get_metrics(authorization: Optional[str] = Header(None)):
+        if not Settings.METRICS_TOKEN:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Not Found')
+
+        scheme, _, token = (authorization or '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(token.encode(), Settings.METRICS_TOKEN.encode()):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail='Invalid metrics token',
+                headers={'WWW-Authenticate': 'Bearer'}
+            )
 
-app.mount(Settings.STATIC_PATH, StaticFiles(
-    directory='app/static'), name='static')
+        return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
 
 
 @app.get('/', include_in_schema=False)
@@ -0,0 +1,110 @@
+import hashlib
+import os
+import re
+import tempfile
+
+from typing import AsyncIterator, Iterator, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from app.settings import Settings
+
+HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+def media_path(hash: str) -> str:
+    """
+    Returns where content with `hash` is stored, fanned out so directories stay small
+    """
+    return os.path.join(Settings.MEDIA_PATH, hash[:2], hash[2:4], hash)
+
+
+async def store_stream(stream: AsyncIterator[bytes]) -> Tuple[str, int]:
+    """
+    Writes `stream` to storage while hashing it, returns content hash and size
+
+    Content already stored under the same hash is kept and the upload discarded.
+    """
+
+    tmp_dir = os.path.join(Settings.MEDIA_PATH, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            async for chunk in stream:
+                size += len(chunk)
+                if size > Settings.MEDIA_MAX_SIZE:
+                    raise MediaTooLarge()
+
+                digest.update(chunk)
+                await run_in_threadpool(f.write, chunk)
+
+        hash = digest.hexdigest()
+        path = media_path(hash)
+        if os.path.exists(path):
+            os.unlink(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    return hash, size
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Returns inclusive byte range requested by Range header, None to send the whole content
+
+    Raises ValueError if the range can't be satisfied. Multiple ranges are not supported
+    and get the whole content, as HTTP allows.
+    """
+
+    if not header:
+        return None
+
+    match = RANGE_PATTERN.match(header.strip())
+    if not match:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+
+    if not start:
+        # Suffix range, last `end` bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError('Empty suffix range')
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError('Range not satisfiable')
+
+    return start, end
+
+
+def read_range(path: str, start: int, end: int) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(Settings.MEDIA_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
@@ -0,0 +1,297 @@
+import bisect
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import anyio
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds, roughly covering cached reads up to bcrypt and SMTP round trips
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+registry: List['_Metric'] = []
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+
+        registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(_escape(labels.get(name, '')) for name in self.labels)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.samples())
+
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self) -> Dict[LabelValues, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+
+        for key, value in values:
+            yield f'{self.name}{_format_labels(self.labels, key)} {value}'
+
+
+class Gauge(_Metric):
+    """
+    Gauge read from `fn` when metrics are collected
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float]):
+        super().__init__(name, help)
+        self.fn = fn
+
+    def samples(self) -> Iterator[str]:
+        try:
+            value = self.fn()
+        except Exception:
+            # Gauges may read state that does not exist yet, e.g. a pool created on first use
+            return
+
+        yield f'{self.name} {value}'
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # Per label values: count in each bucket (not cumulative, last one is +Inf), sum
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                yield f'{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labels, key)} {total}'
+            yield f'{self.name}_count{_format_labels(self.labels, key)} {cumulative}'
+
+
+def _threadpool_busy() -> float:
+    return anyio.to_thread.current_default_thread_limiter().borrowed_tokens
+
+
+def _threadpool_size() -> float:
+    return anyio.to_thread.current_default_thread_limiter().total_tokens
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Request latency by route',
+                            ('method', 'route', 'status'))
+SQL_STATEMENTS = Counter('sql_statements_total', 'SQL statements executed by kind', ('op',))
+# Rows removed by ON DELETE CASCADE or written by triggers are not reported by the driver
+SQL_ROWS_WRITTEN = Counter('sql_rows_written_total', 'Rows inserted, updated or deleted', ('op',))
+SQL_SECONDS = Histogram('sql_statement_duration_seconds', 'SQL statement latency')
+REQUEST_SQL_STATEMENTS = Histogram('http_request_sql_statements', 'SQL statements per request', ('route',),
+                                   buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 500))
+PASSWORD_SECONDS = Histogram('password_hash_duration_seconds', 'Password hashing latency including queueing',
+                             ('op',))
+MAIL_SECONDS = Histogram('mail_send_duration_seconds', 'SMTP delivery latency', ('result',))
+# Sync endpoints and CRUD calls queue up once all threads are busy, only readable from the event loop
+THREADPOOL_BUSY = Gauge('threadpool_threads_busy', 'Threadpool threads running sync work', _threadpool_busy)
+THREADPOOL_SIZE = Gauge('threadpool_threads_limit', 'Threadpool size', _threadpool_size)
+
+
+class RequestStats:
+    """
+    SQL activity of a single request, shared with threads running its queries
+    """
+
+    def __init__(self):
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.slowest: List[Tuple[float, str]] = []
+
+    def add(self, statement: str, seconds: float) -> None:
+        self.statements += 1
+        self.sql_seconds += seconds
+
+        # Only keep what the slow request log prints
+        self.slowest.append((seconds, statement))
+        if len(self.slowest) > Settings.SLOW_REQUEST_STATEMENTS:
+            self.slowest.sort(reverse=True)
+            self.slowest.pop()
+
+
+request_stats: 'ContextVar[Optional[RequestStats]]' = ContextVar('request_stats', default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+WRITE_OPS = ('insert', 'update', 'delete')
+
+
+def _statement_op(statement: str) -> str:
+    op = statement.lstrip()[:6].lower()
+    return op if op in WRITE_OPS or op == 'select' else 'other'
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_start'].pop()
+
+    op = _statement_op(statement)
+    SQL_STATEMENTS.inc(op=op)
+    SQL_SECONDS.observe(seconds)
+    # Covers every row of executemany batches
+    if op in WRITE_OPS and cursor.rowcount > 0:
+        SQL_ROWS_WRITTEN.inc(cursor.rowcount, op=op)
+
+    stats = request_stats.get()
+    if stats is not None:
+        stats.add(statement, seconds)
+
+
+def _handle_error(context):
+    # Failed statements never reach after_cursor_execute
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+
+def instrument_engine(engine: Engine) -> None:
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+
+
+class MetricsMiddleware:
+    """
+    Records latency and SQL statements of every request and logs requests slower than Settings.SLOW_REQUEST_TIME
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._routes: Dict[object, str] = {}
+
+    def _route(self, scope: Scope) -> str:
+        # Routing leaves the matched endpoint in the scope, map it back to its path template
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return 'unmatched'
+
+        if not self._routes:
+            for route in scope['app'].routes:
+                self._routes[getattr(route, 'endpoint', None) or getattr(route, 'app', None)] = route.path
+
+        return self._routes.get(endpoint, 'unmatched')
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        status_code = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - start
+            request_stats.reset(token)
+
+            route = self._route(scope)
+            REQUEST_SECONDS.observe(seconds, method=scope['method'], route=route, status=str(status_code))
+            REQUEST_SQL_STATEMENTS.observe(stats.statements, route=route)
+
+            if seconds >= Settings.SLOW_REQUEST_TIME:
+                self._log_slow(scope, route, status_code, seconds, stats)
+
+    @staticmethod
+    def _log_slow(scope: Scope, route: str, status_code: int, seconds: float, stats: RequestStats) -> None:
+        slowest = ''.join(
+            f'\n  {statement_seconds * 1000:.1f} ms: {" ".join(statement.split())[:200]}'
+            for statement_seconds, statement in sorted(stats.slowest, reverse=True)
+        )
+        logger.warning('Slow request %s %s (%s) %d in %.1f ms, %d SQL statements in %.1f ms%s',
+                       scope['method'], scope['path'], route, status_code, seconds * 1000,
+                       stats.statements, stats.sql_seconds * 1000, slowest)
@@ -11,5 +11,18 @@ from .user import TokenIn as TokenIn
 from .result import Result as Result
 
 from .set import Card as Card
+from .set import CardUpdate as CardUpdate
+from .set import CardBatch as CardBatch
+from .set import CardMatch as CardMatch
 from .set import Set as Set
-from .set import Set as SetDb
\ No newline at end of file
+from .set import SetUpdate as SetUpdate
+from .set import SetSummary as SetSummary
+from .set import SetChange as SetChange
+from .set import SyncPage as SyncPage
+from .set import SetImportResult as SetImportResult
+from .set import Set as SetDb
+from .media import Media as Media
+
+from .study import StudyRound as StudyRound
+from .study import ReviewIn as ReviewIn
+from .study import ReviewOut as ReviewOut
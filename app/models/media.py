@@ -0,0 +1,10 @@
+from pydantic import BaseModel, Field
+
+
+class Media(BaseModel):
+    hash: str = Field(..., example='9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08')
+    size: int = Field(..., example=48213)
+    content_type: str = Field(..., example='audio/mpeg')
+
+    class Config:
+        orm_mode = True
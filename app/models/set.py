@@ -1,22 +1,48 @@
-from typing import List
+from typing import List, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, validator
+
+
+def _not_null(cls, value):
+    # Fields of partial updates may be left out, but not cleared
+    if value is None:
+        raise ValueError('may not be null')
+    return value
 
 
 class Card(BaseModel):
     id: int = Field(..., example=1)
     question: str = Field(..., example='What does 光る mean?')
     answer: str = Field(..., example='To shine')
-    voice_address: str = Field('')
+    # Hashes of uploaded media, see /media
+    voice_address: str = Field('', example='9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08')
     picture_address: str = Field('')
 
     class Config:
         orm_mode = True
 
 
+class CardUpdate(BaseModel):
+    question: Optional[str] = Field(None, example='What does 光る mean?')
+    answer: Optional[str] = Field(None, example='To shine')
+    voice_address: Optional[str] = Field(None)
+    picture_address: Optional[str] = Field(None)
+
+    _reject_null = validator('*', pre=True, allow_reuse=True)(_not_null)
+
+
+class CardBatch(BaseModel):
+    upsert: List[Card] = Field([])
+    delete: List[int] = Field([], example=[2, 3])
+
+
+class CardMatch(Card):
+    set_id: int = Field(..., example=1)
+
+
 class CardDb(Card):
     uid: int = Field(..., example=1)
-    set_id: int = Field(..., example=1)
+    set_uid: int = Field(..., example=1)
 
 
 class Set(BaseModel):
@@ -32,6 +58,52 @@ class Set(BaseModel):
         orm_mode = True
 
 
+class SetUpdate(BaseModel):
+    name: Optional[str] = Field(None, example='Japanese Set')
+    type: Optional[str] = Field(None, example='Listening')
+    max_question: Optional[int] = Field(None, example=5)
+    question_time: Optional[float] = Field(None, example=50.0)
+
+    _reject_null = validator('*', pre=True, allow_reuse=True)(_not_null)
+
+
 class SetDb(Set):
     uid: int = Field(..., example=1)
     owner_id: int = Field(..., example=1)
+
+
+class SetSummary(BaseModel):
+    id: int = Field(..., example=1)
+    name: str = Field(..., example='Japanese Set')
+    type: str = Field(..., example='Listening')
+    card_count: int = Field(..., example=20)
+
+    class Config:
+        orm_mode = True
+
+
+class SetChange(BaseModel):
+    id: int = Field(..., example=1)
+    version: int = Field(..., example=12)
+    deleted: bool = Field(False, example=False)
+
+    name: Optional[str] = Field(None, example='Japanese Set')
+    type: Optional[str] = Field(None, example='Listening')
+    max_question: Optional[int] = Field(None, example=5)
+    question_time: Optional[float] = Field(None, example=50.0)
+
+    cards: List[Card] = Field([])
+    deleted_cards: List[int] = Field([], example=[2, 3])
+
+
+class SyncPage(BaseModel):
+    changes: List[SetChange]
+    version: int = Field(..., example=12)
+    has_more: bool = Field(..., example=False)
+
+
+class SetImportResult(BaseModel):
+    line: int = Field(..., example=1)
+    id: Optional[int] = Field(None, example=1)
+    code: str = Field(..., example='200')
+    message: str = Field(..., example='Set imported')
@@ -0,0 +1,26 @@
+from typing import List
+
+from pydantic import BaseModel, Field
+
+from .set import Card
+
+
+class StudyRound(BaseModel):
+    question_time: float = Field(..., example=50.0)
+    cards: List[Card]
+    # More cards are due than fit in this round
+    has_more: bool = Field(..., example=False)
+
+
+class ReviewIn(BaseModel):
+    card_id: int = Field(..., example=1)
+    # 0 (forgotten) to 5 (perfect recall)
+    grade: int = Field(..., ge=0, le=5, example=4)
+
+
+class ReviewOut(BaseModel):
+    card_id: int = Field(..., example=1)
+    due: float = Field(..., example=1658361600.0)
+    interval: float = Field(..., example=6.0)
+    ease: float = Field(..., example=2.5)
+    repetitions: int = Field(..., example=2)
@@ -0,0 +1,133 @@
+import asyncio
+import functools
+import multiprocessing
+import threading
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from app.settings import Settings
+from app.metrics import PASSWORD_SECONDS, Gauge
+
+
+@functools.lru_cache(maxsize=None)
+def _context():
+    # Only needed where hashing runs, usually the worker processes, so passlib is not imported by the app itself
+    from passlib.context import CryptContext
+
+    # Hashes made with any other cost are flagged for re-hashing
+    return CryptContext(
+        schemes=['bcrypt'],
+        deprecated='auto',
+        bcrypt__default_rounds=Settings.BCRYPT_ROUNDS,
+        bcrypt__min_rounds=Settings.BCRYPT_ROUNDS,
+        bcrypt__max_rounds=Settings.BCRYPT_ROUNDS
+    )
+
+
+class HashQueueFull(Exception):
+    """
+    Raised when too many password hashing jobs are already pending
+    """
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+_pending = 0
+_lock = threading.Lock()
+
+HASH_PENDING = Gauge('password_hash_jobs_pending', 'Password hashing jobs queued or running', lambda: _pending)
+
+
+def _hash(password: str) -> str:
+    return _context().hash(password)
+
+
+def _verify_and_update(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    return _context().verify_and_update(password, hashed_password)
+
+
+def _job_done(future: Future) -> None:
+    global _pending
+
+    with _lock:
+        _pending -= 1
+
+
+def _submit(fn: Callable, *args) -> Future:
+    """
+    Queues `fn` on the worker processes, it counts as pending until it finishes even if nobody waits for it
+    """
+
+    global _executor, _pending
+
+    with _lock:
+        if _pending >= Settings.HASH_QUEUE_LIMIT:
+            raise HashQueueFull()
+
+        if not _executor:
+            # Forking a threaded server can leave locks held in the children, spawn fresh interpreters instead
+            _executor = ProcessPoolExecutor(max_workers=Settings.HASH_WORKERS,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        future = _executor.submit(fn, *args)
+        _pending += 1
+
+    future.add_done_callback(_job_done)
+    return future
+
+
+def _run(fn: Callable, *args):
+    # Hash inline when no worker processes are configured
+    if Settings.HASH_WORKERS <= 0:
+        return fn(*args)
+
+    return _submit(fn, *args).result()
+
+
+async def _run_async(fn: Callable, *args):
+    if Settings.HASH_WORKERS <= 0:
+        return await run_in_threadpool(fn, *args)
+
+    # Awaiting the job directly keeps threadpool threads free while it is queued
+    return await asyncio.wrap_future(_submit(fn, *args))
+
+
+def hash_password(password: str) -> str:
+    with PASSWORD_SECONDS.time(op='hash'):
+        return _run(_hash, password)
+
+
+async def hash_password_async(password: str) -> str:
+    with PASSWORD_SECONDS.time(op='hash'):
+        return await _run_async(_hash, password)
+
+
+def verify_password(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """
+    Verifies password against hash
+
+    Returns whether password is valid and a new hash if the stored one uses outdated parameters
+    """
+
+    with PASSWORD_SECONDS.time(op='verify'):
+        return _run(_verify_and_update, password, hashed_password)
+
+
+async def verify_password_async(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """
+    Same as verify_password, for async endpoints
+    """
+
+    with PASSWORD_SECONDS.time(op='verify'):
+        return await _run_async(_verify_and_update, password, hashed_password)
+
+
+def shutdown() -> None:
+    global _executor
+
+    with _lock:
+        executor, _executor = _executor, None
+
+    if executor:
+        executor.shutdown()
@@ -0,0 +1,190 @@
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from fastapi import Request
+from sqlalchemy import Column, Float, MetaData, String, Table, create_engine, event, text
+from starlette.concurrency import run_in_threadpool
+
+from app.settings import Settings
+from app.sql.database import _set_sqlite_pragmas
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+
+
+def _refill(tokens: float, updated_at: float, capacity: float, rate: float, now: float) -> float:
+    return min(capacity, tokens + (now - updated_at) * rate)
+
+
+class MemoryBackend:
+    """
+    Token buckets kept in this process, least recently used ones are dropped past Settings.RATE_LIMIT_MAX_KEYS
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: 'OrderedDict[str, Tuple[float, float]]' = OrderedDict()
+
+    def take(self, key: str, capacity: float, rate: float, now: float) -> Optional[float]:
+        """
+        Takes a token from bucket `key`, returns None if one was available, otherwise seconds until one is
+        """
+
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (capacity, now))
+            tokens = _refill(tokens, updated_at, capacity, rate, now)
+
+            retry_after = None
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > Settings.RATE_LIMIT_MAX_KEYS:
+                self._buckets.popitem(last=False)
+
+            return retry_after
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+
+class DatabaseBackend:
+    """
+    Token buckets in a database shared by all workers, each take is a single atomic upsert
+    """
+
+    metadata = MetaData()
+    table = Table(
+        'rate_limits', metadata,
+        Column('key', String, primary_key=True),
+        Column('tokens', Float, nullable=False),
+        Column('updated_at', Float, nullable=False, index=True),
+    )
+
+    # Only updates the bucket if it has a token left, nothing is returned otherwise
+    TAKE_SQL = (
+        'INSERT INTO rate_limits (key, tokens, updated_at) VALUES (:key, :capacity - 1, :now) '
+        'ON CONFLICT (key) DO UPDATE SET '
+        'tokens = {least}(:capacity, rate_limits.tokens + (:now - rate_limits.updated_at) * :rate) - 1, '
+        'updated_at = :now '
+        'WHERE {least}(:capacity, rate_limits.tokens + (:now - rate_limits.updated_at) * :rate) >= 1 '
+        'RETURNING tokens'
+    )
+
+    # Buckets untouched for this long are full again and can be forgotten
+    PURGE_AGE = 24 * 60 * 60
+    PURGE_EVERY = 1000
+
+    def __init__(self, url: str):
+        options = {'connect_args': {'check_same_thread': False}} if url.startswith('sqlite') else {}
+        self.engine = create_engine(url, **options)
+        if self.engine.dialect.name == 'sqlite':
+            event.listen(self.engine, 'connect', _set_sqlite_pragmas)
+
+        self.metadata.create_all(self.engine)
+
+        least = 'MIN' if self.engine.dialect.name == 'sqlite' else 'LEAST'
+        self._take = text(self.TAKE_SQL.format(least=least))
+        self._takes = 0
+
+    def take(self, key: str, capacity: float, rate: float, now: float) -> Optional[float]:
+        params = {'key': key, 'capacity': capacity, 'rate': rate, 'now': now}
+        with self.engine.begin() as conn:
+            if conn.execute(self._take, params).first():
+                retry_after = None
+            else:
+                tokens, updated_at = conn.execute(
+                    text('SELECT tokens, updated_at FROM rate_limits WHERE key = :key'), params).first()
+                retry_after = (1 - _refill(tokens, updated_at, capacity, rate, now)) / rate
+
+            self._takes += 1
+            if self._takes % self.PURGE_EVERY == 0:
+                conn.execute(self.table.delete().where(self.table.c.updated_at < now - self.PURGE_AGE))
+
+        return retry_after
+
+    def clear(self) -> None:
+        with self.engine.begin() as conn:
+            conn.execute(self.table.delete())
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+
+    # Created on first use so the shared database is only opened when rate limiting is used
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if Settings.RATE_LIMIT_BACKEND == 'database':
+                    _backend = DatabaseBackend(Settings.RATE_LIMIT_DATABASE_URL)
+                else:
+                    _backend = MemoryBackend()
+
+    return _backend
+
+
+def client_ip(request: Request) -> str:
+    if Settings.RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get('x-forwarded-for')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+
+    return request.client.host if request.client else 'unknown'
+
+
+async def _request_email(request: Request) -> Optional[str]:
+    try:
+        body = await request.json()
+    except ValueError:
+        return None
+
+    email = body.get('email') if isinstance(body, dict) else None
+    return email.strip().lower() if isinstance(email, str) else None
+
+
+class RateLimit:
+    """
+    Dependency taking a token from the client IP's bucket, and the request email's bucket if given
+
+    Limits are named entries of Settings.RATE_LIMITS. Raises RateLimited before the endpoint does any work.
+    """
+
+    def __init__(self, ip_limit: str, email_limit: Optional[str] = None):
+        self.ip_limit = ip_limit
+        self.email_limit = email_limit
+
+    async def __call__(self, request: Request) -> None:
+        if not Settings.RATE_LIMIT_ENABLED:
+            return
+
+        buckets = [(self.ip_limit, client_ip(request))]
+        if self.email_limit:
+            email = await _request_email(request)
+            if email:
+                buckets.append((self.email_limit, email))
+
+        backend = get_backend()
+        now = time.time()
+        for limit, subject in buckets:
+            capacity, period = Settings.RATE_LIMITS[limit]
+            args = (f'{limit}:{subject}', capacity, capacity / period, now)
+            if isinstance(backend, MemoryBackend):
+                retry_after = backend.take(*args)
+            else:
+                # Database round trip would block the event loop
+                retry_after = await run_in_threadpool(backend.take, *args)
+
+            if retry_after is not None:
+                raise RateLimited(retry_after)
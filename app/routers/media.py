@@ -0,0 +1,141 @@
+import os
+
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response, status
+from fastapi.responses import FileResponse, StreamingResponse
+
+from app.http import ETAG_HEADER, etag_matches, not_modified
+from app.settings import Settings
+from app.tags import Tags
+from app.models import Media, UserDb
+from app.sql.database import Session
+from app.dependencies import get_session, run_db
+from app.routers.users import get_active_current_user
+from app.media import HASH_PATTERN, MediaTooLarge, media_path, parse_range, read_range, store_stream
+
+from app.sql.crud import media as media_crud
+
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+# Uploads of other types are stored as DEFAULT_CONTENT_TYPE, anything else that is served is downloaded as an
+# attachment so e.g. uploaded HTML never runs in the API's origin. SVG is excluded as it can carry scripts
+INLINE_CONTENT_TYPES = ('audio/', 'image/')
+UNSAFE_CONTENT_TYPES = ('image/svg+xml',)
+
+
+def is_inline(content_type: str) -> bool:
+    return content_type.startswith(INLINE_CONTENT_TYPES) and content_type not in UNSAFE_CONTENT_TYPES
+
+
+router = APIRouter(
+    prefix='/media',
+    tags=[Tags.media]
+)
+
+
+def _add_media(db: Session, hash: str, size: int, content_type: str) -> Media:
+    # Built while the session can still load the row, the commit expired it and async sessions can't lazy load later
+    return Media.from_orm(media_crud.add_media(db, hash, size, content_type))
+
+
+@router.post(
+    '/',
+    response_model=Media,
+    summary='Upload media for cards',
+    openapi_extra={'requestBody': {'content': {'*/*': {'schema': {'type': 'string', 'format': 'binary'}}}}}
+)
+async def upload_media(
+        request: Request,
+        content_type: str = Header(DEFAULT_CONTENT_TYPE),
+        user: UserDb = Depends(get_active_current_user),
+        db: Session = Depends(get_session)
+):
+    """
+    Stores raw request body, which may be sent chunked, and returns its hash
+    * Use the hash as `voice_address`/`picture_address` of cards
+    * Uploading content that is already stored returns the existing hash
+    * Only audio and image content types are kept, others are stored as application/octet-stream
+    """
+    try:
+        hash, size = await store_stream(request.stream())
+    except MediaTooLarge:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f'Media larger than {Settings.MEDIA_MAX_SIZE} bytes'
+        )
+
+    content_type = content_type.split(';')[0].strip().lower()
+    if not is_inline(content_type):
+        content_type = DEFAULT_CONTENT_TYPE
+    return await run_db(db, _add_media, hash, size, content_type)
+
+
+@router.api_route(
+    '/{hash}',
+    methods=['GET', 'HEAD'],
+    summary='Get media by hash',
+    response_class=Response,
+    responses={200: {'content': {'*/*': {}}}, 206: {'description': 'Partial content'}}
+)
+async def get_media(
+        request: Request,
+        hash: str,
+        range: Optional[str] = Header(None),
+        if_none_match: Optional[str] = Header(None),
+        db: Session = Depends(get_session)
+):
+    """
+    Returns media content
+    * Content under a hash never changes and is cached indefinitely
+    * Supports single byte ranges for seeking
+    * Content other than audio and images is sent as an attachment
+    """
+    if not HASH_PATTERN.match(hash):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Media not found')
+
+    db_media = await run_db(db, media_crud.get_media, hash)
+    path = media_path(hash)
+    if not db_media or not os.path.exists(path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Media not found')
+
+    etag = f'"{hash}"'
+    headers = {
+        ETAG_HEADER: etag,
+        'Cache-Control': Settings.MEDIA_CACHE_CONTROL,
+        'Accept-Ranges': 'bytes',
+        'X-Content-Type-Options': 'nosniff'
+    }
+    if not is_inline(db_media.content_type):
+        headers['Content-Disposition'] = 'attachment'
+
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag, headers)
+
+    try:
+        byte_range = parse_range(range, db_media.size)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail='Range not satisfiable',
+            headers={'Content-Range': f'bytes */{db_media.size}'}
+        )
+
+    if byte_range is None:
+        response = FileResponse(path, media_type=db_media.content_type, method=request.method)
+        # Replaces ETag derived from file modification time
+        response.headers.update(headers)
+        return response
+
+    start, end = byte_range
+    headers['Content-Range'] = f'bytes {start}-{end}/{db_media.size}'
+    headers['Content-Length'] = str(end - start + 1)
+
+    if request.method == 'HEAD':
+        return Response(status_code=status.HTTP_206_PARTIAL_CONTENT, media_type=db_media.content_type, headers=headers)
+
+    return StreamingResponse(
+        read_range(path, start, end),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=db_media.content_type,
+        headers=headers
+    )
@@ -1,11 +1,20 @@
-from typing import List
+import base64
+import binascii
 
-from fastapi import APIRouter, Depends, Body, Response, status
+import orjson
 
+from typing import AsyncIterator, Iterator, List, Optional
+
+from fastapi import APIRouter, Depends, Body, Header, HTTPException, Query, Request, Response, status
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
+from pydantic import ValidationError
+
+from app.http import ETAG_HEADER, etag_matches, make_etag, not_modified
+from app.settings import Settings
 from app.tags import Tags
-from app.models import Result, UserDb, Card, Set, SetDb
-from app.sql.database import Session
-from app.dependencies import get_db
+from app.models import Result, UserDb, Card, CardUpdate, CardBatch, CardMatch, Set, SetDb, SetImportResult, SetSummary, SetUpdate, SyncPage
+from app.sql.database import Session, SessionLocal
+from app.dependencies import get_session, run_db
 from app.routers.users import get_active_current_user
 
 from app.sql.crud import set as set_crud
@@ -15,21 +24,87 @@ router = APIRouter(
     tags=[Tags.sets]
 )
 
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+SET_FIELDS = list(Set.__fields__)
+CARD_FIELDS = list(Card.__fields__)
+
+# Number of sets written per transaction when importing
+IMPORT_CHUNK_SIZE = 100
+
+
+def dict_response(content, response: Response) -> JSONResponse:
+    """
+    Returns already serializable content bypassing response model, keeping headers set on `response`
+    """
+    response_class = ORJSONResponse if Settings.FAST_JSON else JSONResponse
+
+    dict_response = response_class(content=content)
+    for header in (NEXT_CURSOR_HEADER, ETAG_HEADER):
+        if header in response.headers:
+            dict_response.headers[header] = response.headers[header]
+
+    return dict_response
+
+
+def encode_cursor(position: int) -> str:
+    return base64.urlsafe_b64encode(str(position).encode()).decode()
+
+
+def parse_fields(fields: str) -> List[str]:
+    selected = [field.strip() for field in fields.split(',') if field.strip()]
+
+    unknown = [field for field in selected if field not in Set.__fields__]
+    if not selected or unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields: {', '.join(unknown)}"
+        )
+
+    return selected
+
+
+def set_to_dict(db_set: SetDb, fields: List[str] = SET_FIELDS) -> dict:
+    """
+    Builds JSON serializable set straight from database row, skipping model validation
+
+    Stored sets were already validated when written.
+    """
+    data = {}
+    for field in fields:
+        if field == 'cards':
+            data[field] = [{key: getattr(card, key) for key in CARD_FIELDS} for card in db_set.cards]
+        else:
+            data[field] = getattr(db_set, field)
+
+    return data
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Invalid cursor'
+        )
+
 
 @router.post(
     '/',
     response_model=Result,
     summary='Create/update a set for user'
 )
-def create_set(response: Response,
-               set: Set = Body(description='Set description'),
-               user: UserDb = Depends(get_active_current_user),
-               db: Session = Depends(get_db)):
+async def create_set(response: Response,
+                     set: Set = Body(description='Set description'),
+                     user: UserDb = Depends(get_active_current_user),
+                     db: Session = Depends(get_session)):
     """
     Creates or updates (if ID exists) a set
     """
 
-    set = set_crud.add_set(db, set, user)
+    set = await run_db(db, set_crud.add_set, set, user.id)
     if not set:
         return Result(code=status.HTTP_400_BAD_REQUEST, message='Failed to add set')
 
@@ -41,12 +116,248 @@ def create_set(response: Response,
     response_model=List[Set],
     summary='Get sets owned by user'
 )
-def get_sets(user: UserDb = Depends(get_active_current_user), db: Session = Depends(get_db)):
+async def get_sets(
+        response: Response,
+        cursor: Optional[str] = Query(None, description='Cursor returned in X-Next-Cursor header of previous page'),
+        limit: int = Query(100, ge=1, le=500),
+        type: Optional[str] = Query(None, description='Only return sets of this type'),
+        name: Optional[str] = Query(None, description='Only return sets whose name starts with this'),
+        fields: Optional[str] = Query(None, description='Comma separated set fields to return, e.g. id,name'),
+        if_none_match: Optional[str] = Header(None),
+        user: UserDb = Depends(get_active_current_user),
+        db: Session = Depends(get_session)
+):
+    """
+    Returns sets owned by the user ordered by ID
+    * Returns up to *limit* sets per page
+    * If there are more sets, X-Next-Cursor header is set to the cursor of the next page
+    * Only *fields* are returned if specified, cards are not loaded unless requested
+    * Returns 304 if none of the user's sets changed since ETag in If-None-Match
+    """
+    etag = make_etag(await run_db(db, set_crud.get_sets_version, user.id))
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    response.headers[ETAG_HEADER] = etag
+
+    after = decode_cursor(cursor) if cursor else None
+    selected = parse_fields(fields) if fields else None
+    load_cards = not selected or 'cards' in selected
+
+    # Fetch one extra set to find out if there is a next page
+    sets = await run_db(db, set_crud.get_sets, user.id, after, limit + 1, type, name, load_cards)
+    if len(sets) > limit:
+        sets = sets[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(sets[-1].id)
+
+    if selected or Settings.FAST_JSON:
+        return dict_response([set_to_dict(db_set, selected or SET_FIELDS) for db_set in sets], response)
+
+    return sets
+
+
+@router.get(
+    '/summaries',
+    response_model=List[SetSummary],
+    summary='Get summaries of sets owned by user'
+)
+async def get_set_summaries(
+        response: Response,
+        cursor: Optional[str] = Query(None, description='Cursor returned in X-Next-Cursor header of previous page'),
+        limit: int = Query(100, ge=1, le=500),
+        type: Optional[str] = Query(None, description='Only return sets of this type'),
+        name: Optional[str] = Query(None, description='Only return sets whose name starts with this'),
+        if_none_match: Optional[str] = Header(None),
+        user: UserDb = Depends(get_active_current_user),
+        db: Session = Depends(get_session)
+):
+    """
+    Returns ID, name, type and number of cards of sets owned by the user ordered by ID
+    * Paginated the same way as getting sets
+    * Returns 304 if none of the user's sets changed since ETag in If-None-Match
+    """
+    etag = make_etag(await run_db(db, set_crud.get_sets_version, user.id))
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    response.headers[ETAG_HEADER] = etag
+
+    after = decode_cursor(cursor) if cursor else None
+
+    summaries = await run_db(db, set_crud.get_set_summaries, user.id, after, limit + 1, type, name)
+    if len(summaries) > limit:
+        summaries = summaries[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(summaries[-1].id)
+
+    return summaries
+
+
+async def read_lines(request: Request, max_size: int) -> AsyncIterator[Optional[bytes]]:
+    """
+    Yields lines of request body as they arrive, None in place of lines longer than `max_size` bytes
+
+    Each chunk is only scanned once, the rest of a line over the limit is dropped as it arrives.
+    """
+    pieces = []
+    size = 0
+    too_long = False
+    async for chunk in request.stream():
+        start = 0
+        while True:
+            end = chunk.find(b'\n', start)
+            piece = chunk[start:] if end == -1 else chunk[start:end]
+
+            if not too_long and piece:
+                size += len(piece)
+                too_long = size > max_size
+                if too_long:
+                    pieces.clear()
+                else:
+                    pieces.append(piece)
+
+            if end == -1:
+                break
+            yield None if too_long else b''.join(pieces)
+            pieces = []
+            size = 0
+            too_long = False
+            start = end + 1
+
+    if pieces or too_long:
+        yield None if too_long else b''.join(pieces)
+
+
+@router.post(
+    '/import',
+    response_model=List[SetImportResult],
+    summary='Create/update sets in bulk',
+    openapi_extra={'requestBody': {'content': {NDJSON_MEDIA_TYPE: {'schema': {'$ref': '#/components/schemas/Set'}}}}}
+)
+async def import_sets(
+        request: Request,
+        user: UserDb = Depends(get_active_current_user),
+        db: Session = Depends(get_session)
+):
+    """
+    Creates or updates (if ID exists) sets from a newline delimited JSON body, one set per line
+    * Sets are validated as they are received and written in chunks
+    * Returns result for each non-empty line
+    * Lines longer than the configured maximum (4 MiB by default) are rejected with 413
+    """
+    results = []
+    chunk = []
+    chunk_results = []
+
+    async def write_chunk():
+        accepted = await run_db(db, set_crud.add_sets, chunk, user.id)
+        for result, ok in zip(chunk_results, accepted):
+            if not ok:
+                result.code = status.HTTP_400_BAD_REQUEST
+                result.message = 'Card IDs are not unique'
+        chunk.clear()
+        chunk_results.clear()
+
+    line_no = 0
+    async for line in read_lines(request, Settings.IMPORT_MAX_LINE_SIZE):
+        line_no += 1
+        if line is None:
+            results.append(SetImportResult(
+                line=line_no, code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                message=f'Line longer than {Settings.IMPORT_MAX_LINE_SIZE} bytes'))
+            continue
+        if not line.strip():
+            continue
+
+        try:
+            card_set = Set.parse_raw(line)
+        except ValidationError:
+            results.append(SetImportResult(
+                line=line_no, code=status.HTTP_422_UNPROCESSABLE_ENTITY, message='JSON validation error'))
+            continue
+
+        result = SetImportResult(line=line_no, id=card_set.id, code=status.HTTP_200_OK, message='Set imported')
+        results.append(result)
+        chunk.append(card_set)
+        chunk_results.append(result)
+
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            await write_chunk()
+
+    if chunk:
+        await write_chunk()
+
+    return results
+
+
+@router.get(
+    '/export',
+    summary='Get all sets owned by user as a stream',
+    response_class=StreamingResponse,
+    responses={200: {'content': {NDJSON_MEDIA_TYPE: {'schema': {'$ref': '#/components/schemas/Set'}}}}}
+)
+async def export_sets(user: UserDb = Depends(get_active_current_user)):
+    """
+    Returns all sets owned by the user as newline delimited JSON, one set per line
+    """
+
+    def export_lines() -> Iterator[bytes]:
+        # Streaming outlives the request's dependencies, use a session of its own
+        with SessionLocal() as db:
+            for db_set in set_crud.iter_sets(db, user.id):
+                if Settings.FAST_JSON:
+                    yield orjson.dumps(set_to_dict(db_set)) + b'\n'
+                else:
+                    yield Set.from_orm(db_set).json().encode() + b'\n'
+
+    return StreamingResponse(export_lines(), media_type=NDJSON_MEDIA_TYPE)
+
+
+@router.get(
+    '/changes',
+    response_model=SyncPage,
+    summary='Get changes to sets since a version'
+)
+async def get_changes(
+        since: int = Query(0, ge=0, description='Version returned by previous sync, 0 to fetch everything'),
+        limit: int = Query(50, ge=1, le=200),
+        user: UserDb = Depends(get_active_current_user),
+        db: Session = Depends(get_session)
+):
+    """
+    Returns sets changed or deleted after version *since* ordered by version
+    * Changed sets only carry cards changed after *since*, apply *deleted_cards* before *cards*
+    * Deleted sets are marked with *deleted*
+    * Pass returned *version* as *since* to fetch the next page while *has_more* is true
+    """
+
+    return await run_db(db, set_crud.get_changes, user.id, since, limit)
+
+
+@router.get(
+    '/search',
+    response_model=List[CardMatch],
+    summary='Search cards of all sets owned by user'
+)
+async def search_cards(
+        response: Response,
+        q: str = Query(..., min_length=1, description='Words to find in card questions and answers'),
+        cursor: Optional[str] = Query(None, description='Cursor returned in X-Next-Cursor header of previous page'),
+        limit: int = Query(20, ge=1, le=100),
+        user: UserDb = Depends(get_active_current_user),
+        db: Session = Depends(get_session)
+):
     """
-    Returns all sets owned by the user
+    Returns cards whose question or answer contain all words of *q*, best matches first
+    * The last word also matches words starting with it
+    * If there are more cards, X-Next-Cursor header is set to the cursor of the next page
     """
+    offset = decode_cursor(cursor) if cursor else 0
 
-    return set_crud.get_sets(db, user)
+    # Fetch one extra card to find out if there is a next page
+    cards = await run_db(db, set_crud.search_cards, user.id, q, offset, limit + 1)
+    if len(cards) > limit:
+        cards = cards[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(offset + limit)
+
+    return cards
 
 
 @router.get(
@@ -54,12 +365,44 @@ def get_sets(user: UserDb = Depends(get_active_current_user), db: Session = Depe
     response_model=Set,
     summary="Get set by ID"
 )
-def get_set(id: int, user: UserDb = Depends(get_active_current_user), db: Session = Depends(get_db)):
+async def get_set(
+        id: int,
+        response: Response,
+        fields: Optional[str] = Query(None, description='Comma separated set fields to return, e.g. id,name'),
+        if_none_match: Optional[str] = Header(None),
+        user: UserDb = Depends(get_active_current_user),
+        db: Session = Depends(get_session)
+):
     """
     Returns a set matching given ID owned by the user
+    * Only *fields* are returned if specified, cards are not loaded unless requested
+    * Returns 304 if the set did not change since ETag in If-None-Match
     """
+    not_found = HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail='Set does not exist'
+    )
 
-    return set_crud.get_set(db, user, id)
+    # Check the version alone first so unchanged sets skip loading cards
+    if if_none_match:
+        version = await run_db(db, set_crud.get_set_version, user.id, id)
+        if version is None:
+            raise not_found
+        if etag_matches(if_none_match, make_etag(version)):
+            return not_modified(make_etag(version))
+
+    selected = parse_fields(fields) if fields else None
+    load_cards = not selected or 'cards' in selected
+
+    db_set = await run_db(db, set_crud.get_set, user.id, id, load_cards)
+    if not db_set:
+        raise not_found
+    response.headers[ETAG_HEADER] = make_etag(db_set.version)
+
+    if selected or Settings.FAST_JSON:
+        return dict_response(set_to_dict(db_set, selected or SET_FIELDS), response)
+
+    return db_set
 
 
 @router.delete(
@@ -67,17 +410,144 @@ def get_set(id: int, user: UserDb = Depends(get_active_current_user), db: Sessio
     response_model=Result,
     summary="Remove a set"
 )
-def delete_set(
+async def delete_set(
         id: int,
         response: Response,
         user: UserDb = Depends(get_active_current_user),
-        db: Session = Depends(get_db)
+        db: Session = Depends(get_session)
 ):
     """
     Removes a set matching given ID owned by the user
     """
-    if set_crud.del_set(db, user, id):
+    if await run_db(db, set_crud.del_set, user.id, id):
         return Result(code=status.HTTP_200_OK, message='Set deleted successfully')
     else:
         response.status_code = status.HTTP_400_BAD_REQUEST
         return Result(code=status.HTTP_400_BAD_REQUEST, message='Failed to delete set')
+
+
+@router.patch(
+    '/{id}',
+    response_model=Result,
+    summary="Update set information"
+)
+async def update_set(
+        id: int,
+        response: Response,
+        update: SetUpdate = Body(description='Set fields to update'),
+        user: UserDb = Depends(get_active_current_user),
+        db: Session = Depends(get_session)
+):
+    """
+    Updates information of a set matching given ID owned by the user
+    * Only specified fields are updated, cards are left untouched
+    """
+    if not await run_db(db, set_crud.update_set, user.id, id, update):
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return Result(code=status.HTTP_404_NOT_FOUND, message='Set does not exist')
+
+    return Result(code=status.HTTP_200_OK, message='Set updated successfully')
+
+
+@router.post(
+    '/{id}/cards',
+    response_model=Result,
+    summary="Add a card to set"
+)
+async def add_card(
+        id: int,
+        response: Response,
+        card: Card = Body(description='Card description'),
+        user: UserDb = Depends(get_active_current_user),
+        db: Session = Depends(get_session)
+):
+    """
+    Adds a card to a set matching given ID owned by the user
+    """
+    db_set = await run_db(db, set_crud.get_set, user.id, id, load_cards=False)
+    if not db_set:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return Result(code=status.HTTP_404_NOT_FOUND, message='Set does not exist')
+
+    if not await run_db(db, set_crud.add_card, db_set, card):
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return Result(code=status.HTTP_400_BAD_REQUEST, message='Card exists')
+
+    return Result(code=status.HTTP_200_OK, message='Card added successfully')
+
+
+@router.patch(
+    '/{id}/cards',
+    response_model=Result,
+    summary="Add, update and remove multiple cards"
+)
+async def update_cards(
+        id: int,
+        response: Response,
+        batch: CardBatch = Body(description='Cards to add/update and card IDs to remove'),
+        user: UserDb = Depends(get_active_current_user),
+        db: Session = Depends(get_session)
+):
+    """
+    Applies a batch of card operations to a set matching given ID owned by the user
+    * Cards in *upsert* are added or replace existing cards with the same ID
+    * Cards with IDs in *delete* are removed
+    """
+    db_set = await run_db(db, set_crud.get_set, user.id, id, load_cards=False)
+    if not db_set:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return Result(code=status.HTTP_404_NOT_FOUND, message='Set does not exist')
+
+    if not await run_db(db, set_crud.update_cards, db_set, batch):
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return Result(code=status.HTTP_400_BAD_REQUEST, message='Card IDs are not unique')
+
+    return Result(code=status.HTTP_200_OK, message='Cards updated successfully')
+
+
+@router.patch(
+    '/{id}/cards/{card_id}',
+    response_model=Result,
+    summary="Update a card"
+)
+async def update_card(
+        id: int,
+        card_id: int,
+        response: Response,
+        update: CardUpdate = Body(description='Card fields to update'),
+        user: UserDb = Depends(get_active_current_user),
+        db: Session = Depends(get_session)
+):
+    """
+    Updates a card in a set matching given ID owned by the user
+    * Only specified fields are updated
+    """
+    db_set = await run_db(db, set_crud.get_set, user.id, id, load_cards=False)
+    if not db_set or not await run_db(db, set_crud.update_card, db_set, card_id, update):
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return Result(code=status.HTTP_404_NOT_FOUND, message='Card does not exist')
+
+    return Result(code=status.HTTP_200_OK, message='Card updated successfully')
+
+
+@router.delete(
+    '/{id}/cards/{card_id}',
+    response_model=Result,
+    summary="Remove a card"
+)
+async def delete_card(
+        id: int,
+        card_id: int,
+        response: Response,
+        user: UserDb = Depends(get_active_current_user),
+        db: Session = Depends(get_session)
+):
+    """
+    Removes a card from a set matching given ID owned by the user
+    """
+    db_set = await run_db(db, set_crud.get_set, user.id, id, load_cards=False)
+    if not db_set or not await run_db(db, set_crud.del_card, db_set, card_id):
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return Result(code=status.HTTP_404_NOT_FOUND, message='Card does not exist')
+
+    return Result(code=status.HTTP_200_OK, message='Card deleted successfully')
@@ -0,0 +1,68 @@
+import time
+
+from typing import List
+
+from fastapi import APIRouter, Depends, Body, HTTPException, status
+
+from app.tags import Tags
+from app.models import UserDb, ReviewIn, ReviewOut, StudyRound
+from app.sql.database import Session
+from app.dependencies import get_session, run_db
+from app.routers.users import get_active_current_user
+
+from app.sql.crud import set as set_crud
+from app.sql.crud import study as study_crud
+
+router = APIRouter(
+    prefix='/sets',
+    tags=[Tags.study]
+)
+
+
+async def get_study_set(id: int, user: UserDb, db: Session):
+    db_set = await run_db(db, set_crud.get_set, user.id, id, load_cards=False)
+    if not db_set:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Set does not exist')
+
+    return db_set
+
+
+@router.get(
+    '/{id}/study',
+    response_model=StudyRound,
+    summary='Get next round of cards to study'
+)
+async def get_round(
+        id: int,
+        user: UserDb = Depends(get_active_current_user),
+        db: Session = Depends(get_session)
+):
+    """
+    Returns up to *max_question* due cards of a set matching given ID owned by the user
+    * Cards are picked by a spaced repetition schedule, most overdue first
+    * New cards are due right away
+    """
+    db_set = await get_study_set(id, user, db)
+
+    cards, has_more = await run_db(db, study_crud.get_due_cards, db_set, time.time(), max(db_set.max_question or 0, 0))
+    return StudyRound(question_time=db_set.question_time or 0, cards=cards, has_more=has_more)
+
+
+@router.post(
+    '/{id}/study',
+    response_model=List[ReviewOut],
+    summary='Submit answers of a study round'
+)
+async def review_cards(
+        id: int,
+        reviews: List[ReviewIn] = Body(description='Graded answers'),
+        user: UserDb = Depends(get_active_current_user),
+        db: Session = Depends(get_session)
+):
+    """
+    Grades answers from 0 (forgotten) to 5 (perfect recall) and schedules when each card is due next
+    * Returns new schedule of each reviewed card, unknown card IDs are ignored
+    """
+    db_set = await get_study_set(id, user, db)
+
+    return await run_db(db, study_crud.review_cards, db_set, reviews, time.time())
@@ -1,37 +1,42 @@
-from typing import Optional
+import time
+
+from typing import Optional, Tuple
 from datetime import datetime, timedelta
 
-from fastapi import APIRouter, Cookie, Response, HTTPException, status, Depends, BackgroundTasks
+from fastapi import APIRouter, Cookie, Response, HTTPException, status, Depends
 
 from jose import jwt
 from jose.exceptions import JWTError
 
-from passlib.context import CryptContext
 from app.models.result import Result
 
+from app.cache import TTLCache
 from app.settings import Settings
 from app.tags import Tags
-from app.mail import send_mail
-from app.dependencies import get_db
+from app.mail import queue_mail
+from app.passwords import hash_password_async, verify_password_async
+from app.ratelimit import RateLimit
+from app.dependencies import get_db, get_session, run_db
 from app.models.user import EmailIn, LoginInfo, PassIn, TokenIn, UserUpdate, UserIn, UserDb, UserOut
 
 from app.sql.database import Session
 from app.sql.crud import user as crud_user
 
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
-
 # Generate random key with `openssl rand -hex 32`
 JWT_KEY = '64d016c4f5bee1e80cd3eb8bc42013f997eaac43b56b5aa10a5a1532a17f8655'
 JWT_ALGO = 'HS256'
 JWT_DEFAULT_EXP_DAYS = 7
 
+# Maps auth token to user ID so repeated requests skip decoding
+token_cache = TTLCache(maxsize=Settings.TOKEN_CACHE_SIZE, ttl=Settings.USER_CACHE_TTL)
+
 router = APIRouter(
     prefix='/users',
     tags=[Tags.users]
 )
 
 
-def get_current_user(fc_authtoken: str = Cookie(default=None), db: Session = Depends(get_db)):
+async def get_current_user(fc_authtoken: str = Cookie(default=None), db: Session = Depends(get_session)):
     auth_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail='Failed to verify token'
@@ -40,23 +45,41 @@ def get_current_user(fc_authtoken: str = Cookie(default=None), db: Session = Dep
     if not fc_authtoken:
         raise auth_exception
 
-    try:
-        token_data: dict = jwt.decode(fc_authtoken, JWT_KEY, JWT_ALGO)
-        id = token_data.get('sub')
-        if not id:
+    id = token_cache.get(fc_authtoken)
+    if id is None:
+        try:
+            token_data: dict = jwt.decode(fc_authtoken, JWT_KEY, JWT_ALGO)
+            id = token_data.get('sub')
+            if not id:
+                raise auth_exception
+            id = int(id)
+        except JWTError:
             raise auth_exception
-        id = int(id)
-    except JWTError:
-        raise auth_exception
 
-    user = crud_user.get_user(db, id)
+        # Never keep a token cached past its expiry
+        exp = token_data.get('exp')
+        ttl = Settings.USER_CACHE_TTL
+        if exp:
+            ttl = min(ttl, exp - time.time())
+        token_cache.set(fc_authtoken, id, ttl)
+
+    user = await run_db(db, _get_cached_user, id)
     if not user:
         raise auth_exception
 
     return user
 
 
-def get_active_current_user(user: UserDb = Depends(get_current_user)):
+def _get_cached_user(db: Session, user_id: int) -> Optional[UserDb]:
+    user = crud_user.get_cached_user(db, user_id)
+
+    # Ends the read transaction, routes may wait on bcrypt before touching the database again
+    db.commit()
+
+    return user
+
+
+async def get_active_current_user(user: UserDb = Depends(get_current_user)):
     if not user.active:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -79,11 +102,51 @@ def create_access_token(subject: str, exp_delta: Optional[timedelta] = timedelta
     return token
 
 
+def create_user_token(db: Session, user_id: int, reuse: bool = False) -> str:
+    """
+    Creates a single use token to email to the user and records its hash
+
+    With `reuse`, a recorded token valid for at least Settings.TOKEN_REUSE_MIN_TTL is returned instead.
+    """
+
+    if reuse:
+        db_token = crud_user.get_live_token(db, user_id, time.time() + Settings.TOKEN_REUSE_MIN_TTL)
+        if db_token:
+            # Tokens only carry subject and expiry, so encoding them again gives back the emailed token
+            token = jwt.encode({'sub': str(user_id), 'exp': db_token.expires_at}, JWT_KEY, JWT_ALGO)
+            if crud_user.hash_token(token) == db_token.token_hash:
+                return token
+
+    expires_at = int(time.time()) + JWT_DEFAULT_EXP_DAYS * 24 * 60 * 60
+    token = jwt.encode({'sub': str(user_id), 'exp': expires_at}, JWT_KEY, JWT_ALGO)
+    crud_user.add_user_token(db, token, user_id, expires_at)
+
+    return token
+
+
+def _get_credentials(db: Session, email: str) -> Optional[Tuple[int, str]]:
+    user_db = crud_user.get_user_by_email(db, email)
+    credentials = (user_db.id, user_db.hashed_password) if user_db else None
+
+    # Ends the read transaction so the connection goes back to the pool while bcrypt runs
+    db.commit()
+
+    return credentials
+
+
+def _email_taken(db: Session, email: str) -> bool:
+    taken = crud_user.get_user_by_email(db, email) is not None
+    db.commit()
+
+    return taken
+
+
 @router.post(
     '/login',
-    response_model=Result
+    response_model=Result,
+    dependencies=[Depends(RateLimit('login_ip', 'login_email'))]
 )
-def login(info: LoginInfo, response: Response = Response(), db: Session = Depends(get_db)):
+async def login(info: LoginInfo, response: Response = Response(), db: Session = Depends(get_session)):
     """
     Sets fc_authtoken token cookie based on username and password
 
@@ -92,13 +155,24 @@ def login(info: LoginInfo, response: Response = Response(), db: Session = Depend
 
     info.email = info.email.lower()
 
-    user_db = crud_user.get_user_by_email(db, info.email)
+    credentials = await run_db(db, _get_credentials, info.email)
 
-    if not user_db or not pwd_context.verify(info.password, user_db.hashed_password):
+    invalid_result = Result(code=status.HTTP_401_UNAUTHORIZED, message='Invalid email/password')
+    if not credentials:
         response.status_code = status.HTTP_401_UNAUTHORIZED
-        return Result(code=status.HTTP_401_UNAUTHORIZED, message='Invalid email/password')
+        return invalid_result
 
-    token = create_access_token(str(user_db.id))
+    user_id, hashed_password = credentials
+    valid, new_hash = await verify_password_async(info.password, hashed_password)
+    if not valid:
+        response.status_code = status.HTTP_401_UNAUTHORIZED
+        return invalid_result
+
+    # Upgrade hashes made with outdated parameters
+    if new_hash:
+        await run_db(db, crud_user.update_user_hash, user_id, new_hash)
+
+    token = create_access_token(str(user_id))
     response.set_cookie(key='fc_authtoken', value=token)
 
     return Result(code=status.HTTP_200_OK, message='Logged in successfully')
@@ -120,12 +194,30 @@ def login(response: Response = Response(), user: UserDb = Depends(get_current_us
     return Result(code=status.HTTP_200_OK, message='Token renewed successfully')
 
 
+def _add_user(db: Session, user: UserIn, hashed_password: str) -> None:
+    db_user = crud_user.add_user(db, user, hashed_password)
+
+    verify_token = create_user_token(db, db_user.id)
+
+    verify_link = f"{Settings.STATIC_URL}/verify.html?token={verify_token}"
+    queue_mail(
+        db,
+        user.email,
+        'Verify Email Address',
+        (f"Hi!\n"
+         "We just need to verify your email address before you can use our app.\n"
+         f"Verify your email address here:\n"
+         f"<a href=\"{verify_link}\">{verify_link}</a>")
+    )
+
+
 @router.post(
     '/',
     summary='Create new user',
-    response_model=Result
+    response_model=Result,
+    dependencies=[Depends(RateLimit('mail_ip', 'mail_email'))]
 )
-def create_user(user: UserIn, response: Response, tasks: BackgroundTasks, db: Session = Depends(get_db)):
+async def create_user(user: UserIn, response: Response, db: Session = Depends(get_session)):
     """
     Creates a new user
     * New users are **inactive** by default
@@ -134,25 +226,13 @@ def create_user(user: UserIn, response: Response, tasks: BackgroundTasks, db: Se
 
     user.email = user.email.lower()
 
-    if crud_user.get_user_by_email(db, user.email):
+    if await run_db(db, _email_taken, user.email):
         response.status_code = status.HTTP_400_BAD_REQUEST
         return Result(code=status.HTTP_400_BAD_REQUEST, message='User exists')
 
-    db_user = crud_user.add_user(db, user)
-
-    verify_token = create_access_token(str(db_user.id))
-    crud_user.add_user_token(db, verify_token, db_user.id)
+    hashed_password = await hash_password_async(user.password)
 
-    verify_link = f"{Settings.STATIC_URL}/verify.html?token={verify_token}"
-    tasks.add_task(
-        send_mail,
-        user.email,
-        'Verify Email Address',
-        (f"Hi!\n"
-         "We just need to verify your email address before you can use our app.\n"
-         f"Verify your email address here:\n"
-         f"<a href=\"{verify_link}\">{verify_link}</a>")
-    )
+    await run_db(db, _add_user, user, hashed_password)
 
     return Result(code=status.HTTP_200_OK, message='User created successfully')
 
@@ -203,9 +283,10 @@ def verify_user(token: TokenIn, response: Response, db: Session = Depends(get_db
 @router.post(
     '/verify',
     summary='Resend verification email',
-    response_model=Result
+    response_model=Result,
+    dependencies=[Depends(RateLimit('mail_ip', 'mail_email'))]
 )
-def resend_verify(email: EmailIn, response: Response, tasks: BackgroundTasks, db: Session = Depends(get_db)):
+def resend_verify(email: EmailIn, response: Response, db: Session = Depends(get_db)):
     email.email = email.email.lower()
 
     db_user = crud_user.get_user_by_email(db, email.email)
@@ -216,12 +297,11 @@ def resend_verify(email: EmailIn, response: Response, tasks: BackgroundTasks, db
         response.status_code = status.HTTP_400_BAD_REQUEST
         return Result(code=status.HTTP_400_BAD_REQUEST, message='User already active')
 
-    verify_token = create_access_token(str(db_user.id))
-    crud_user.add_user_token(db, verify_token, db_user.id)
+    verify_token = create_user_token(db, db_user.id)
 
     verify_link = f"{Settings.STATIC_URL}/verify.html?token={verify_token}"
-    tasks.add_task(
-        send_mail,
+    queue_mail(
+        db,
         db_user.email,
         'Verify Email Address',
         (f"Hi!\n"
@@ -259,16 +339,20 @@ def del_user_me(user: UserDb = Depends(get_current_user), db: Session = Depends(
     return Result(code=status.HTTP_200_OK, message='User deleted successfully')
 
 
+def _update_user(db: Session, user_id: int, hashed_password: Optional[str]) -> bool:
+    return crud_user.update_user(db, user_id, hashed_password) is not None
+
+
 @router.put(
     '/me',
     summary='Update current user info',
     response_model=Result
 )
-def update_user(
+async def update_user(
     update: UserUpdate,
     response: Response,
     user: UserDb = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_session)
 ):
     """
     Updates information for current user
@@ -276,12 +360,16 @@ def update_user(
     * Returns user information after update
     """
 
+    hashed_password = None
     if update.new_password:
-        if not update.current_password or not pwd_context.verify(update.current_password, user.hashed_password):
+        if not update.current_password or \
+                not (await verify_password_async(update.current_password, user.hashed_password))[0]:
             response.status_code = status.HTTP_401_UNAUTHORIZED
             return Result(code=status.HTTP_401_UNAUTHORIZED, message='Incorrect current password')
 
-    new_user = crud_user.update_user(db, user.id, update)
+        hashed_password = await hash_password_async(update.new_password)
+
+    new_user = await run_db(db, _update_user, user.id, hashed_password)
     if not new_user:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         return Result(code=status.HTTP_500_INTERNAL_SERVER_ERROR, message='Failed to update user')
@@ -292,9 +380,10 @@ def update_user(
 @router.post(
     '/password',
     summary='Initiate password reset',
-    response_model=Result
+    response_model=Result,
+    dependencies=[Depends(RateLimit('mail_ip', 'mail_email'))]
 )
-def pass_reset_init(input: EmailIn, response: Response, tasks: BackgroundTasks, db: Session = Depends(get_db)):
+def pass_reset_init(input: EmailIn, response: Response, db: Session = Depends(get_db)):
     """
     Initiaites password reset procedure
     1. User will receive an email with link
@@ -309,14 +398,11 @@ def pass_reset_init(input: EmailIn, response: Response, tasks: BackgroundTasks,
         response.status_code = status.HTTP_404_NOT_FOUND
         return Result(code=status.HTTP_404_NOT_FOUND, message='User does not exist')
 
-    # TODO reuse existing token if possible
-
-    token = create_access_token(str(user_db.id))
-    crud_user.add_user_token(db, token, user_db.id)
+    token = create_user_token(db, user_db.id, reuse=True)
 
     reset_link = f"{Settings.STATIC_URL}/reset.html?token={token}"
-    tasks.add_task(
-        send_mail,
+    queue_mail(
+        db,
         user_db.email,
         'Reset Account Password',
         (f"Hi\n"
@@ -328,12 +414,20 @@ def pass_reset_init(input: EmailIn, response: Response, tasks: BackgroundTasks,
     return Result(code=status.HTTP_200_OK, message='Password reset initiated')
 
 
+def _check_user_token(db: Session, token: str, user_id: int) -> bool:
+    valid = crud_user.check_user_token(db, token, user_id)
+    db.commit()
+
+    return valid
+
+
 @router.put(
     '/password/{token}',
     summary='Reset user password',
-    response_model=Result
+    response_model=Result,
+    dependencies=[Depends(RateLimit('password_ip'))]
 )
-def pass_reset(input: PassIn, response: Response, token: str, db=Depends(get_db)):
+async def pass_reset(input: PassIn, response: Response, token: str, db: Session = Depends(get_session)):
     """
     Resets user password after verifying token
 
@@ -358,18 +452,17 @@ def pass_reset(input: PassIn, response: Response, token: str, db=Depends(get_db)
         response.status_code = status.HTTP_400_BAD_REQUEST
         return bad_token_result
 
-    db_user = crud_user.get_user(db, id)
-    if not db_user:
-        response.status_code = status.HTTP_400_BAD_REQUEST
-        return bad_token_result
-    if not crud_user.check_user_token(db, token, id):
+    if not await run_db(db, _check_user_token, token, id):
         response.status_code = status.HTTP_400_BAD_REQUEST
         return bad_token_result
 
-    crud_user.del_user_token(db, token, id)
+    # Hashed before the token is used up, a full hash queue leaves it valid for another try
+    hashed_password = await hash_password_async(input.password)
 
-    crud_user.update_user(db, id, UserUpdate(new_password=input.password))
-    # Activate user as we know they have access to the email
-    crud_user.activate_user(db, id)
+    # Activates the user too as we know they have access to the email
+    if not await run_db(db, crud_user.reset_password, token, id, hashed_password):
+        # Used by a concurrent reset meanwhile
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return bad_token_result
 
     return Result(code=status.HTTP_200_OK, message='Password reset successfully')
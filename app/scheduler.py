@@ -0,0 +1,37 @@
+from typing import NamedTuple
+
+DAY = 24 * 60 * 60
+
+MIN_EASE = 1.3
+
+# Grades are 0-5, answers graded below this count as forgotten
+PASS_GRADE = 3
+
+
+class ReviewState(NamedTuple):
+    interval: float
+    ease: float
+    repetitions: int
+    lapses: int
+
+
+def schedule(state: ReviewState, grade: int) -> ReviewState:
+    """
+    Returns review state after answering with `grade` using SM-2
+
+    Forgotten cards start over with a one day interval, ease drops with weaker answers either way.
+    """
+
+    ease = max(MIN_EASE, state.ease + 0.1 - (5 - grade) * (0.08 + (5 - grade) * 0.02))
+
+    if grade < PASS_GRADE:
+        return ReviewState(interval=1, ease=ease, repetitions=0, lapses=state.lapses + 1)
+
+    if state.repetitions == 0:
+        interval = 1
+    elif state.repetitions == 1:
+        interval = 6
+    else:
+        interval = state.interval * state.ease
+
+    return ReviewState(interval=interval, ease=ease, repetitions=state.repetitions + 1, lapses=state.lapses)
@@ -1,3 +1,38 @@
+import os
+
+from dotenv import load_dotenv
+
+# Database settings can be overridden through the environment or a .env file
+load_dotenv()
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def _env_dict(name: str, default: dict) -> dict:
+    """
+    Overrides entries of `default` with a comma separated name=value list, e.g. "synchronous=FULL,cache_size=-64000"
+    """
+
+    value = dict(default)
+    for item in os.environ.get(name, '').split(','):
+        if item.strip():
+            key, _, setting = item.partition('=')
+            value[key.strip()] = setting.strip()
+    return value
+
+
+def _async_url(url: str) -> str:
+    for prefix, async_prefix in (('sqlite://', 'sqlite+aiosqlite://'), ('postgresql://', 'postgresql+asyncpg://')):
+        if url.startswith(prefix):
+            return async_prefix + url[len(prefix):]
+    return url
+
+
 class Settings:
     MAIN_DOMAIN = 'example.com'
     API_DOMAIN = 'api.example.com'
@@ -14,8 +49,125 @@ class Settings:
 
     SMTP_SERVER = 'example.com'
     SMTP_PORT = 465
+    SMTP_SSL = True
+    SMTP_TIMEOUT = 30
+    # Reconnect instead of reusing connections idle for longer than this
+    SMTP_IDLE_TIMEOUT = 60
 
     SMTP_USER = 'noreply@example.com'
     SMTP_PASS = 'password'
 
     MAIL_FROM_NAME = 'FlashNest'
+
+    # Outbound mail is queued in the database and delivered by background workers
+    MAIL_WORKERS = 2
+    # Mails a worker delivers before looking for new work, each is claimed right before it is sent
+    MAIL_BATCH_SIZE = 20
+    MAIL_POLL_INTERVAL = 5
+    # Has to outlast a single send, i.e. connecting, logging in and sending (up to SMTP_TIMEOUT each)
+    MAIL_LEASE_TIME = 300
+    MAIL_MAX_ATTEMPTS = 8
+    MAIL_RETRY_DELAY = 30
+    MAIL_RETRY_MAX_DELAY = 3600
+
+    # Any SQLAlchemy URL, server databases need their driver installed (e.g. psycopg2/asyncpg for PostgreSQL)
+    DATABASE_URL = os.environ.get('FC_DATABASE_URL', 'sqlite:///./app.sqlite3')
+    ASYNC_DATABASE_URL = os.environ.get('FC_ASYNC_DATABASE_URL', _async_url(DATABASE_URL))
+
+    # Connections are pooled so per-connection caches and mmap survive between requests
+    # A session keeps its connection while its request awaits, so requests in flight can outnumber the threadpool (40)
+    # SQLite opens overflow connections without a cap (-1), server databases default to one per threadpool thread
+    DB_POOL_SIZE = int(os.environ.get('FC_DB_POOL_SIZE', 10))
+    DB_MAX_OVERFLOW = int(os.environ.get('FC_DB_MAX_OVERFLOW', -1 if DATABASE_URL.startswith('sqlite') else 30))
+    DB_POOL_TIMEOUT = int(os.environ.get('FC_DB_POOL_TIMEOUT', 30))
+    # Seconds after which connections are replaced, -1 keeps them forever
+    DB_POOL_RECYCLE = int(os.environ.get('FC_DB_POOL_RECYCLE', -1))
+    DB_ECHO = _env_bool('FC_DB_ECHO', False)
+
+    # Schema is managed by `python -m app.sql.migrations upgrade`, workers refuse to start on an outdated one
+    # Auto migration upgrades it on startup instead, only safe with a single worker (e.g. development)
+    DB_AUTO_MIGRATE = _env_bool('FC_DB_AUTO_MIGRATE', False)
+
+    # Applied to every new connection when using SQLite, FC_SQLITE_PRAGMAS overrides single entries
+    # WAL lets readers proceed while a write is being committed
+    # foreign_keys has to stay on, deletes rely on ON DELETE CASCADE
+    SQLITE_PRAGMAS = _env_dict('FC_SQLITE_PRAGMAS', {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'foreign_keys': 'ON',
+        'busy_timeout': 5000,
+        'cache_size': -16000,
+        'mmap_size': 268435456
+    })
+
+    # Use an AsyncSession for async endpoints instead of sync sessions in the threadpool
+    DB_ASYNC = _env_bool('FC_DB_ASYNC', False)
+
+    # Serialize set payloads straight from database rows with orjson instead of validating them
+    # through response models first
+    FAST_JSON = _env_bool('FC_FAST_JSON', True)
+
+    # Lines of NDJSON set imports longer than this many bytes are rejected without being buffered
+    IMPORT_MAX_LINE_SIZE = int(os.environ.get('FC_IMPORT_MAX_LINE_SIZE', 4 * 1024 * 1024))
+
+    # Responses at least COMPRESS_MIN_SIZE bytes long are compressed, brotli is used when installed
+    # and accepted by the client, falling back to gzip
+    COMPRESS_MIN_SIZE = int(os.environ.get('FC_COMPRESS_MIN_SIZE', 1024))
+    COMPRESS_LEVEL = int(os.environ.get('FC_COMPRESS_LEVEL', 6))
+    COMPRESS_BROTLI = _env_bool('FC_COMPRESS_BROTLI', True)
+    BROTLI_QUALITY = int(os.environ.get('FC_BROTLI_QUALITY', 4))
+    # Body chunks at least this large are compressed in the threadpool instead of blocking the event loop
+    COMPRESS_THREAD_MIN_SIZE = int(os.environ.get('FC_COMPRESS_THREAD_MIN_SIZE', 64 * 1024))
+    # Serve static files from .br/.gz variants written at startup
+    STATIC_PRECOMPRESS = True
+
+    # Uploaded card media is stored on disk under its SHA-256, identical uploads are stored once
+    MEDIA_PATH = os.environ.get('FC_MEDIA_PATH', './media')
+    MEDIA_MAX_SIZE = 20 * 1024 * 1024
+    MEDIA_CHUNK_SIZE = 64 * 1024
+    # Content never changes under a hash, so clients may cache it forever
+    MEDIA_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+    # Expired verification/reset tokens are purged every TOKEN_SWEEP_INTERVAL seconds
+    TOKEN_SWEEP_INTERVAL = 3600
+    TOKEN_SWEEP_BATCH_SIZE = 1000
+    # Password reset emails resend a token still valid for at least this many seconds instead of creating one
+    TOKEN_REUSE_MIN_TTL = 3600
+
+    # Token buckets throttling endpoints that hash passwords or send mail, per client IP and per email
+    # Each limit is (capacity, seconds for an empty bucket to refill)
+    RATE_LIMIT_ENABLED = _env_bool('FC_RATE_LIMIT_ENABLED', True)
+    RATE_LIMITS = {
+        'login_ip': (30, 60),
+        'login_email': (10, 600),
+        'mail_ip': (10, 3600),
+        'mail_email': (3, 3600),
+        'password_ip': (10, 600),
+    }
+    # 'memory' keeps buckets per worker process, 'database' shares them through RATE_LIMIT_DATABASE_URL
+    RATE_LIMIT_BACKEND = os.environ.get('FC_RATE_LIMIT_BACKEND', 'memory')
+    RATE_LIMIT_DATABASE_URL = os.environ.get('FC_RATE_LIMIT_DATABASE_URL', 'sqlite:///./ratelimit.sqlite3')
+    RATE_LIMIT_MAX_KEYS = 100000
+    # Use X-Forwarded-For as client IP, only enable behind a proxy that sets it
+    RATE_LIMIT_TRUST_FORWARDED = _env_bool('FC_RATE_LIMIT_TRUST_FORWARDED', False)
+
+    # Prometheus metrics of this worker process at /metrics
+    METRICS_ENABLED = _env_bool('FC_METRICS_ENABLED', True)
+    # Scrapers send it as "Authorization: Bearer <token>", /metrics is not served without one
+    METRICS_TOKEN = os.environ.get('FC_METRICS_TOKEN') or None
+    # Requests taking longer are logged with their slowest SQL statements
+    SLOW_REQUEST_TIME = float(os.environ.get('FC_SLOW_REQUEST_TIME', 1.0))
+    SLOW_REQUEST_STATEMENTS = 5
+
+    # Per-process caches of decoded auth tokens and user rows
+    # Other workers only see user changes once their entries expire
+    TOKEN_CACHE_SIZE = 4096
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 60
+
+    # Password hashing runs in a process pool to keep request threads responsive
+    # Requests fail with 503 once HASH_QUEUE_LIMIT jobs are pending, 0 workers hashes inline
+    # Sync callers hold a threadpool thread (40) while waiting, keep the limit below it and the DB pool
+    BCRYPT_ROUNDS = int(os.environ.get('FC_BCRYPT_ROUNDS', 12))
+    HASH_WORKERS = int(os.environ.get('FC_HASH_WORKERS', os.cpu_count() or 1))
+    HASH_QUEUE_LIMIT = int(os.environ.get('FC_HASH_QUEUE_LIMIT', 16))
@@ -0,0 +1,86 @@
+import time
+
+from typing import Optional
+from sqlalchemy.orm import Session
+
+from app.sql import models as sql_models
+
+
+def add_mail(db: Session, to_addr: str, subject: str, message: str, to_name: Optional[str] = None) -> sql_models.Mail:
+    db_mail = sql_models.Mail(
+        to_addr=to_addr,
+        to_name=to_name,
+        subject=subject,
+        message=message,
+        next_attempt_at=time.time()
+    )
+
+    db.add(db_mail)
+    db.commit()
+
+    return db_mail
+
+
+def claim_mail(db: Session, lease: float, due_before: Optional[float] = None,
+               candidates: int = 10) -> Optional[sql_models.Mail]:
+    """
+    Claims the longest due mail for delivery, only considering mails due at `due_before` if given
+
+    The claimed mail is hidden from other workers for `lease` seconds, so it is retried if the claiming
+    worker dies before reporting back. Mails are claimed one at a time so the lease only has to cover a
+    single send. Up to `candidates` due mails are tried in case other workers claim them first.
+    """
+
+    now = time.time()
+    due = db.query(sql_models.Mail).\
+        filter(sql_models.Mail.next_attempt_at <= (now if due_before is None else due_before)).\
+        order_by(sql_models.Mail.next_attempt_at).\
+        limit(candidates).\
+        all()
+
+    for db_mail in due:
+        # Only succeeds if no other worker claimed the mail in the meantime
+        count = db.query(sql_models.Mail).\
+            filter(sql_models.Mail.id == db_mail.id).\
+            filter(sql_models.Mail.next_attempt_at == db_mail.next_attempt_at).\
+            update({
+                sql_models.Mail.next_attempt_at: now + lease,
+                sql_models.Mail.attempts: sql_models.Mail.attempts + 1
+            }, synchronize_session=False)
+        if count:
+            db.commit()
+            return db_mail
+
+    db.commit()
+
+    return None
+
+
+def del_mail(db: Session, mail: sql_models.Mail) -> None:
+    db.query(sql_models.Mail).\
+        filter(sql_models.Mail.id == mail.id).\
+        delete(synchronize_session=False)
+
+    db.commit()
+
+
+def retry_mail(db: Session, mail: sql_models.Mail, error: str, retry_at: Optional[float]) -> None:
+    """
+    Schedules a failed mail for another attempt at `retry_at`, or gives up on it if `retry_at` is None
+
+    Mails given up on are kept for inspection without their message, which holds verification and
+    reset links.
+    """
+
+    values = {
+        sql_models.Mail.next_attempt_at: retry_at,
+        sql_models.Mail.last_error: error
+    }
+    if retry_at is None:
+        values[sql_models.Mail.message] = None
+
+    db.query(sql_models.Mail).\
+        filter(sql_models.Mail.id == mail.id).\
+        update(values, synchronize_session=False)
+
+    db.commit()
@@ -0,0 +1,34 @@
+import time
+
+from typing import Optional
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.sql import models as sql_models
+
+
+def get_media(db: Session, hash: str) -> Optional[sql_models.Media]:
+    return db.query(sql_models.Media).\
+        filter(sql_models.Media.hash == hash).\
+        first()
+
+
+def add_media(db: Session, hash: str, size: int, content_type: str) -> sql_models.Media:
+    """
+    Records stored content, returns the existing row if the same content was uploaded before
+    """
+
+    db_media = get_media(db, hash)
+    if db_media:
+        return db_media
+
+    db_media = sql_models.Media(hash=hash, size=size, content_type=content_type, created_at=time.time())
+    db.add(db_media)
+    try:
+        db.commit()
+    except IntegrityError:
+        # Uploaded concurrently by someone else
+        db.rollback()
+        return get_media(db, hash)
+
+    return db_media
@@ -1,85 +1,547 @@
-from typing import Union, List
+import time
 
-from sqlalchemy.orm import Session
+from collections import defaultdict
+from typing import Dict, Iterator, Optional, Union, List
+
+from sqlalchemy import func, insert, literal, or_, text
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Query, Session, joinedload, selectinload
 
 from app.sql import models as sql_models
-from app.sql.crud import user as crud_user
 from app import models as py_models
 
+# Keep IN (...) lists well below SQLite's bound parameter limit
+BULK_CHUNK_SIZE = 500
+
+
+def _unique_ids(ids: List[int]) -> bool:
+    return len(set(ids)) == len(ids)
+
+
+def _bump_version(db: Session, owner_id: int, count: int = 1) -> int:
+    """
+    Increments the owner's set version by `count` and returns the new value
+    """
+
+    db.query(sql_models.User).\
+        filter(sql_models.User.id == owner_id).\
+        update({sql_models.User.set_version: sql_models.User.set_version + count}, synchronize_session=False)
+
+    return get_sets_version(db, owner_id)
+
+
+def get_sets_version(db: Session, owner_id: int) -> int:
+    return db.query(sql_models.User.set_version).\
+        filter(sql_models.User.id == owner_id).\
+        scalar() or 0
+
+
+def get_set_version(db: Session, owner_id: int, id: int) -> Union[int, None]:
+    return db.query(sql_models.Set.version).\
+        filter(sql_models.Set.owner_id == owner_id).\
+        filter(sql_models.Set.id == id).\
+        scalar()
+
+
+def _add_reviews(db: Session, cards: Query) -> None:
+    """
+    Puts cards selected by `cards` on their set's due queue, due right away
+    """
+
+    select = cards.with_entities(sql_models.Card.uid, sql_models.Card.set_uid, literal(time.time())).statement
+    db.execute(insert(sql_models.Review).from_select(['card_uid', 'set_uid', 'due'], select))
+
+
+def add_set(db: Session, card_set: py_models.Set, owner_id: int) -> Union[sql_models.Set, None]:
+    if not add_sets(db, [card_set], owner_id)[0]:
+        return None
+
+    return get_set(db, owner_id, card_set.id)
+
+
+def add_sets(db: Session, card_sets: List[py_models.Set], owner_id: int) -> List[bool]:
+    """
+    Creates or updates (if ID exists) sets in a single transaction
+
+    Returns whether each set was accepted, sets with duplicate card IDs are rejected.
+    """
 
-def add_set(db: Session, card_set: py_models.Set, user: py_models.UserBase) -> Union[sql_models.Set, None]:
     # Make sure card IDs are unique
-    id_set = set()
-    for card in card_set.cards:
-        if card.id in id_set:
-            return None
-        id_set.add(card.id)
-
-    # Replace existing set if set ID exists
-    existing_set = get_set(db, user, card_set.id)
-    if existing_set:
-        db.delete(existing_set)
-
-    db_user = crud_user.get_user_by_email(db, user.email)
-
-    db_set = sql_models.Set(
-        id=card_set.id,
-        name=card_set.name,
-        type=card_set.type,
-        max_question=card_set.max_question,
-        question_time=card_set.question_time,
-        owner_id=db_user.id
-    )
-    db.add(db_set)
-
-    for card in card_set.cards:
-        db_card = sql_models.Card(
-            id=card.id,
-            question=card.question,
-            answer=card.answer,
-            voice_address=card.voice_address,
-            picture_address=card.picture_address,
-            set_id=db_set.id
-        )
-        db.add(db_card)
+    accepted = [_unique_ids([card.id for card in card_set.cards]) for card_set in card_sets]
+
+    # Later sets with the same ID replace earlier ones
+    latest = {card_set.id: card_set for card_set, ok in zip(card_sets, accepted) if ok}
+    if not latest:
+        return accepted
+
+    # Every set gets its own version so syncing clients can page between them
+    version = _bump_version(db, owner_id, len(latest)) - len(latest)
+
+    ids = list(latest)
+    existing = {}
+    for i in range(0, len(ids), BULK_CHUNK_SIZE):
+        for db_set in db.query(sql_models.Set).\
+                options(selectinload(sql_models.Set.cards)).\
+                filter(sql_models.Set.owner_id == owner_id).\
+                filter(sql_models.Set.id.in_(ids[i:i + BULK_CHUNK_SIZE])):
+            existing[db_set.id] = db_set
+
+    new_sets = []
+    for card_set in latest.values():
+        version += 1
+
+        # Update existing set in place if set ID exists
+        db_set = existing.get(card_set.id)
+        if db_set:
+            db_set.name = card_set.name
+            db_set.type = card_set.type
+            db_set.max_question = card_set.max_question
+            db_set.question_time = card_set.question_time
+            db_set.version = version
+
+            _sync_cards(db, db_set, card_set.cards)
+        else:
+            db_set = sql_models.Set(
+                id=card_set.id,
+                name=card_set.name,
+                type=card_set.type,
+                max_question=card_set.max_question,
+                question_time=card_set.question_time,
+                version=version,
+                owner_id=owner_id
+            )
+            db.add(db_set)
+            new_sets.append((db_set, card_set))
+
+    # Cards of new sets need the set UIDs assigned on flush
+    db.flush()
+    db.bulk_insert_mappings(sql_models.Card, [
+        dict(card.dict(), set_uid=db_set.uid, version=db_set.version)
+        for db_set, card_set in new_sets
+        for card in card_set.cards
+    ])
+
+    new_uids = [db_set.uid for db_set, _ in new_sets]
+    for i in range(0, len(new_uids), BULK_CHUNK_SIZE):
+        _add_reviews(db, db.query(sql_models.Card).filter(sql_models.Card.set_uid.in_(new_uids[i:i + BULK_CHUNK_SIZE])))
 
     db.commit()
-    db.refresh(db_set)
 
-    return db_set
+    return accepted
 
 
-def get_sets(db: Session, user: py_models.UserBase, skip: int = 0, limit: int = 100) -> List[sql_models.Set]:
-    user_db = crud_user.get_user_by_email(db, user.email)
+def _sync_cards(db: Session, db_set: sql_models.Set, cards: List[py_models.Card]) -> None:
+    """
+    Diffs incoming cards against stored cards by card ID and only writes what changed
+    """
 
-    return db.query(sql_models.Set).\
-        filter(sql_models.Set.owner_id == user_db.id).\
-        offset(skip).\
+    stored = {db_card.id: db_card for db_card in db_set.cards}
+    _write_cards(db, db_set, cards, stored)
+
+    # Whatever was not sent by the client was removed
+    incoming = {card.id for card in cards}
+    _delete_cards(db, db_set, [db_card for id, db_card in stored.items() if id not in incoming])
+
+
+def _write_cards(
+    db: Session,
+    db_set: sql_models.Set,
+    cards: List[py_models.Card],
+    stored: Dict[int, sql_models.Card]
+) -> None:
+    """
+    Bulk inserts cards missing from `stored` and bulk updates the ones that differ
+
+    Written cards get the set's current version
+    """
+
+    inserts = []
+    updates = []
+    for card in cards:
+        values = card.dict()
+
+        db_card = stored.get(card.id)
+        if not db_card:
+            inserts.append(dict(values, set_uid=db_set.uid, version=db_set.version))
+        elif any(getattr(db_card, key) != value for key, value in values.items()):
+            updates.append(dict(values, uid=db_card.uid, version=db_set.version))
+
+    if updates:
+        db.bulk_update_mappings(sql_models.Card, updates)
+    if inserts:
+        db.bulk_insert_mappings(sql_models.Card, inserts)
+
+        ids = [values['id'] for values in inserts]
+        for i in range(0, len(ids), BULK_CHUNK_SIZE):
+            _add_reviews(db, db.query(sql_models.Card).
+                         filter(sql_models.Card.set_uid == db_set.uid).
+                         filter(sql_models.Card.id.in_(ids[i:i + BULK_CHUNK_SIZE])))
+            _clear_card_tombstones(db, db_set, ids[i:i + BULK_CHUNK_SIZE])
+
+
+def _clear_card_tombstones(db: Session, db_set: sql_models.Set, ids: List[int]) -> None:
+    # Cards added again are no longer deleted
+    db.query(sql_models.Tombstone).\
+        filter(sql_models.Tombstone.owner_id == db_set.owner_id).\
+        filter(sql_models.Tombstone.set_id == db_set.id).\
+        filter(sql_models.Tombstone.card_id.in_(ids)).\
+        delete(synchronize_session=False)
+
+
+def _delete_cards(db: Session, db_set: sql_models.Set, db_cards: List[sql_models.Card]) -> None:
+    """
+    Bulk deletes cards and leaves tombstones at the set's current version for syncing clients
+    """
+
+    uids = [db_card.uid for db_card in db_cards]
+    for i in range(0, len(uids), BULK_CHUNK_SIZE):
+        db.query(sql_models.Card).\
+            filter(sql_models.Card.uid.in_(uids[i:i + BULK_CHUNK_SIZE])).\
+            delete(synchronize_session=False)
+
+    if db_cards:
+        db.bulk_insert_mappings(sql_models.Tombstone, [
+            dict(owner_id=db_set.owner_id, set_id=db_set.id, card_id=db_card.id, version=db_set.version)
+            for db_card in db_cards
+        ])
+
+
+def _sets_query(
+    query: Query,
+    owner_id: int,
+    after: Optional[int],
+    type: Optional[str],
+    name_prefix: Optional[str]
+) -> Query:
+    query = query.filter(sql_models.Set.owner_id == owner_id)
+
+    # Range scan on the (owner_id, id) index instead of OFFSET
+    if after is not None:
+        query = query.filter(sql_models.Set.id > after)
+    if type is not None:
+        query = query.filter(sql_models.Set.type == type)
+    if name_prefix:
+        query = query.filter(sql_models.Set.name.startswith(name_prefix, autoescape=True))
+
+    return query.order_by(sql_models.Set.id)
+
+
+def get_sets(
+    db: Session,
+    owner_id: int,
+    after: Optional[int] = None,
+    limit: int = 100,
+    type: Optional[str] = None,
+    name_prefix: Optional[str] = None,
+    load_cards: bool = True
+) -> List[sql_models.Set]:
+    """
+    Returns sets ordered by ID, starting after set ID `after`
+    """
+
+    query = db.query(sql_models.Set)
+    if load_cards:
+        query = query.options(selectinload(sql_models.Set.cards))
+
+    return _sets_query(query, owner_id, after, type, name_prefix).\
         limit(limit).\
         all()
 
 
-def get_set(db: Session, user: py_models.UserBase, id: int) -> sql_models.Set:
-    user_db = crud_user.get_user_by_email(db, user.email)
+def get_set_summaries(
+    db: Session,
+    owner_id: int,
+    after: Optional[int] = None,
+    limit: int = 100,
+    type: Optional[str] = None,
+    name_prefix: Optional[str] = None
+) -> List[Row]:
+    """
+    Returns set ID, name, type and card count ordered by ID, starting after set ID `after`
+    """
 
-    return db.query(sql_models.Set).\
-        filter(sql_models.Set.owner_id == user_db.id).\
+    query = db.query(
+        sql_models.Set.id,
+        sql_models.Set.name,
+        sql_models.Set.type,
+        func.count(sql_models.Card.uid).label('card_count')
+    ).\
+        outerjoin(sql_models.Card, sql_models.Card.set_uid == sql_models.Set.uid).\
+        group_by(sql_models.Set.uid)
+
+    return _sets_query(query, owner_id, after, type, name_prefix).\
+        limit(limit).\
+        all()
+
+
+def get_set(db: Session, owner_id: int, id: int, load_cards: bool = True) -> sql_models.Set:
+    query = db.query(sql_models.Set)
+    if load_cards:
+        query = query.options(joinedload(sql_models.Set.cards))
+
+    return query.\
+        filter(sql_models.Set.owner_id == owner_id).\
         filter(sql_models.Set.id == id).\
         first()
 
 
-def del_set(db: Session, user: py_models.UserBase, id: int) -> bool:
-    set = get_set(db, user, id)
-    if not set:
+def update_set(
+    db: Session,
+    owner_id: int,
+    id: int,
+    update: py_models.SetUpdate
+) -> Union[sql_models.Set, None]:
+    db_set = get_set(db, owner_id, id, load_cards=False)
+    if not db_set:
+        return None
+
+    for key, value in update.dict(exclude_unset=True).items():
+        setattr(db_set, key, value)
+    db_set.version = _bump_version(db, owner_id)
+
+    db.commit()
+
+    return db_set
+
+
+def del_set(db: Session, owner_id: int, id: int) -> bool:
+    # Of concurrent deletes of the same set only one removes the row, so only that one writes a tombstone
+    # Cards and reviews go with it through ON DELETE CASCADE
+    deleted = db.query(sql_models.Set).\
+        filter(sql_models.Set.owner_id == owner_id).\
+        filter(sql_models.Set.id == id).\
+        delete(synchronize_session=False)
+    if deleted != 1:
+        db.rollback()
         return False
 
-    db.delete(set)
+    # Card tombstones are superseded by the set's own
+    db.query(sql_models.Tombstone).\
+        filter(sql_models.Tombstone.owner_id == owner_id).\
+        filter(sql_models.Tombstone.set_id == id).\
+        delete(synchronize_session=False)
+    db.add(sql_models.Tombstone(owner_id=owner_id, set_id=id, version=_bump_version(db, owner_id)))
+
     db.commit()
     return True
 
 
+def iter_sets(db: Session, owner_id: int, batch_size: int = 100) -> Iterator[sql_models.Set]:
+    """
+    Yields all sets with their cards ordered by ID, loading `batch_size` sets at a time
+    """
+
+    return db.query(sql_models.Set).\
+        options(selectinload(sql_models.Set.cards)).\
+        filter(sql_models.Set.owner_id == owner_id).\
+        order_by(sql_models.Set.id).\
+        yield_per(batch_size)
+
+
 def get_card(db: Session, set: sql_models.Set, id: int) -> sql_models.Card:
     return db.query(sql_models.Card).\
-        filter(sql_models.Card.set_id == set.id).\
+        filter(sql_models.Card.set_uid == set.uid).\
         filter(sql_models.Card.id == id).\
         first()
+
+
+def add_card(db: Session, set: sql_models.Set, card: py_models.Card) -> Union[sql_models.Card, None]:
+    if get_card(db, set, card.id):
+        return None
+
+    set.version = _bump_version(db, set.owner_id)
+    db_card = sql_models.Card(**card.dict(), set_uid=set.uid, version=set.version)
+    db.add(db_card)
+    db.flush()
+    db.add(sql_models.Review(card_uid=db_card.uid, set_uid=set.uid, due=time.time()))
+    _clear_card_tombstones(db, set, [card.id])
+    db.commit()
+
+    return db_card
+
+
+def update_card(
+    db: Session,
+    set: sql_models.Set,
+    id: int,
+    update: py_models.CardUpdate
+) -> Union[sql_models.Card, None]:
+    db_card = get_card(db, set, id)
+    if not db_card:
+        return None
+
+    for key, value in update.dict(exclude_unset=True).items():
+        setattr(db_card, key, value)
+    set.version = db_card.version = _bump_version(db, set.owner_id)
+
+    db.commit()
+
+    return db_card
+
+
+def del_card(db: Session, set: sql_models.Set, id: int) -> bool:
+    db_card = get_card(db, set, id)
+    if not db_card:
+        return False
+
+    set.version = _bump_version(db, set.owner_id)
+    _delete_cards(db, set, [db_card])
+    db.commit()
+
+    return True
+
+
+def update_cards(db: Session, set: sql_models.Set, batch: py_models.CardBatch) -> bool:
+    """
+    Applies a batch of card upserts and deletions in a single transaction
+    """
+
+    upsert_ids = [card.id for card in batch.upsert]
+    # Make sure a card is not both upserted and deleted
+    if not _unique_ids(upsert_ids + batch.delete):
+        return False
+
+    # Only load the cards touched by the batch
+    ids = upsert_ids + batch.delete
+    stored = {}
+    for i in range(0, len(ids), BULK_CHUNK_SIZE):
+        for db_card in db.query(sql_models.Card).\
+                filter(sql_models.Card.set_uid == set.uid).\
+                filter(sql_models.Card.id.in_(ids[i:i + BULK_CHUNK_SIZE])):
+            stored[db_card.id] = db_card
+
+    set.version = _bump_version(db, set.owner_id)
+    _write_cards(db, set, batch.upsert, stored)
+    _delete_cards(db, set, [stored[id] for id in batch.delete if id in stored])
+
+    db.commit()
+
+    return True
+
+
+def get_changes(db: Session, owner_id: int, since: int, limit: int = 50) -> py_models.SyncPage:
+    """
+    Returns up to `limit` sets changed or deleted after version `since`, ordered by version
+
+    Each changed set only carries the cards changed or deleted after `since`.
+    """
+
+    sets = db.query(sql_models.Set).\
+        filter(sql_models.Set.owner_id == owner_id).\
+        filter(sql_models.Set.version > since).\
+        order_by(sql_models.Set.version).\
+        limit(limit + 1).\
+        all()
+    deleted_sets = db.query(sql_models.Tombstone).\
+        filter(sql_models.Tombstone.owner_id == owner_id).\
+        filter(sql_models.Tombstone.card_id.is_(None)).\
+        filter(sql_models.Tombstone.version > since).\
+        order_by(sql_models.Tombstone.version).\
+        limit(limit + 1).\
+        all()
+
+    entries = sorted(sets + deleted_sets, key=lambda entry: entry.version)
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    changed_sets = [entry for entry in entries if isinstance(entry, sql_models.Set)]
+    cards = defaultdict(list)
+    deleted_cards = defaultdict(list)
+    for i in range(0, len(changed_sets), BULK_CHUNK_SIZE):
+        chunk = changed_sets[i:i + BULK_CHUNK_SIZE]
+
+        for db_card in db.query(sql_models.Card).\
+                filter(sql_models.Card.set_uid.in_([db_set.uid for db_set in chunk])).\
+                filter(sql_models.Card.version > since):
+            cards[db_card.set_uid].append(db_card)
+
+        for tombstone in db.query(sql_models.Tombstone).\
+                filter(sql_models.Tombstone.owner_id == owner_id).\
+                filter(sql_models.Tombstone.set_id.in_([db_set.id for db_set in chunk])).\
+                filter(sql_models.Tombstone.card_id.isnot(None)).\
+                filter(sql_models.Tombstone.version > since):
+            deleted_cards[tombstone.set_id].append(tombstone.card_id)
+
+    changes = []
+    for entry in entries:
+        if isinstance(entry, sql_models.Tombstone):
+            changes.append(py_models.SetChange(id=entry.set_id, version=entry.version, deleted=True))
+        else:
+            changes.append(py_models.SetChange(
+                id=entry.id,
+                version=entry.version,
+                name=entry.name,
+                type=entry.type,
+                max_question=entry.max_question,
+                question_time=entry.question_time,
+                cards=[py_models.Card.from_orm(db_card) for db_card in cards[entry.uid]],
+                deleted_cards=deleted_cards[entry.id]
+            ))
+
+    return py_models.SyncPage(
+        changes=changes,
+        version=entries[-1].version if entries else since,
+        has_more=has_more
+    )
+
+
+def _match_expression(owner_id: int, query: str) -> str:
+    """
+    Builds FTS5 query matching all words of `query` in the owner's cards, last word as prefix
+    """
+
+    words = ['"' + word.replace('"', '""') + '"' for word in query.split()]
+    words[-1] += '*'
+
+    return f'owner : "{owner_id}" AND {{question answer}} : ({" ".join(words)})'
+
+
+def _search_index(db: Session, owner_id: int, query: str, offset: int, limit: int) -> List[Row]:
+    # Question matches weigh more than answer matches
+    uids = [row[0] for row in db.execute(
+        text('SELECT rowid FROM cards_fts WHERE cards_fts MATCH :match '
+             'ORDER BY bm25(cards_fts, 0.0, 2.0, 1.0) LIMIT :limit OFFSET :offset'),
+        {'match': _match_expression(owner_id, query), 'limit': limit, 'offset': offset}
+    )]
+
+    rows = db.query(sql_models.Card, sql_models.Set.id).\
+        join(sql_models.Set, sql_models.Set.uid == sql_models.Card.set_uid).\
+        filter(sql_models.Card.uid.in_(uids)).\
+        all()
+    order = {uid: i for i, uid in enumerate(uids)}
+    rows.sort(key=lambda row: order[row[0].uid])
+
+    return rows
+
+
+def _search_substrings(db: Session, owner_id: int, query: str, offset: int, limit: int) -> List[Row]:
+    matches = [
+        or_(func.lower(sql_models.Card.question).contains(word.lower(), autoescape=True),
+            func.lower(sql_models.Card.answer).contains(word.lower(), autoescape=True))
+        for word in query.split()
+    ]
+
+    return db.query(sql_models.Card, sql_models.Set.id).\
+        join(sql_models.Set, sql_models.Set.uid == sql_models.Card.set_uid).\
+        filter(sql_models.Set.owner_id == owner_id).\
+        filter(*matches).\
+        order_by(sql_models.Card.uid).\
+        offset(offset).\
+        limit(limit).\
+        all()
+
+
+def search_cards(db: Session, owner_id: int, query: str, offset: int, limit: int) -> List[py_models.CardMatch]:
+    """
+    Returns cards of the owner whose question or answer contain all words of `query`, best matches first
+
+    Uses the FTS5 index on SQLite, other databases fall back to unranked substring matching.
+    """
+
+    if not query.split():
+        return []
+
+    search = _search_index if db.get_bind().dialect.name == 'sqlite' else _search_substrings
+    rows = search(db, owner_id, query, offset, limit)
+
+    return [py_models.CardMatch(**py_models.Card.from_orm(db_card).dict(), set_id=set_id) for db_card, set_id in rows]
@@ -0,0 +1,74 @@
+from typing import List, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.sql import models as sql_models
+from app import models as py_models
+from app.scheduler import DAY, ReviewState, schedule
+from app.sql.crud.set import BULK_CHUNK_SIZE
+
+
+def get_due_cards(db: Session, set: sql_models.Set, now: float, limit: int) -> Tuple[List[sql_models.Card], bool]:
+    """
+    Returns up to `limit` cards of a set that are due at `now`, most overdue first, and whether more are due
+
+    Walks the (set_uid, due) index, so cost does not grow with the number of cards in the set.
+    """
+
+    cards = db.query(sql_models.Card).\
+        join(sql_models.Review, sql_models.Review.card_uid == sql_models.Card.uid).\
+        filter(sql_models.Review.set_uid == set.uid).\
+        filter(sql_models.Review.due <= now).\
+        order_by(sql_models.Review.due).\
+        limit(limit + 1).\
+        all()
+
+    return cards[:limit], len(cards) > limit
+
+
+def review_cards(
+    db: Session,
+    set: sql_models.Set,
+    reviews: List[py_models.ReviewIn],
+    now: float
+) -> List[py_models.ReviewOut]:
+    """
+    Reschedules reviewed cards of a set, unknown card IDs are skipped
+
+    Cards reviewed more than once in a batch are rescheduled for each review in order.
+    """
+
+    ids = list({review.card_id for review in reviews})
+    stored = {}
+    for i in range(0, len(ids), BULK_CHUNK_SIZE):
+        for card_id, db_review in db.query(sql_models.Card.id, sql_models.Review).\
+                join(sql_models.Review, sql_models.Review.card_uid == sql_models.Card.uid).\
+                filter(sql_models.Card.set_uid == set.uid).\
+                filter(sql_models.Card.id.in_(ids[i:i + BULK_CHUNK_SIZE])):
+            stored[card_id] = db_review
+
+    results = {}
+    for review in reviews:
+        db_review = stored.get(review.card_id)
+        if not db_review:
+            continue
+
+        state = schedule(
+            ReviewState(db_review.interval, db_review.ease, db_review.repetitions, db_review.lapses), review.grade)
+        db_review.interval = state.interval
+        db_review.ease = state.ease
+        db_review.repetitions = state.repetitions
+        db_review.lapses = state.lapses
+        db_review.due = now + state.interval * DAY
+
+        results[review.card_id] = py_models.ReviewOut(
+            card_id=review.card_id,
+            due=db_review.due,
+            interval=db_review.interval,
+            ease=db_review.ease,
+            repetitions=db_review.repetitions
+        )
+
+    db.commit()
+
+    return list(results.values())
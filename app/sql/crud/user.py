@@ -1,18 +1,37 @@
-from typing import List, Union
+import hashlib
+import time
+
+from typing import List, Optional, Union
 from sqlalchemy.orm import Session
 
 from app.sql import models as sql_models
 from app import models as py_models
+from app.cache import TTLCache
+from app.settings import Settings
 
-from passlib.context import CryptContext
-
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
+# Maps user ID to py_models.UserDb, must be invalidated whenever a user row changes
+user_cache = TTLCache(maxsize=Settings.USER_CACHE_SIZE, ttl=Settings.USER_CACHE_TTL)
 
 
 def get_user(db: Session, user_id: int) -> sql_models.User:
     return db.query(sql_models.User).filter(sql_models.User.id == user_id).first()
 
 
+def get_cached_user(db: Session, user_id: int) -> Union[py_models.UserDb, None]:
+    user = user_cache.get(user_id)
+    if user:
+        return user
+
+    db_user = get_user(db, user_id)
+    if not db_user:
+        return None
+
+    user = py_models.UserDb.from_orm(db_user)
+    user_cache.set(user_id, user)
+
+    return user
+
+
 def get_user_by_email(db: Session, email: str) -> sql_models.User:
     return db.query(sql_models.User).filter(sql_models.User.email == email).first()
 
@@ -21,10 +40,10 @@ def get_users(db: Session, skip: int = 0, limit: int = 100) -> List[sql_models.U
     return db.query(sql_models.User).offset(skip).limit(limit).all()
 
 
-def add_user(db: Session, user: py_models.UserIn) -> sql_models.User:
+def add_user(db: Session, user: py_models.UserIn, hashed_password: str) -> sql_models.User:
     db_user = sql_models.User(
         email=user.email,
-        hashed_password=pwd_context.hash(user.password)
+        hashed_password=hashed_password
     )
 
     db.add(db_user)
@@ -34,20 +53,30 @@ def add_user(db: Session, user: py_models.UserIn) -> sql_models.User:
     return db_user
 
 
-def update_user(db: Session, user_id: int, update: py_models.UserUpdate) -> Union[sql_models.User, None]:
+def update_user(db: Session, user_id: int, hashed_password: Optional[str] = None) -> Union[sql_models.User, None]:
     db_user = get_user(db, user_id)
     if not db_user:
         return None
 
-    if update.new_password:
-        db_user.hashed_password = pwd_context.hash(update.new_password)
+    if hashed_password:
+        db_user.hashed_password = hashed_password
 
     db.commit()
+    user_cache.pop(user_id)
     db.refresh(db_user)
 
     return db_user
 
 
+def update_user_hash(db: Session, user_id: int, hashed_password: str) -> None:
+    db.query(sql_models.User).\
+        filter(sql_models.User.id == user_id).\
+        update({sql_models.User.hashed_password: hashed_password})
+
+    db.commit()
+    user_cache.pop(user_id)
+
+
 def del_user(db: Session, user_id: int) -> bool:
     db_user = get_user(db, user_id)
 
@@ -56,6 +85,7 @@ def del_user(db: Session, user_id: int) -> bool:
 
     db.delete(db_user)
     db.commit()
+    user_cache.pop(user_id)
 
     return True
 
@@ -65,10 +95,15 @@ def activate_user(db: Session, user_id: int):
     db_user.active = True
 
     db.commit()
+    user_cache.pop(user_id)
 
 
-def add_user_token(db: Session, token: str, user_id: int):
-    db_token = sql_models.Token(token=token, owner_id=user_id)
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def add_user_token(db: Session, token: str, user_id: int, expires_at: int):
+    db_token = sql_models.Token(token_hash=hash_token(token), expires_at=expires_at, owner_id=user_id)
 
     db.add(db_token)
     db.commit()
@@ -78,26 +113,79 @@ def add_user_token(db: Session, token: str, user_id: int):
 
 
 def del_user_token(db: Session, token: str, user_id: int) -> bool:
-    db_token = db.query(sql_models.Token).\
+    count = db.query(sql_models.Token).\
         filter(sql_models.Token.owner_id == user_id).\
-        filter(sql_models.Token.token == token).\
-        first()
+        filter(sql_models.Token.token_hash == hash_token(token)).\
+        delete(synchronize_session=False)
+
+    db.commit()
+
+    return count > 0
+
+
+def reset_password(db: Session, token: str, user_id: int, hashed_password: str) -> bool:
+    """
+    Uses up `token` and sets the new password hash in one transaction, also activates the user
+
+    Returns False without changing anything if the token was already used.
+    """
 
-    if not db_token:
+    used = db.query(sql_models.Token).\
+        filter(sql_models.Token.owner_id == user_id).\
+        filter(sql_models.Token.token_hash == hash_token(token)).\
+        filter(sql_models.Token.expires_at > time.time()).\
+        delete(synchronize_session=False)
+    if not used:
+        db.rollback()
         return False
 
-    db.delete(db_token)
+    db.query(sql_models.User).\
+        filter(sql_models.User.id == user_id).\
+        update({sql_models.User.hashed_password: hashed_password, sql_models.User.active: True})
+
     db.commit()
+    user_cache.pop(user_id)
 
     return True
 
 
 def check_user_token(db: Session, token: str, user_id: int) -> bool:
-    db_token = db.query(sql_models.Token).\
+    db_token = db.query(sql_models.Token.id).\
         filter(sql_models.Token.owner_id == user_id).\
-        filter(sql_models.Token.token == token).\
+        filter(sql_models.Token.token_hash == hash_token(token)).\
+        filter(sql_models.Token.expires_at > time.time()).\
         first()
 
     if db_token:
         return True
     return False
+
+
+def get_live_token(db: Session, user_id: int, expires_after: float) -> Union[sql_models.Token, None]:
+    """
+    Returns the user's token lasting longest if it is still valid at `expires_after`
+    """
+
+    return db.query(sql_models.Token).\
+        filter(sql_models.Token.owner_id == user_id).\
+        filter(sql_models.Token.expires_at > expires_after).\
+        order_by(sql_models.Token.expires_at.desc()).\
+        first()
+
+
+def purge_expired_tokens(db: Session, limit: int) -> int:
+    """
+    Deletes up to `limit` expired tokens, returns the number deleted
+    """
+
+    expired = db.query(sql_models.Token.id).\
+        filter(sql_models.Token.expires_at <= time.time()).\
+        limit(limit).\
+        scalar_subquery()
+
+    count = db.query(sql_models.Token).\
+        filter(sql_models.Token.id.in_(expired)).\
+        delete(synchronize_session=False)
+    db.commit()
+
+    return count
@@ -1,15 +1,60 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import Session as Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from app.settings import Settings
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in Settings.SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+
+def _engine_options(url: str) -> dict:
+    options = dict(
+        pool_size=Settings.DB_POOL_SIZE,
+        max_overflow=Settings.DB_MAX_OVERFLOW,
+        pool_timeout=Settings.DB_POOL_TIMEOUT,
+        pool_recycle=Settings.DB_POOL_RECYCLE,
+        echo=Settings.DB_ECHO
+    )
+    if make_url(url).get_backend_name() == 'sqlite':
+        options['connect_args'] = {"check_same_thread": False}
+
+    return options
+
+
+def _is_sqlite(engine: Engine) -> bool:
+    return engine.dialect.name == 'sqlite'
 
-DATABASE_URL = 'sqlite:///./app.sqlite3'
 
 engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False}
+    Settings.DATABASE_URL,
+    poolclass=QueuePool,
+    **_engine_options(Settings.DATABASE_URL)
 )
+if _is_sqlite(engine):
+    event.listen(engine, 'connect', _set_sqlite_pragmas)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Only used by routers when Settings.DB_ASYNC is enabled
+async_engine = None
+AsyncSessionLocal = None
+if Settings.DB_ASYNC:
+    async_engine = create_async_engine(
+        Settings.ASYNC_DATABASE_URL,
+        poolclass=AsyncAdaptedQueuePool,
+        **_engine_options(Settings.ASYNC_DATABASE_URL)
+    )
+    if _is_sqlite(async_engine.sync_engine):
+        event.listen(async_engine.sync_engine, 'connect', _set_sqlite_pragmas)
+    AsyncSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=async_engine, class_=AsyncSession)
+
 Base = declarative_base()
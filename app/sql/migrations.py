@@ -0,0 +1,299 @@
+"""
+Schema revisions, applied with
+
+    python -m app.sql.migrations upgrade
+
+The applied revision is kept in the `schema_revision` table. Databases created before revisions were
+tracked are upgraded from the first one, so revisions check what they change still needs changing.
+New tables and columns need a revision, the app never changes the schema on its own.
+"""
+
+import argparse
+import hashlib
+import logging
+
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from jose import jwt
+from jose.exceptions import JWTError
+from sqlalchemy import Column, MetaData, String, Table, inspect
+from sqlalchemy.engine import Connection, Engine
+
+from app.sql import models as sql_models
+from app.sql.database import Base
+from app.sql.search import create_card_search
+
+logger = logging.getLogger(__name__)
+
+
+def _legacy_card_owners(set_uids: List[int], cards: List[Tuple]) -> Tuple[List[Tuple[int, Tuple]], int]:
+    """
+    Splits the old cards of one set ID into the batches they were written in and pairs them with its sets
+
+    Old sets wrote their cards right after themselves and card IDs were unique within a set, so a repeated
+    card ID starts the next batch. Replacing a set used to delete every card with its ID, so the newest
+    batches belong to the newest sets. Returns (set uid, card) pairs and the number of cards left over.
+    """
+
+    batches: List[List[Tuple]] = []
+    seen: Set[int] = set()
+    for card in cards:
+        if not batches or card[1] in seen:
+            batches.append([])
+            seen = set()
+        batches[-1].append(card)
+        seen.add(card[1])
+
+    pairs = [(set_uid, card)
+             for set_uid, batch in zip(reversed(set_uids), reversed(batches))
+             for card in batch]
+
+    return pairs, len(cards) - len(pairs)
+
+
+def _migrate_card_set_uid(conn: Connection) -> None:
+    """
+    Rebuilds sets/cards so cards reference sets by surrogate `uid` instead of per-user set `id`
+
+    Old cards did not record their owner, those of set IDs shared across users are attached by the
+    order they were written in, see `_legacy_card_owners`. Cards that can't be attached are logged.
+    """
+
+    for index in ('ix_sets_uid', 'ix_sets_id', 'ix_cards_uid', 'ix_cards_id'):
+        conn.exec_driver_sql(f'DROP INDEX IF EXISTS {index}')
+
+    conn.exec_driver_sql('ALTER TABLE cards RENAME TO _cards_old')
+    conn.exec_driver_sql('ALTER TABLE sets RENAME TO _sets_old')
+
+    sql_models.Set.__table__.create(conn)
+    sql_models.Card.__table__.create(conn)
+
+    conn.exec_driver_sql(
+        'INSERT INTO sets (uid, id, type, name, max_question, question_time, owner_id) '
+        'SELECT uid, id, type, name, max_question, question_time, owner_id FROM _sets_old '
+        'WHERE id IS NOT NULL AND owner_id IS NOT NULL'
+    )
+
+    set_uids: Dict[int, List[int]] = {}
+    for uid, id in conn.exec_driver_sql('SELECT uid, id FROM sets ORDER BY uid'):
+        set_uids.setdefault(id, []).append(uid)
+
+    cards: Dict[int, List[Tuple]] = {}
+    for card in conn.exec_driver_sql(
+        'SELECT uid, id, question, answer, voice_address, picture_address, set_id FROM _cards_old '
+        'WHERE id IS NOT NULL ORDER BY uid'
+    ):
+        cards.setdefault(card[6], []).append(tuple(card))
+
+    rows = []
+    for set_id, set_cards in cards.items():
+        pairs, dropped = _legacy_card_owners(set_uids.get(set_id, []), set_cards)
+        if len(set_uids.get(set_id, [])) > 1:
+            logger.warning('Set ID %s is shared by %d users, attached its cards in the order they were written',
+                           set_id, len(set_uids[set_id]))
+        if dropped:
+            logger.warning('Dropped %d cards of set ID %s, no set was left to attach them to', dropped, set_id)
+
+        rows.extend(dict(uid=card[0], id=card[1], question=card[2], answer=card[3], voice_address=card[4],
+                         picture_address=card[5], set_uid=set_uid) for set_uid, card in pairs)
+
+    if rows:
+        conn.execute(sql_models.Card.__table__.insert(), rows)
+
+    conn.exec_driver_sql('DROP TABLE _cards_old')
+    conn.exec_driver_sql('DROP TABLE _sets_old')
+
+
+def _migrate_token_hash(conn: Connection) -> None:
+    """
+    Rebuilds tokens so they are stored as hashes with their expiry, unreadable tokens are dropped
+    """
+
+    rows = conn.exec_driver_sql('SELECT token, owner_id FROM tokens WHERE owner_id IS NOT NULL').fetchall()
+
+    conn.exec_driver_sql('DROP INDEX IF EXISTS ix_tokens_id')
+    conn.exec_driver_sql('DROP TABLE tokens')
+    sql_models.Token.__table__.create(conn)
+
+    tokens = []
+    for token, owner_id in rows:
+        try:
+            expires_at = int(jwt.get_unverified_claims(token)['exp'])
+        except (JWTError, KeyError, TypeError, ValueError):
+            continue
+        tokens.append(dict(token_hash=hashlib.sha256(token.encode()).hexdigest(), expires_at=expires_at, owner_id=owner_id))
+
+    if tokens:
+        conn.execute(sql_models.Token.__table__.insert(), tokens)
+
+
+def _add_column(conn: Connection, table: str, column: str, ddl: str) -> None:
+    inspector = inspect(conn)
+    if table not in inspector.get_table_names():
+        return
+
+    if column not in {c['name'] for c in inspector.get_columns(table)}:
+        conn.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}')
+
+
+def _add_reviews(conn: Connection) -> None:
+    """
+    Creates the review table and schedules every existing card for review
+    """
+
+    sql_models.Review.__table__.create(conn)
+    conn.exec_driver_sql(
+        'INSERT INTO reviews (card_uid, set_uid, due) '
+        'SELECT uid, set_uid, 0 FROM cards'
+    )
+
+
+def _add_card_search(conn: Connection) -> None:
+    """
+    Creates card search index and indexes existing cards
+    """
+
+    create_card_search(sql_models.Card.__table__, conn)
+    conn.exec_driver_sql(
+        'INSERT INTO cards_fts (rowid, owner, question, answer) '
+        'SELECT c.uid, s.owner_id, c.question, c.answer FROM cards c JOIN sets s ON s.uid = c.set_uid'
+    )
+
+
+def _revision_set_uid(conn: Connection) -> None:
+    # Versions where cards referenced sets.id only ever ran on SQLite
+    if conn.dialect.name == 'sqlite' and 'cards' in inspect(conn).get_table_names():
+        if 'set_uid' not in {column['name'] for column in inspect(conn).get_columns('cards')}:
+            _migrate_card_set_uid(conn)
+
+
+def _revision_set_versions(conn: Connection) -> None:
+    _add_column(conn, 'users', 'set_version', "INTEGER DEFAULT '0' NOT NULL")
+    _add_column(conn, 'sets', 'version', "INTEGER DEFAULT '0' NOT NULL")
+    _add_column(conn, 'cards', 'version', "INTEGER DEFAULT '0' NOT NULL")
+    if 'sets' in inspect(conn).get_table_names():
+        conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_sets_owner_id_version ON sets (owner_id, version)')
+
+
+def _revision_reviews(conn: Connection) -> None:
+    tables = inspect(conn).get_table_names()
+    if 'cards' in tables and 'reviews' not in tables:
+        _add_reviews(conn)
+
+
+def _revision_card_search(conn: Connection) -> None:
+    tables = inspect(conn).get_table_names()
+    if conn.dialect.name == 'sqlite' and 'cards' in tables and 'cards_fts' not in tables:
+        _add_card_search(conn)
+
+
+def _revision_token_hash(conn: Connection) -> None:
+    if 'tokens' in inspect(conn).get_table_names():
+        if 'token_hash' not in {column['name'] for column in inspect(conn).get_columns('tokens')}:
+            _migrate_token_hash(conn)
+
+
+class Revision(NamedTuple):
+    id: str
+    message: str
+    upgrade: Callable[[Connection], None]
+
+
+# Applied in order, append new revisions at the end
+REVISIONS: List[Revision] = [
+    Revision('0001', 'Reference sets from cards by uid', _revision_set_uid),
+    Revision('0002', 'Add set versions', _revision_set_versions),
+    Revision('0003', 'Add review schedule', _revision_reviews),
+    Revision('0004', 'Add card search index', _revision_card_search),
+    Revision('0005', 'Store token hashes', _revision_token_hash),
+]
+
+HEAD = REVISIONS[-1].id
+
+revision_table = Table(
+    'schema_revision', MetaData(),
+    Column('revision', String(32), primary_key=True),
+)
+
+
+def current_revision(conn: Connection) -> Optional[str]:
+    if not inspect(conn).has_table(revision_table.name):
+        return None
+
+    return conn.execute(revision_table.select()).scalar()
+
+
+def _stamp(conn: Connection, revision: str) -> None:
+    revision_table.create(conn, checkfirst=True)
+    conn.execute(revision_table.delete())
+    conn.execute(revision_table.insert().values(revision=revision))
+
+
+def upgrade(engine: Engine) -> List[str]:
+    """
+    Upgrades the schema to the latest revision in one transaction
+
+    Returns IDs of applied revisions. Empty databases get the current schema directly, which counts as all.
+    """
+
+    with engine.begin() as conn:
+        current = current_revision(conn)
+        ids = [revision.id for revision in REVISIONS]
+        if current is not None and current not in ids:
+            raise RuntimeError(f'Unknown schema revision {current}, database is newer than this version')
+
+        if current is None and not inspect(conn).get_table_names():
+            Base.metadata.create_all(bind=conn)
+            _stamp(conn, HEAD)
+            return ids
+
+        pending = REVISIONS[ids.index(current) + 1:] if current is not None else REVISIONS
+        for revision in pending:
+            revision.upgrade(conn)
+
+        if current is None:
+            # Untracked databases may lack tables that used to be created on startup
+            Base.metadata.create_all(bind=conn)
+
+        if pending:
+            _stamp(conn, HEAD)
+
+        return [revision.id for revision in pending]
+
+
+def check_schema(engine: Engine) -> None:
+    """
+    Raises RuntimeError unless the schema is at the latest revision
+    """
+
+    with engine.connect() as conn:
+        current = current_revision(conn)
+
+    if current != HEAD:
+        raise RuntimeError(f'Database schema is at revision {current or "none"}, expected {HEAD}. '
+                           'Run `python -m app.sql.migrations upgrade`')
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from app.sql.database import engine
+
+    parser = argparse.ArgumentParser(prog='python -m app.sql.migrations', description='Manage the database schema')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('upgrade', help='Upgrade to the latest revision')
+    commands.add_parser('current', help='Show the applied revision')
+    commands.add_parser('history', help='List revisions')
+    args = parser.parse_args(argv)
+
+    if args.command == 'upgrade':
+        applied = upgrade(engine)
+        print(f'Applied {", ".join(applied)}' if applied else 'Schema is up to date', f'(revision {HEAD})')
+    elif args.command == 'current':
+        with engine.connect() as conn:
+            print(current_revision(conn) or 'none')
+    else:
+        for revision in REVISIONS:
+            print(f'{revision.id} {revision.message}{" (head)" if revision.id == HEAD else ""}')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,3 +3,10 @@ from .user import Token as Token
 
 from .set import Set as Set
 from .set import Card as Card
+from .set import Tombstone as Tombstone
+
+from .mail import Mail as Mail
+
+from .media import Media as Media
+
+from .study import Review as Review
@@ -0,0 +1,17 @@
+from sqlalchemy import Column, Float, Integer, String
+
+from app.sql.database import Base
+
+
+class Mail(Base):
+    __tablename__ = 'mails'
+
+    id = Column(Integer, primary_key=True)
+    to_addr = Column(String, nullable=False)
+    to_name = Column(String)
+    subject = Column(String)
+    message = Column(String)
+    attempts = Column(Integer, default=0, nullable=False)
+    # NULL once delivery has been given up on
+    next_attempt_at = Column(Float, index=True)
+    last_error = Column(String)
@@ -0,0 +1,13 @@
+from sqlalchemy import Column, Float, Integer, String
+
+from app.sql.database import Base
+
+
+class Media(Base):
+    __tablename__ = 'media'
+
+    # SHA-256 of the content, files are shared by every card referencing the same bytes
+    hash = Column(String, primary_key=True)
+    size = Column(Integer, nullable=False)
+    content_type = Column(String, nullable=False)
+    created_at = Column(Float, nullable=False)
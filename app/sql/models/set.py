@@ -1,19 +1,27 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Index, UniqueConstraint, event
 from sqlalchemy.orm import relationship
 
 from app.sql.database import Base
+from app.sql.search import create_card_search
 
 
 class Set(Base):
     __tablename__ = 'sets'
+    __table_args__ = (
+        # Set IDs are only unique per user, also serves (owner_id) lookups
+        UniqueConstraint('owner_id', 'id'),
+        Index('ix_sets_owner_id_version', 'owner_id', 'version'),
+    )
 
-    uid = Column(Integer, primary_key=True, index=True)
-    id = Column(Integer, index=True)
+    uid = Column(Integer, primary_key=True)
+    id = Column(Integer, nullable=False)
     type = Column(String)
     name = Column(String)
     max_question = Column(Integer)
     question_time = Column(Float)
-    owner_id = Column(Integer, ForeignKey('users.id'))
+    # Owner's set_version when the set or its cards last changed
+    version = Column(Integer, default=0, server_default='0', nullable=False)
+    owner_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
 
     owner = relationship('User', back_populates='sets')
     cards = relationship('Card', back_populates='set', cascade='all, delete')
@@ -21,13 +29,39 @@ class Set(Base):
 
 class Card(Base):
     __tablename__ = 'cards'
+    __table_args__ = (
+        # Card IDs are only unique per set, also serves (set_uid) lookups
+        UniqueConstraint('set_uid', 'id'),
+    )
 
-    uid = Column(Integer, primary_key=True, index=True)
-    id = Column(Integer, index=True)
+    uid = Column(Integer, primary_key=True)
+    id = Column(Integer, nullable=False)
     question = Column(String)
     answer = Column(String)
     voice_address = Column(String)
     picture_address = Column(String)
-    set_id = Column(Integer, ForeignKey('sets.id'))
+    # Owner's set_version when the card last changed
+    version = Column(Integer, default=0, server_default='0', nullable=False)
+    set_uid = Column(Integer, ForeignKey('sets.uid', ondelete='CASCADE'), nullable=False)
 
     set = relationship('Set', back_populates='cards')
+
+
+event.listen(Card.__table__, 'after_create', create_card_search)
+
+
+class Tombstone(Base):
+    """
+    Marks a deleted set or card so syncing clients can learn about the deletion
+    """
+    __tablename__ = 'tombstones'
+    __table_args__ = (
+        Index('ix_tombstones_owner_id_version', 'owner_id', 'version'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    set_id = Column(Integer, nullable=False)
+    # NULL if the whole set was deleted
+    card_id = Column(Integer)
+    version = Column(Integer, nullable=False)
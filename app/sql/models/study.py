@@ -0,0 +1,24 @@
+from sqlalchemy import Column, Float, ForeignKey, Index, Integer
+
+from app.sql.database import Base
+
+
+class Review(Base):
+    """
+    Spaced repetition state of a card, every card has one from the moment it is created
+    """
+    __tablename__ = 'reviews'
+    __table_args__ = (
+        # Due queue of a set, next cards to study are a range scan from its start
+        Index('ix_reviews_set_uid_due', 'set_uid', 'due'),
+    )
+
+    card_uid = Column(Integer, ForeignKey('cards.uid', ondelete='CASCADE'), primary_key=True)
+    set_uid = Column(Integer, ForeignKey('sets.uid', ondelete='CASCADE'), nullable=False)
+    # Unix time the card is next due at
+    due = Column(Float, nullable=False)
+    # Days until the next review after a successful one
+    interval = Column(Float, default=0, server_default='0', nullable=False)
+    ease = Column(Float, default=2.5, server_default='2.5', nullable=False)
+    repetitions = Column(Integer, default=0, server_default='0', nullable=False)
+    lapses = Column(Integer, default=0, server_default='0', nullable=False)
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, String
 from sqlalchemy.orm import relationship
 
 from app.sql.database import Base
@@ -12,6 +12,8 @@ class User(Base):
     hashed_password = Column(String)
     active = Column(Boolean, default=False)
     premium = Column(Boolean, default=False)
+    # Bumped on every change to the user's sets
+    set_version = Column(Integer, default=0, server_default='0', nullable=False)
 
     tokens = relationship('Token', back_populates='owner',
                           cascade='all, delete')
@@ -20,9 +22,15 @@ class User(Base):
 
 class Token(Base):
     __tablename__ = 'tokens'
+    __table_args__ = (
+        Index('ix_tokens_owner_id_token_hash', 'owner_id', 'token_hash'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    token = Column(String)
-    owner_id = Column(Integer, ForeignKey('users.id'))
+    # SHA-256 of the emailed token, the token itself is never stored
+    token_hash = Column(String(64), nullable=False)
+    # Unix time, same as the token's exp claim
+    expires_at = Column(Integer, nullable=False, index=True)
+    owner_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
 
     owner = relationship('User', back_populates='tokens')
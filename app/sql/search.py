@@ -0,0 +1,34 @@
+from sqlalchemy.engine import Connection
+
+# Card text index on SQLite, rowid is the card UID and `owner` the owner's user ID so
+# searches are scoped inside the index instead of filtering matches of every user
+# Triggers keep it in sync with every write, including cards deleted along with their set or user
+CARD_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS cards_fts USING fts5("
+    "owner, question, answer, tokenize='unicode61 remove_diacritics 2')",
+
+    "CREATE TRIGGER IF NOT EXISTS cards_fts_insert AFTER INSERT ON cards BEGIN "
+    "INSERT INTO cards_fts (rowid, owner, question, answer) "
+    "SELECT NEW.uid, owner_id, NEW.question, NEW.answer FROM sets WHERE uid = NEW.set_uid; "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS cards_fts_update AFTER UPDATE OF question, answer ON cards BEGIN "
+    "UPDATE cards_fts SET question = NEW.question, answer = NEW.answer WHERE rowid = NEW.uid; "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS cards_fts_delete AFTER DELETE ON cards BEGIN "
+    "DELETE FROM cards_fts WHERE rowid = OLD.uid; "
+    "END",
+]
+
+
+def create_card_search(target, conn: Connection, **kwargs) -> None:
+    """
+    Creates card search index alongside the cards table, other databases search without an index
+    """
+
+    if conn.dialect.name != 'sqlite':
+        return
+
+    for ddl in CARD_SEARCH_DDL:
+        conn.exec_driver_sql(ddl)
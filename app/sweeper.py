@@ -0,0 +1,60 @@
+import logging
+import threading
+
+from app.settings import Settings
+from app.sql.database import SessionLocal
+from app.sql.crud import user as crud_user
+
+logger = logging.getLogger(__name__)
+
+
+class TokenSweeper:
+    """
+    Background thread purging expired verification and password reset tokens in batches
+    """
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._work, name='token-sweeper', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+        if self._thread:
+            self._thread.join()
+        self._thread = None
+
+    def _work(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('Failed to purge expired tokens')
+
+            self._stop.wait(Settings.TOKEN_SWEEP_INTERVAL)
+
+    def sweep(self) -> int:
+        """
+        Purges all expired tokens, one short transaction per batch so writers are not held up
+        """
+
+        total = 0
+        with SessionLocal() as db:
+            while not self._stop.is_set():
+                count = crud_user.purge_expired_tokens(db, Settings.TOKEN_SWEEP_BATCH_SIZE)
+                total += count
+                if count < Settings.TOKEN_SWEEP_BATCH_SIZE:
+                    break
+
+        return total
+
+
+sweeper = TokenSweeper()
@@ -4,3 +4,5 @@ from enum import Enum
 class Tags(str, Enum):
     users = 'users'
     sets = 'sets'
+    media = 'media'
+    study = 'study'
@@ -0,0 +1,243 @@
+"""
+Benchmarks the API in-process against a synthetic SQLite database
+
+    pip install -r benchmarks/requirements.txt
+    python -m benchmarks.run --users 50 --sets 20 --cards 100 --output before.json
+    python -m benchmarks.run --users 50 --sets 20 --cards 100 --compare before.json
+
+Contention of readers and writers under another SQLite profile, e.g. the rollback journal:
+
+    python -m benchmarks.run --mix contention --sqlite-pragmas journal_mode=DELETE,synchronous=FULL
+
+Each mix issues the same pre-drawn requests for a given --seed through an async client calling the
+ASGI app directly, so results only reflect the app and database, not the network. Mixes run in the
+order given on the same database, later mixes see changes made by earlier ones.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Dict, List, Optional
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark the API against a synthetic database')
+    parser.add_argument('--users', type=int, default=20, help='Users to seed')
+    parser.add_argument('--sets', type=int, default=20, help='Sets per user')
+    parser.add_argument('--cards', type=int, default=50, help='Cards per set')
+    parser.add_argument('--big-set-cards', type=int, default=1000, help='Cards per set written by upsert_big_set')
+    parser.add_argument('--requests', type=int, default=500, help='Requests per mix')
+    parser.add_argument('--concurrency', type=int, default=16, help='Requests in flight')
+    parser.add_argument('--mix', action='append', help='Mix to run, may be repeated, all by default')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for data and request scripts')
+    parser.add_argument('--bcrypt-rounds', type=int, default=4, help='bcrypt cost of seeded and rehashed passwords')
+    parser.add_argument('--accept-encoding', default='identity', help='Accept-Encoding sent with every request')
+    parser.add_argument('--db', help='SQLite database file, seeded unless it exists, temporary by default')
+    parser.add_argument('--sqlite-pragmas', help='Overrides of Settings.SQLITE_PRAGMAS, e.g. journal_mode=DELETE')
+    parser.add_argument('--output', help='Write results as JSON here instead of stdout')
+    parser.add_argument('--compare', help='Results JSON of an earlier run to print a comparison against')
+
+    return parser.parse_args(argv)
+
+
+def configure(args: argparse.Namespace, db_path: str) -> None:
+    # Settings are read at import time, so this has to happen before anything from app is imported
+    os.environ['FC_DATABASE_URL'] = f'sqlite:///{db_path}'
+    os.environ['FC_BCRYPT_ROUNDS'] = str(args.bcrypt_rounds)
+    os.environ['FC_RATE_LIMIT_ENABLED'] = '0'
+    os.environ['FC_SLOW_REQUEST_TIME'] = 'inf'
+    if args.sqlite_pragmas:
+        os.environ['FC_SQLITE_PRAGMAS'] = args.sqlite_pragmas
+
+
+def counter_totals(counter) -> Dict[str, float]:
+    return {key[0]: value for key, value in counter.values().items()}
+
+
+def counter_delta(before: Dict[str, float], after: Dict[str, float]) -> Dict[str, float]:
+    return {key: value - before.get(key, 0) for key, value in sorted(after.items()) if value - before.get(key, 0)}
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run_mix(app, mix: str, ctx, args: argparse.Namespace, rng: random.Random) -> Dict:
+    import httpx
+
+    from app import metrics
+    from benchmarks.scenarios import script
+
+    requests = script(mix, ctx, rng, args.requests)
+    latencies: Dict[str, List[float]] = {}
+    statuses: Dict[str, int] = {}
+    errors = 0
+    received = 0
+
+    headers = {'Accept-Encoding': args.accept_encoding}
+    # Failing requests are counted as 500s instead of aborting the run, e.g. "database is locked" under contention
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', headers=headers) as client:
+        queue = iter(requests)
+
+        async def worker():
+            nonlocal errors, received
+            for name, request in queue:
+                cookies = {'fc_authtoken': request.user.token} if request.user else None
+
+                start = time.perf_counter()
+                response = await client.request(request.method, request.url, json=request.json,
+                                                params=request.params, cookies=cookies)
+                latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+                statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+                if response.status_code >= 400 and response.status_code not in request.expected:
+                    errors += 1
+                # Bytes as sent, before the client decompresses them
+                received += response.num_bytes_downloaded
+
+        statements = counter_totals(metrics.SQL_STATEMENTS)
+        rows = counter_totals(metrics.SQL_ROWS_WRITTEN)
+        cpu = time.process_time()
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        statements = counter_delta(statements, counter_totals(metrics.SQL_STATEMENTS))
+        rows = counter_delta(rows, counter_totals(metrics.SQL_ROWS_WRITTEN))
+
+    every = [latency for values in latencies.values() for latency in values]
+
+    def summary(values: List[float]) -> Dict:
+        return {
+            'requests': len(values),
+            'p50_ms': round(percentile(values, 0.5) * 1000, 3),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+            'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+            'max_ms': round(max(values) * 1000, 3) if values else 0.0,
+        }
+
+    return dict(
+        summary(every),
+        throughput_rps=round(len(every) / elapsed, 2),
+        elapsed_s=round(elapsed, 3),
+        # Client and app share the process, so this includes the client's share
+        cpu_s=round(cpu, 3),
+        errors=errors,
+        statuses=statuses,
+        sql_statements=sum(statements.values()),
+        sql_statements_per_request=round(sum(statements.values()) / len(every), 2) if every else 0.0,
+        sql_statements_by_op=statements,
+        # Write amplification, e.g. how many rows saving a set with one edited card touches
+        rows_written=rows,
+        rows_written_per_request=round(sum(rows.values()) / len(every), 2) if every else 0.0,
+        response_bytes=received,
+        operations={name: summary(values) for name, values in sorted(latencies.items())},
+    )
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: Dict, results: Dict) -> str:
+    lines = [f"{'mix':<16}{'rps':>22}{'p50 ms':>24}{'p99 ms':>24}{'sql/req':>18}{'rows/req':>22}"]
+    for mix, current in results['mixes'].items():
+        before = baseline.get('mixes', {}).get(mix)
+        if not before:
+            continue
+
+        cells = []
+        for key, width in (('throughput_rps', 22), ('p50_ms', 24), ('p99_ms', 24), ('sql_statements_per_request', 18),
+                           ('rows_written_per_request', 22)):
+            if key not in before:
+                continue
+            change = (current[key] / before[key] - 1) * 100 if before[key] else 0.0
+            cells.append(f'{before[key]:.1f} -> {current[key]:.1f} ({change:+.0f}%)'.rjust(width))
+        lines.append(f'{mix:<16}' + ''.join(cells))
+
+    return '\n'.join(lines)
+
+
+async def main(args: argparse.Namespace, existing: bool) -> Dict:
+    from app.main import app
+    from app.sql import migrations
+    from app.sql.database import engine
+    from benchmarks.scenarios import Context, MIXES
+    from benchmarks.seed import load_sets, load_users, seed
+
+    migrations.upgrade(engine)
+
+    seed_time = 0.0
+    if existing:
+        users = load_users()
+    else:
+        start = time.perf_counter()
+        users = seed(args.users, args.sets, args.cards, args.seed)
+        seed_time = time.perf_counter() - start
+
+    rng = random.Random(args.seed)
+    ctx = Context(users=users, sets=args.sets, cards=args.cards, big_set_cards=args.big_set_cards)
+    ctx.stored = load_sets()
+    ctx.deletable = [(user, id) for user in users for id in range(args.sets)]
+    rng.shuffle(ctx.deletable)
+
+    mixes = args.mix or list(MIXES)
+    try:
+        results = {mix: await run_mix(app, mix, ctx, args, rng) for mix in mixes}
+    finally:
+        # Stops the password pool and disposes the async engine, whose connections would keep the process alive
+        await app.router.shutdown()
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'seeded': not existing,
+            'seed_s': round(seed_time, 3),
+            'params': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        },
+        'mixes': results,
+    }
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if not args.db:
+            args.db = os.path.join(tmp, 'bench.sqlite3')
+        existing = os.path.exists(args.db)
+        configure(args, args.db)
+
+        results = asyncio.run(main(args, existing))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), results), file=sys.stderr)
@@ -0,0 +1,149 @@
+import random
+
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Tuple
+
+from app import models as py_models
+from benchmarks.seed import PASSWORD, User, WORDS, make_set, random_text
+
+
+@dataclass
+class Context:
+    users: List[User]
+    sets: int
+    cards: int
+    big_set_cards: int
+    # Seeded sets not deleted yet, shuffled
+    deletable: List[Tuple[User, int]] = field(default_factory=list)
+    # Latest content sent for each (owner ID, set ID), kept up to date as requests are drawn
+    stored: Dict[Tuple[int, int], py_models.Set] = field(default_factory=dict)
+
+
+@dataclass
+class Request:
+    method: str
+    url: str
+    user: User = None
+    json: object = None
+    params: dict = None
+    # Statuses that count as success besides 2xx/3xx, e.g. 404 for sets deleted by an earlier request
+    expected: Tuple[int, ...] = ()
+
+
+def login(ctx: Context, rng: random.Random) -> Request:
+    user = rng.choice(ctx.users)
+    return Request('POST', '/users/login', json={'email': user.email, 'password': PASSWORD})
+
+
+def list_sets(ctx: Context, rng: random.Random) -> Request:
+    return Request('GET', '/sets/', rng.choice(ctx.users), params={'limit': 100})
+
+
+def list_summaries(ctx: Context, rng: random.Random) -> Request:
+    return Request('GET', '/sets/summaries', rng.choice(ctx.users), params={'limit': 100})
+
+
+def get_set(ctx: Context, rng: random.Random) -> Request:
+    return Request('GET', f'/sets/{rng.randrange(ctx.sets)}', rng.choice(ctx.users), expected=(404,))
+
+
+def export_sets(ctx: Context, rng: random.Random) -> Request:
+    return Request('GET', '/sets/export', rng.choice(ctx.users))
+
+
+def search(ctx: Context, rng: random.Random) -> Request:
+    return Request('GET', '/sets/search', rng.choice(ctx.users), params={'q': rng.choice(WORDS), 'limit': 20})
+
+
+def study_round(ctx: Context, rng: random.Random) -> Request:
+    return Request('GET', f'/sets/{rng.randrange(ctx.sets)}/study', rng.choice(ctx.users), expected=(404,))
+
+
+def edit_set(ctx: Context, rng: random.Random) -> Request:
+    # Saves a whole set again after editing one card, like clients do after every small change
+    user = rng.choice(ctx.users)
+    id = rng.randrange(ctx.sets)
+    card_set = ctx.stored.get((user.id, id))
+    if card_set is None:
+        card_set = ctx.stored[(user.id, id)] = make_set(rng, id, ctx.cards)
+    elif card_set.cards:
+        rng.choice(card_set.cards).question = random_text(rng, 6)
+
+    return Request('POST', '/sets/', user, json=card_set.dict())
+
+
+def upsert_big_set(ctx: Context, rng: random.Random) -> Request:
+    # Replaces a seeded set, most cards change so this exercises the bulk write path
+    user = rng.choice(ctx.users)
+    card_set = make_set(rng, rng.randrange(ctx.sets), ctx.big_set_cards)
+    ctx.stored[(user.id, card_set.id)] = card_set
+    return Request('POST', '/sets/', user, json=card_set.dict())
+
+
+def delete_set(ctx: Context, rng: random.Random) -> Request:
+    if not ctx.deletable:
+        # Deleting a missing set fails with 400
+        return Request('DELETE', f'/sets/{rng.randrange(ctx.sets)}', rng.choice(ctx.users), expected=(400,))
+
+    user, id = ctx.deletable.pop()
+    return Request('DELETE', f'/sets/{id}', user)
+
+
+OPERATIONS: Dict[str, Callable[[Context, random.Random], Request]] = {
+    'login': login,
+    'list_sets': list_sets,
+    'list_summaries': list_summaries,
+    'get_set': get_set,
+    'export_sets': export_sets,
+    'search': search,
+    'study_round': study_round,
+    'edit_set': edit_set,
+    'upsert_big_set': upsert_big_set,
+    'delete_set': delete_set,
+}
+
+# Weighted operations of each scripted mix, run in this order by default
+MIXES: Dict[str, Dict[str, int]] = {
+    'login_storm': {'login': 1},
+    'list_sets': {'list_sets': 1},
+    'list_summaries': {'list_summaries': 1},
+    'get_set': {'get_set': 1},
+    'export': {'export_sets': 1},
+    'search': {'search': 1},
+    'study': {'study_round': 1},
+    'edit_set': {'edit_set': 1},
+    'upsert_big_set': {'upsert_big_set': 1},
+    # Readers racing writers of the same sets, compares SQLite journal modes and pool settings
+    'contention': {
+        'get_set': 10,
+        'list_summaries': 5,
+        'edit_set': 5,
+    },
+    'mixed': {
+        'get_set': 40,
+        'list_summaries': 20,
+        'list_sets': 10,
+        'search': 10,
+        'study_round': 10,
+        'login': 5,
+        'edit_set': 5,
+        'upsert_big_set': 3,
+        'delete_set': 2,
+    },
+    # Last, it empties the database
+    'delete': {'delete_set': 1},
+}
+
+
+def script(mix: str, ctx: Context, rng: random.Random, requests: int) -> List[Tuple[str, Request]]:
+    """
+    Draws `requests` operations of `mix` up front so every run issues the same requests
+    """
+
+    names = list(MIXES[mix])
+    weights = list(MIXES[mix].values())
+
+    return [
+        (name, OPERATIONS[name](ctx, rng))
+        for name in rng.choices(names, weights, k=requests)
+    ]
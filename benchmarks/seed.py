@@ -0,0 +1,97 @@
+import random
+
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+from sqlalchemy.orm import selectinload
+
+from app import models as py_models
+from app.passwords import hash_password
+from app.routers.users import create_access_token
+from app.sql import models as sql_models
+from app.sql.crud import set as set_crud
+from app.sql.database import SessionLocal
+
+PASSWORD = 'benchmark-password'
+
+# Small vocabulary so searches hit a realistic share of cards
+WORDS = [
+    'apple', 'river', 'mountain', 'shine', 'quickly', 'library', 'window', 'forest', 'winter', 'garden',
+    'teacher', 'yellow', 'ocean', 'market', 'silver', 'thunder', 'kitchen', 'pencil', 'travel', 'island',
+    '光る', '食べる', '学校', '先生', '水', '山', '川', '花', '電車', '本',
+]
+
+
+@dataclass
+class User:
+    id: int
+    email: str
+    # Auth cookie, so scenarios other than login skip the login round trip
+    token: str
+
+
+def email(index: int) -> str:
+    return f'user{index}@bench.example.com'
+
+
+def random_text(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def make_set(rng: random.Random, id: int, cards: int) -> py_models.Set:
+    return py_models.Set(
+        id=id,
+        name=f'Set {id} {rng.choice(WORDS)}',
+        type=rng.choice(['Listening', 'Reading', 'Writing']),
+        max_question=10,
+        question_time=30.0,
+        cards=[
+            py_models.Card(id=i, question=random_text(rng, 6), answer=random_text(rng, 3))
+            for i in range(cards)
+        ]
+    )
+
+
+def seed(users: int, sets: int, cards: int, seed: int) -> List[User]:
+    """
+    Fills an empty database with `users` active users owning `sets` sets of `cards` cards each
+
+    All users share one password, hashed once with whatever cost Settings.BCRYPT_ROUNDS sets.
+    """
+
+    rng = random.Random(seed)
+    hashed_password = hash_password(PASSWORD)
+
+    with SessionLocal() as db:
+        db.bulk_insert_mappings(sql_models.User, [
+            dict(email=email(i), hashed_password=hashed_password, active=True)
+            for i in range(users)
+        ])
+        db.commit()
+
+        seeded = []
+        for db_user in db.query(sql_models.User).order_by(sql_models.User.id).all():
+            set_crud.add_sets(db, [make_set(rng, id, cards) for id in range(sets)], db_user.id)
+            seeded.append(User(db_user.id, db_user.email, create_access_token(str(db_user.id))))
+
+    return seeded
+
+
+def load_users() -> List[User]:
+    with SessionLocal() as db:
+        return [
+            User(db_user.id, db_user.email, create_access_token(str(db_user.id)))
+            for db_user in db.query(sql_models.User).order_by(sql_models.User.id)
+        ]
+
+
+def load_sets() -> Dict[Tuple[int, int], py_models.Set]:
+    """
+    Returns stored sets by owner and set ID, so scenarios can save them again with small edits
+    """
+
+    with SessionLocal() as db:
+        return {
+            (db_set.owner_id, db_set.id): py_models.Set.from_orm(db_set)
+            for db_set in db.query(sql_models.Set).options(selectinload(sql_models.Set.cards))
+        }
@@ -0,0 +1,125 @@
+"""
+Measures serializing a set for a response, through its response model or straight from the row
+
+    python -m benchmarks.serialization --cards 10 1000 10000
+
+The model path is what FastAPI does with response_model=Set: validate the row into the model, run
+jsonable_encoder and render with the json module. The dict path is what the set routes do with
+Settings.FAST_JSON: set_to_dict and ORJSONResponse. Rows are built in memory, so loading them from
+the database is left out of both. To compare whole requests, run the benchmark suite once with
+FC_FAST_JSON=0.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Measure serializing sets for responses')
+    parser.add_argument('--cards', type=int, nargs='+', default=[10, 1000, 10000], help='Set sizes to measure')
+    parser.add_argument('--repeat', type=int, default=20, help='Responses rendered per set size and path')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for set content')
+    parser.add_argument('--output', help='Write results as JSON here instead of stdout')
+
+    return parser.parse_args(argv)
+
+
+def make_row(rng: random.Random, cards: int):
+    from app.sql import models as sql_models
+    from benchmarks.seed import make_set
+
+    card_set = make_set(rng, 1, cards)
+    return sql_models.Set(
+        uid=1, owner_id=1, version=1,
+        **card_set.dict(exclude={'cards'}),
+        cards=[sql_models.Card(uid=i + 1, **card.dict()) for i, card in enumerate(card_set.cards)]
+    )
+
+
+@lru_cache()
+def response_field():
+    from fastapi.utils import create_response_field
+
+    from app.models import Set
+
+    # FastAPI creates it once per route
+    return create_response_field(name='response', type_=Set)
+
+
+def model_path(db_set) -> bytes:
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+
+    value, errors = response_field().validate(db_set, {}, loc=('response',))
+    assert not errors, errors
+
+    return JSONResponse(content=jsonable_encoder(value)).body
+
+
+def dict_path(db_set) -> bytes:
+    from fastapi.responses import ORJSONResponse
+
+    from app.routers.sets import set_to_dict
+
+    return ORJSONResponse(content=set_to_dict(db_set)).body
+
+
+def measure(render: Callable, db_set, repeat: int) -> Dict:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = render(db_set)
+        timings.append(time.perf_counter() - start)
+
+    return {
+        'min_ms': round(min(timings) * 1000, 3),
+        'mean_ms': round(sum(timings) / repeat * 1000, 3),
+        'bytes': len(body),
+    }
+
+
+def main(args: argparse.Namespace) -> Dict:
+    from benchmarks.run import git_commit
+
+    rng = random.Random(args.seed)
+
+    results = {}
+    for cards in args.cards:
+        db_set = make_row(rng, cards)
+        # Both paths have to produce the same document
+        assert json.loads(model_path(db_set)) == json.loads(dict_path(db_set))
+
+        model = measure(model_path, db_set, args.repeat)
+        fast = measure(dict_path, db_set, args.repeat)
+        results[str(cards)] = {
+            'model': model,
+            'dict': fast,
+            'speedup': round(model['min_ms'] / fast['min_ms'], 1) if fast['min_ms'] else None,
+        }
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'params': {key: value for key, value in vars(args).items() if key != 'output'},
+        },
+        'cards': results,
+    }
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = main(args)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
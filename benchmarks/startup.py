@@ -0,0 +1,106 @@
+"""
+Measures worker cold start: importing the app, running its startup hooks and serving a first request
+
+    python -m benchmarks.startup --runs 10 --output startup.json [--max-ms 3000]
+
+Every run is a fresh interpreter against an already migrated SQLite database, like a worker
+(re)started by uvicorn. Results are medians, JSON shaped like benchmarks.run output so runs can be
+tracked across commits. With --max-ms it exits with an error if the median process run takes
+longer, CI uses it to catch import time regressions.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Dict, List, Optional
+
+from benchmarks.run import git_commit
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Measure worker cold start')
+    parser.add_argument('--runs', type=int, default=10, help='Fresh interpreters to start')
+    parser.add_argument('--output', help='Write results as JSON here instead of stdout')
+    parser.add_argument('--max-ms', type=float, help='Fail if the median process run takes longer than this')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+
+    return parser.parse_args(argv)
+
+
+async def child() -> Dict:
+    start = time.perf_counter()
+    from app.main import app
+    imported = time.perf_counter()
+
+    import httpx
+
+    await app.router.startup()
+    started = time.perf_counter()
+
+    async with httpx.AsyncClient(app=app, base_url='http://bench') as client:
+        await client.get('/')
+    served = time.perf_counter()
+
+    await app.router.shutdown()
+
+    return {
+        'import_ms': (imported - start) * 1000,
+        'startup_ms': (started - imported) * 1000,
+        'first_request_ms': (served - started) * 1000,
+    }
+
+
+def main(args: argparse.Namespace) -> Dict:
+    samples: Dict[str, List[float]] = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, FC_DATABASE_URL=f'sqlite:///{os.path.join(tmp, "bench.sqlite3")}',
+                   FC_DB_AUTO_MIGRATE='0')
+        subprocess.run([sys.executable, '-m', 'app.sql.migrations', 'upgrade'], env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, '-m', 'benchmarks.startup', '--child'], env=env, check=True,
+                                    capture_output=True, text=True).stdout
+            process = (time.perf_counter() - start) * 1000
+
+            for key, value in dict(json.loads(output), process_ms=process).items():
+                samples.setdefault(key, []).append(value)
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'params': {'runs': args.runs},
+        },
+        'startup': {key: round(statistics.median(values), 1) for key, values in samples.items()},
+    }
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(child())))
+        sys.exit()
+
+    results = main(args)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    process_ms = results['startup']['process_ms']
+    if args.max_ms is not None and process_ms > args.max_ms:
+        sys.exit(f'Cold start took {process_ms} ms, more than --max-ms {args.max_ms}')
@@ -0,0 +1,140 @@
+"""
+Measures write amplification of saving a set after a small edit
+
+    python -m benchmarks.writes --cards 10 1000 2000
+
+Each save changes one card, removes one and adds one. It is written once by diffing against the
+stored cards (how sets are saved) and once by deleting and reinserting the whole set (how they used
+to be saved). Rows are counted from driver row counts, so rows removed through ON DELETE CASCADE
+(reviews) and search index rows written by triggers are left out of both.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from typing import Dict, List, Optional
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Measure rows written per set save')
+    parser.add_argument('--cards', type=int, nargs='+', default=[10, 1000, 2000], help='Set sizes to measure')
+    parser.add_argument('--saves', type=int, default=5, help='Saves per set size and strategy')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for set content')
+    parser.add_argument('--output', help='Write results as JSON here instead of stdout')
+
+    return parser.parse_args(argv)
+
+
+def edit(card_set, rng: random.Random):
+    from app import models as py_models
+    from benchmarks.seed import random_text
+
+    cards = [card.copy() for card in card_set.cards]
+    cards[0].question = random_text(rng, 6)
+    cards.pop()
+    cards.append(py_models.Card(id=max(card.id for card in card_set.cards) + 1, question=random_text(rng, 6),
+                                answer=random_text(rng, 3)))
+
+    return card_set.copy(update={'cards': cards})
+
+
+def replace_set(db, card_set, owner_id: int) -> None:
+    from app.sql import models as sql_models
+    from app.sql.crud import set as set_crud
+
+    db_set = set_crud.get_set(db, owner_id, card_set.id, load_cards=False)
+    if db_set:
+        db.query(sql_models.Card).\
+            filter(sql_models.Card.set_uid == db_set.uid).\
+            delete(synchronize_session=False)
+        db.query(sql_models.Set).\
+            filter(sql_models.Set.uid == db_set.uid).\
+            delete(synchronize_session=False)
+        db.expunge(db_set)
+
+    set_crud.add_sets(db, [card_set], owner_id)
+
+
+def measure(save, db, card_set, owner_id: int, saves: int, rng: random.Random) -> Dict:
+    from app import metrics
+    from benchmarks.run import counter_delta, counter_totals
+
+    statements = counter_totals(metrics.SQL_STATEMENTS)
+    rows = counter_totals(metrics.SQL_ROWS_WRITTEN)
+    start = time.perf_counter()
+    for _ in range(saves):
+        card_set = edit(card_set, rng)
+        save(db, card_set, owner_id)
+    elapsed = time.perf_counter() - start
+    statements = counter_delta(statements, counter_totals(metrics.SQL_STATEMENTS))
+    rows = counter_delta(rows, counter_totals(metrics.SQL_ROWS_WRITTEN))
+
+    return {
+        'rows_written_per_save': round(sum(rows.values()) / saves, 1),
+        'rows_written': {op: round(value / saves, 1) for op, value in rows.items()},
+        'write_statements_per_save': round(sum(
+            value for op, value in statements.items() if op in metrics.WRITE_OPS) / saves, 1),
+        'mean_ms': round(elapsed / saves * 1000, 3),
+    }
+
+
+def main(args: argparse.Namespace) -> Dict:
+    from app import metrics
+    from app.sql import migrations
+    from app.sql import models as sql_models
+    from app.sql.crud import set as set_crud
+    from app.sql.database import SessionLocal, engine
+    from benchmarks.run import git_commit
+    from benchmarks.seed import make_set
+
+    migrations.upgrade(engine)
+    # Normally done by app.main, which this does not need
+    metrics.instrument_engine(engine)
+    rng = random.Random(args.seed)
+
+    results = {}
+    with SessionLocal() as db:
+        db_user = sql_models.User(email='writes@bench.example.com', hashed_password='', active=True)
+        db.add(db_user)
+        db.commit()
+
+        strategies = (('diff', lambda db, card_set, owner_id: set_crud.add_sets(db, [card_set], owner_id)),
+                      ('delete_reinsert', replace_set))
+        for id, cards in enumerate(args.cards):
+            card_set = make_set(rng, id, cards)
+            set_crud.add_sets(db, [card_set], db_user.id)
+
+            results[str(cards)] = {
+                name: measure(save, db, card_set, db_user.id, args.saves, rng)
+                for name, save in strategies
+            }
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'params': {key: value for key, value in vars(args).items() if key != 'output'},
+        },
+        'cards': results,
+    }
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Settings are read at import time, so this has to happen before anything from app is imported
+        os.environ['FC_DATABASE_URL'] = f'sqlite:///{os.path.join(tmp, "bench.sqlite3")}'
+        results = main(args)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
@@ -0,0 +1,77 @@
+import gzip
+import os
+
+import pytest
+
+from app import compression
+from app.settings import Settings
+
+
+def test_precompress_static_writes_variants(tmp_path):
+    (tmp_path / 'page.html').write_text('<p>Hello</p>' * 200)
+
+    compression.precompress_static(str(tmp_path))
+
+    assert gzip.decompress((tmp_path / 'page.html.gz').read_bytes()) == (tmp_path / 'page.html').read_bytes()
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(compression.TEMP_SUFFIX)]
+
+
+def test_precompress_static_keeps_old_variant_on_failure(tmp_path, monkeypatch):
+    (tmp_path / 'page.html').write_text('<p>Hello</p>' * 200)
+    (tmp_path / 'page.html.gz').write_bytes(b'old')
+    os.utime(tmp_path / 'page.html.gz', (0, 0))
+
+    def fail(src, dst):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(os, 'replace', fail)
+    compression.precompress_static(str(tmp_path))
+
+    assert (tmp_path / 'page.html.gz').read_bytes() == b'old'
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(compression.TEMP_SUFFIX)]
+
+
+@pytest.fixture
+def big_set(auth_client) -> dict:
+    payload = {
+        'id': 2,
+        'name': 'Big Set',
+        'type': 'Reading',
+        'max_question': 10,
+        'question_time': 30.0,
+        'cards': [{'id': i, 'question': f'Question {i}', 'answer': f'Answer {i}'} for i in range(100)],
+    }
+    assert auth_client.post('/sets/', json=payload).status_code == 200
+
+    return payload
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'identity'])
+def test_set_etag_is_the_same_on_200_and_304(auth_client, big_set, encoding):
+    response = auth_client.get('/sets/2', headers={'Accept-Encoding': encoding})
+    assert response.status_code == 200
+    assert (response.headers.get('Content-Encoding') == 'gzip') == (encoding == 'gzip')
+
+    etag = response.headers['ETag']
+    assert etag.startswith('W/')
+
+    cached = auth_client.get('/sets/2', headers={'Accept-Encoding': encoding, 'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.headers['ETag'] == etag
+
+
+@pytest.mark.parametrize('thread_min_size, threaded', [(0, True), (1024 * 1024, False)])
+def test_large_bodies_are_compressed_in_threadpool(auth_client, big_set, monkeypatch, thread_min_size, threaded):
+    calls = []
+
+    async def run_in_threadpool(fn, *args):
+        calls.append(fn)
+        return fn(*args)
+
+    monkeypatch.setattr(Settings, 'COMPRESS_THREAD_MIN_SIZE', thread_min_size)
+    monkeypatch.setattr(compression, 'run_in_threadpool', run_in_threadpool)
+
+    response = auth_client.get('/sets/2', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert len(response.json()['cards']) == len(big_set['cards'])
+    assert bool(calls) == threaded
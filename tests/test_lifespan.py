@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = textwrap.dedent('''
+    from fastapi.testclient import TestClient
+
+    from app.main import app
+
+    with TestClient(app) as client:
+        response = client.post('/users/login', json={'email': 'nobody@test.example.com', 'password': 'password'})
+        assert response.status_code == 401, response.status_code
+''')
+
+
+def test_async_engine_is_disposed_on_shutdown(tmp_path):
+    env = dict(
+        os.environ,
+        FC_DATABASE_URL=f'sqlite:///{tmp_path / "lifespan.sqlite3"}',
+        FC_DB_ASYNC='1',
+        FC_DB_AUTO_MIGRATE='1',
+    )
+    env.pop('FC_ASYNC_DATABASE_URL', None)
+
+    # Undisposed async connections keep the interpreter from exiting
+    result = subprocess.run([sys.executable, '-c', SCRIPT], env=env, cwd=ROOT, timeout=60, capture_output=True,
+                            text=True)
+    assert result.returncode == 0, result.stderr
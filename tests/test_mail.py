@@ -0,0 +1,147 @@
+import socket
+import time
+
+import pytest
+
+from aiosmtpd.controller import Controller
+
+from app import mail as app_mail
+from app.settings import Settings
+from app.sql import models as sql_models
+from app.sql.crud import mail as crud_mail
+
+
+class Handler:
+    """
+    Collects delivered messages, recipients are answered with `rcpt_reply`
+    """
+
+    def __init__(self):
+        self.rcpt_reply = '250 OK'
+        self.messages = []
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if self.rcpt_reply.startswith('250'):
+            envelope.rcpt_tos.append(address)
+        return self.rcpt_reply
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return '250 Message accepted for delivery'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def smtp_server(monkeypatch, db):
+    handler = Handler()
+    controller = Controller(handler, hostname='127.0.0.1', port=free_port())
+    controller.start()
+
+    monkeypatch.setattr(Settings, 'SMTP_SERVER', controller.hostname)
+    monkeypatch.setattr(Settings, 'SMTP_PORT', controller.port)
+    monkeypatch.setattr(Settings, 'SMTP_SSL', False)
+    monkeypatch.setattr(Settings, 'SMTP_PASS', '')
+    monkeypatch.setattr(Settings, 'MAIL_RETRY_DELAY', 0)
+
+    # Start from an empty queue, other tests queue verification mails
+    db.query(sql_models.Mail).delete()
+    db.commit()
+
+    yield handler
+    controller.stop()
+
+
+@pytest.fixture
+def drain():
+    dispatcher = app_mail.MailDispatcher()
+    conn = app_mail.SMTPConnection()
+
+    yield lambda: dispatcher.drain(conn)
+    conn.close()
+
+
+def stored_mails(db):
+    db.expire_all()
+    return db.query(sql_models.Mail).all()
+
+
+def test_mail_is_delivered(smtp_server, drain, db):
+    app_mail.queue_mail(db, 'user@test.example.com', 'Hello', 'Reset link', to_name='User')
+
+    assert drain() == 1
+    assert [message.rcpt_tos for message in smtp_server.messages] == [['user@test.example.com']]
+    assert b'Reset link' in smtp_server.messages[0].original_content
+    assert stored_mails(db) == []
+
+
+def test_mail_is_retried_after_transient_failure(smtp_server, drain, db):
+    app_mail.queue_mail(db, 'user@test.example.com', 'Hello', 'Reset link')
+
+    smtp_server.rcpt_reply = '451 Try again later'
+    assert drain() == 1
+    [mail] = stored_mails(db)
+    assert mail.attempts == 1
+    assert mail.next_attempt_at is not None and '451' in mail.last_error
+
+    smtp_server.rcpt_reply = '250 OK'
+    assert drain() == 1
+    assert len(smtp_server.messages) == 1
+    assert stored_mails(db) == []
+
+
+def test_mail_is_given_up_after_max_attempts(smtp_server, drain, db, monkeypatch):
+    monkeypatch.setattr(Settings, 'MAIL_MAX_ATTEMPTS', 2)
+    app_mail.queue_mail(db, 'user@test.example.com', 'Hello', 'Reset link')
+
+    smtp_server.rcpt_reply = '451 Try again later'
+    assert drain() == 1
+    assert drain() == 1
+    assert drain() == 0
+
+    [mail] = stored_mails(db)
+    assert mail.attempts == 2
+    assert mail.next_attempt_at is None
+    # The link in it must not outlive delivery
+    assert mail.message is None
+
+
+def test_mail_is_given_up_on_permanent_failure(smtp_server, drain, db):
+    app_mail.queue_mail(db, 'nobody@test.example.com', 'Hello', 'Reset link')
+
+    smtp_server.rcpt_reply = '550 No such user'
+    assert drain() == 1
+
+    [mail] = stored_mails(db)
+    assert mail.attempts == 1
+    assert mail.next_attempt_at is None and mail.message is None
+    assert '550' in mail.last_error
+
+
+def test_mail_is_retried_when_server_is_down(smtp_server, drain, db, monkeypatch):
+    app_mail.queue_mail(db, 'user@test.example.com', 'Hello', 'Reset link')
+
+    with monkeypatch.context() as patch:
+        # Nothing listens on the discard port
+        patch.setattr(Settings, 'SMTP_PORT', 9)
+        assert drain() == 1
+
+    assert drain() == 1
+    assert len(smtp_server.messages) == 1
+
+
+def test_mails_are_claimed_one_at_a_time(smtp_server, db):
+    for i in range(2):
+        app_mail.queue_mail(db, f'user{i}@test.example.com', 'Hello', 'Reset link')
+
+    first = crud_mail.claim_mail(db, Settings.MAIL_LEASE_TIME)
+    second = crud_mail.claim_mail(db, Settings.MAIL_LEASE_TIME)
+    assert {first.to_addr, second.to_addr} == {'user0@test.example.com', 'user1@test.example.com'}
+
+    # Both are leased, nothing is left to claim until the leases run out
+    assert crud_mail.claim_mail(db, Settings.MAIL_LEASE_TIME) is None
+    assert all(mail.next_attempt_at > time.time() for mail in stored_mails(db))
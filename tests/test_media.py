@@ -0,0 +1,74 @@
+import hashlib
+import os
+import uuid
+
+import pytest
+
+from app.media import media_path
+from app.sql.crud import media as media_crud
+
+
+def upload(client, content: bytes, content_type: str) -> dict:
+    response = client.post('/media/', data=content, headers={'Content-Type': content_type})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_upload_keeps_audio_and_image_types(auth_client):
+    media = upload(auth_client, uuid.uuid4().bytes, 'audio/mpeg; charset=binary')
+    assert media['content_type'] == 'audio/mpeg'
+
+    response = auth_client.get(f'/media/{media["hash"]}')
+    assert response.headers['Content-Type'] == 'audio/mpeg'
+    assert response.headers['X-Content-Type-Options'] == 'nosniff'
+    assert 'Content-Disposition' not in response.headers
+
+
+def test_upload_in_async_mode(auth_client, async_db):
+    content = uuid.uuid4().bytes
+
+    media = upload(auth_client, content, 'image/png')
+    assert media['content_type'] == 'image/png'
+    # Content stored before returns the existing row
+    assert upload(auth_client, content, 'image/png') == media
+
+    assert auth_client.get(f'/media/{media["hash"]}').status_code == 200
+
+
+@pytest.mark.parametrize('content_type', ['text/html', 'image/svg+xml', 'application/javascript'])
+def test_upload_stores_other_types_as_binary(auth_client, content_type):
+    media = upload(auth_client, b'<script>alert(1)</script>' + uuid.uuid4().bytes, content_type)
+    assert media['content_type'] == 'application/octet-stream'
+
+    response = auth_client.get(f'/media/{media["hash"]}')
+    assert response.headers['Content-Type'] == 'application/octet-stream'
+    assert response.headers['X-Content-Type-Options'] == 'nosniff'
+    assert response.headers['Content-Disposition'] == 'attachment'
+
+
+def test_stored_unsafe_type_is_sent_as_attachment(client, db):
+    # Stored before uploads were restricted
+    content = b'<script>alert(1)</script>' + uuid.uuid4().bytes
+    hash = hashlib.sha256(content).hexdigest()
+    path = media_path(hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    media_crud.add_media(db, hash, len(content), 'text/html')
+
+    for headers in ({}, {'Range': 'bytes=0-3'}):
+        response = client.get(f'/media/{hash}', headers=headers)
+        assert response.status_code in (200, 206)
+        assert response.headers['X-Content-Type-Options'] == 'nosniff'
+        assert response.headers['Content-Disposition'] == 'attachment'
+
+
+def test_unchanged_media_returns_304(auth_client):
+    media = upload(auth_client, uuid.uuid4().bytes, 'image/png')
+    etag = auth_client.get(f'/media/{media["hash"]}').headers['ETag']
+
+    cached = auth_client.get(f'/media/{media["hash"]}', headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.content == b''
+    assert cached.headers['ETag'] == etag
+    assert cached.headers['Cache-Control']
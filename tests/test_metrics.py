@@ -0,0 +1,31 @@
+import pytest
+
+from app.settings import Settings
+
+TOKEN = 'metrics-token'
+
+
+@pytest.fixture
+def metrics_token(monkeypatch) -> str:
+    monkeypatch.setattr(Settings, 'METRICS_TOKEN', TOKEN)
+    return TOKEN
+
+
+def test_metrics_not_served_without_token_setting(client):
+    assert client.get('/metrics').status_code == 404
+    assert client.get('/metrics', headers={'Authorization': 'Bearer '}).status_code == 404
+
+
+@pytest.mark.parametrize('authorization', [None, 'Bearer wrong-token', f'Basic {TOKEN}'])
+def test_metrics_rejects_missing_or_wrong_token(client, metrics_token, authorization):
+    headers = {'Authorization': authorization} if authorization else {}
+
+    response = client.get('/metrics', headers=headers)
+    assert response.status_code == 401
+    assert response.headers['WWW-Authenticate'] == 'Bearer'
+
+
+def test_metrics_served_with_token(client, metrics_token):
+    response = client.get('/metrics', headers={'Authorization': f'Bearer {metrics_token}'})
+    assert response.status_code == 200
+    assert 'http_request_duration_seconds' in response.text
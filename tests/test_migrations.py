@@ -0,0 +1,86 @@
+import logging
+import os
+
+from sqlalchemy import create_engine
+
+from app.sql import migrations
+
+# Tables as created by versions before schema revisions were tracked
+BASELINE_SCHEMA = [
+    'CREATE TABLE users (id INTEGER PRIMARY KEY, email VARCHAR UNIQUE, hashed_password VARCHAR, '
+    'active BOOLEAN, premium BOOLEAN)',
+    'CREATE TABLE tokens (id INTEGER PRIMARY KEY, token VARCHAR, owner_id INTEGER REFERENCES users (id))',
+    'CREATE TABLE sets (uid INTEGER PRIMARY KEY, id INTEGER, type VARCHAR, name VARCHAR, max_question INTEGER, '
+    'question_time FLOAT, owner_id INTEGER REFERENCES users (id))',
+    'CREATE INDEX ix_sets_uid ON sets (uid)',
+    'CREATE INDEX ix_sets_id ON sets (id)',
+    'CREATE TABLE cards (uid INTEGER PRIMARY KEY, id INTEGER, question VARCHAR, answer VARCHAR, '
+    'voice_address VARCHAR, picture_address VARCHAR, set_id INTEGER REFERENCES sets (id))',
+    'CREATE INDEX ix_cards_uid ON cards (uid)',
+    'CREATE INDEX ix_cards_id ON cards (id)',
+]
+
+
+def add_baseline_set(conn, owner_id: int, id: int, card_ids) -> None:
+    conn.exec_driver_sql(
+        'INSERT INTO sets (id, type, name, max_question, question_time, owner_id) VALUES (?, ?, ?, ?, ?, ?)',
+        (id, 'basic', f'Set {id} of {owner_id}', 10, 5.0, owner_id)
+    )
+    for card_id in card_ids:
+        conn.exec_driver_sql(
+            'INSERT INTO cards (id, question, answer, voice_address, picture_address, set_id) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (card_id, f'{owner_id}-{card_id}?', f'{owner_id}-{card_id}', '', '', id)
+        )
+
+
+def make_baseline_database(path):
+    engine = create_engine(f'sqlite:///{os.path.join(path, "baseline.sqlite3")}')
+    with engine.begin() as conn:
+        for statement in BASELINE_SCHEMA:
+            conn.exec_driver_sql(statement)
+        conn.exec_driver_sql("INSERT INTO users (id, email, active, premium) VALUES (1, 'a@b.c', 1, 0)")
+        conn.exec_driver_sql("INSERT INTO users (id, email, active, premium) VALUES (2, 'd@e.f', 1, 0)")
+
+    return engine
+
+
+def test_upgrade_keeps_cards_of_set_ids_shared_across_users(tmp_path):
+    engine = make_baseline_database(tmp_path)
+    with engine.begin() as conn:
+        add_baseline_set(conn, 1, 1, [1, 2, 3])
+        add_baseline_set(conn, 2, 1, [1, 2])
+        add_baseline_set(conn, 2, 2, [1])
+        add_baseline_set(conn, 1, 3, [4, 5])
+
+    assert migrations.upgrade(engine) == [revision.id for revision in migrations.REVISIONS]
+
+    with engine.connect() as conn:
+        cards = conn.exec_driver_sql(
+            'SELECT s.owner_id, s.id, c.id, c.question FROM cards c JOIN sets s ON s.uid = c.set_uid '
+            'ORDER BY s.owner_id, s.id, c.id'
+        ).fetchall()
+    engine.dispose()
+
+    assert [tuple(card) for card in cards] == [
+        (1, 1, 1, '1-1?'), (1, 1, 2, '1-2?'), (1, 1, 3, '1-3?'),
+        (1, 3, 4, '1-4?'), (1, 3, 5, '1-5?'),
+        (2, 1, 1, '2-1?'), (2, 1, 2, '2-2?'),
+        (2, 2, 1, '2-1?'),
+    ]
+
+
+def test_upgrade_logs_cards_without_a_set(tmp_path, caplog):
+    engine = make_baseline_database(tmp_path)
+    with engine.begin() as conn:
+        add_baseline_set(conn, 1, 1, [1, 2])
+        conn.exec_driver_sql('DELETE FROM sets')
+
+    with caplog.at_level(logging.WARNING, logger=migrations.__name__):
+        migrations.upgrade(engine)
+
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql('SELECT COUNT(*) FROM cards').scalar() == 0
+    engine.dispose()
+
+    assert 'Dropped 2 cards of set ID 1' in caplog.text
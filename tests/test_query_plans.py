@@ -0,0 +1,95 @@
+import re
+
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+
+import pytest
+
+from sqlalchemy import event
+
+from app import models as py_models
+from app.sql.crud import set as set_crud
+from app.sql.crud import study as study_crud
+from app.sql.crud import user as user_crud
+from app.sql.database import SessionLocal, engine
+
+pytestmark = pytest.mark.skipif(engine.dialect.name != 'sqlite', reason='EXPLAIN QUERY PLAN is SQLite specific')
+
+# Tables that grow with users, looking anything up in them must not scan
+LARGE_TABLES = ('users', 'sets', 'cards', 'reviews', 'tokens', 'tombstones')
+
+
+@contextmanager
+def captured_selects() -> Iterator[List[Tuple[str, tuple]]]:
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+
+
+def full_scans(statements: List[Tuple[str, tuple]]) -> List[str]:
+    """
+    Returns plan steps that read a large table without searching an index
+    """
+
+    scans = []
+    with engine.connect() as conn:
+        for statement, parameters in statements:
+            for row in conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters):
+                detail = row[-1]
+                match = re.match(r'SCAN (\w+)', detail)
+                if match and match.group(1) in LARGE_TABLES:
+                    scans.append(f'{detail}: {" ".join(statement.split())}')
+
+    return scans
+
+
+def assert_indexed(fn, *args, **kwargs):
+    with SessionLocal() as db, captured_selects() as statements:
+        fn(db, *args, **kwargs)
+
+    assert statements
+    assert full_scans(statements) == []
+
+
+@pytest.fixture
+def stored_set(user, card_set):
+    with SessionLocal() as db:
+        db_set = set_crud.get_set(db, user.id, card_set['id'], load_cards=False)
+        db.expunge(db_set)
+
+    return db_set
+
+
+def test_set_lookups_use_indexes(user, stored_set):
+    assert_indexed(set_crud.get_set, user.id, stored_set.id)
+    assert_indexed(set_crud.get_set_version, user.id, stored_set.id)
+    assert_indexed(set_crud.get_sets_version, user.id)
+    assert_indexed(set_crud.get_sets, user.id)
+    assert_indexed(set_crud.get_sets, user.id, after=0, load_cards=False)
+    assert_indexed(set_crud.get_set_summaries, user.id)
+    assert_indexed(lambda db: list(set_crud.iter_sets(db, user.id)))
+
+
+def test_card_lookups_use_indexes(user, stored_set):
+    assert_indexed(set_crud.get_card, stored_set, 1)
+    assert_indexed(set_crud.update_cards, stored_set, py_models.CardBatch(
+        upsert=[py_models.Card(id=1, question='Question', answer='Answer')], delete=[2]))
+    assert_indexed(study_crud.get_due_cards, stored_set, 0, 10)
+
+
+def test_sync_uses_indexes(user, stored_set):
+    assert_indexed(set_crud.get_changes, user.id, 0)
+
+
+def test_user_lookups_use_indexes(user):
+    assert_indexed(user_crud.get_user, user.id)
+    assert_indexed(user_crud.get_user_by_email, user.email)
+    assert_indexed(user_crud.check_user_token, 'token', user.id)
@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+from app import ratelimit
+from app.settings import Settings
+
+
+@pytest.fixture(params=['memory', 'database'])
+def rate_limit(request, monkeypatch, tmp_path) -> None:
+    """
+    Enables rate limiting on a fresh backend of each kind, logins allow 5 tries per IP and 2 per email
+    """
+
+    monkeypatch.setattr(Settings, 'RATE_LIMIT_ENABLED', True)
+    monkeypatch.setattr(Settings, 'RATE_LIMIT_BACKEND', request.param)
+    monkeypatch.setattr(Settings, 'RATE_LIMIT_DATABASE_URL', f'sqlite:///{os.path.join(tmp_path, "ratelimit.sqlite3")}')
+    monkeypatch.setattr(Settings, 'RATE_LIMIT_TRUST_FORWARDED', True)
+    monkeypatch.setattr(Settings, 'RATE_LIMITS', {**Settings.RATE_LIMITS, 'login_ip': (5, 60), 'login_email': (2, 600)})
+    monkeypatch.setattr(ratelimit, '_backend', None)
+    yield
+    if isinstance(ratelimit._backend, ratelimit.DatabaseBackend):
+        ratelimit._backend.engine.dispose()
+
+
+def login(client, email: str, ip: str = '192.0.2.1'):
+    return client.post('/users/login', json={'email': email, 'password': 'wrong'}, headers={'X-Forwarded-For': ip})
+
+
+def test_login_is_limited_per_email(client, rate_limit):
+    for _ in range(2):
+        assert login(client, 'limited@test.example.com').status_code == 401
+
+    response = login(client, 'Limited@test.example.com')
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '300'
+
+    # Other emails have their own bucket
+    assert login(client, 'other@test.example.com').status_code == 401
+
+
+def test_login_is_limited_per_ip(client, rate_limit):
+    for i in range(5):
+        assert login(client, f'{i}@test.example.com').status_code == 401
+
+    response = login(client, '5@test.example.com')
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '12'
+
+    # Other clients have their own bucket
+    assert login(client, '5@test.example.com', ip='192.0.2.2').status_code == 401
@@ -0,0 +1,385 @@
+import asyncio
+import json
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import pytest
+
+from app.routers.sets import NDJSON_MEDIA_TYPE, read_lines
+from app.routers.users import create_access_token
+from app.settings import Settings
+from app.sql import models as sql_models
+from app.sql.crud import set as set_crud
+from app.sql.database import SessionLocal, engine
+
+
+def test_patch_set_updates_given_fields(auth_client, card_set):
+    response = auth_client.patch('/sets/1', json={'name': 'Renamed'})
+    assert response.status_code == 200
+
+    stored = auth_client.get('/sets/1').json()
+    assert stored['name'] == 'Renamed'
+    assert stored['type'] == card_set['type']
+
+
+def test_patch_set_rejects_null(auth_client, card_set):
+    response = auth_client.patch('/sets/1', json={'name': None})
+    assert response.status_code == 422
+
+    assert auth_client.get('/sets/1').json()['name'] == card_set['name']
+
+    summaries = auth_client.get('/sets/summaries')
+    assert summaries.status_code == 200
+    assert summaries.json()[0]['name'] == card_set['name']
+
+
+def test_patch_card_rejects_null(auth_client, card_set):
+    response = auth_client.patch('/sets/1/cards/0', json={'question': None, 'answer': 'New answer'})
+    assert response.status_code == 422
+
+    card = auth_client.get('/sets/1').json()['cards'][0]
+    assert card['question'] == card_set['cards'][0]['question']
+    assert card['answer'] == card_set['cards'][0]['answer']
+
+
+def test_delete_set_writes_one_tombstone(auth_client, user, card_set, db):
+    assert auth_client.delete('/sets/1').status_code == 200
+    assert auth_client.delete('/sets/1').status_code == 400
+
+    tombstones = db.query(sql_models.Tombstone).filter(sql_models.Tombstone.owner_id == user.id).all()
+    assert [(tombstone.set_id, tombstone.card_id) for tombstone in tombstones] == [(1, None)]
+    assert db.query(sql_models.Card).count() == db.query(sql_models.Card).join(sql_models.Set).count()
+
+
+def test_concurrent_deletes_write_one_tombstone(user, card_set, db):
+    def delete() -> bool:
+        with SessionLocal() as session:
+            return set_crud.del_set(session, user.id, card_set['id'])
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: delete(), range(4)))
+
+    assert sorted(results) == [False, False, False, True]
+    assert db.query(sql_models.Tombstone).filter(sql_models.Tombstone.owner_id == user.id).count() == 1
+
+
+class ChunkedRequest:
+    def __init__(self, chunks: List[bytes]):
+        self.chunks = chunks
+
+    async def stream(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def collect_lines(chunks: List[bytes], max_size: int) -> list:
+    async def collect():
+        return [line async for line in read_lines(ChunkedRequest(chunks), max_size)]
+
+    return asyncio.run(collect())
+
+
+def test_read_lines_joins_lines_across_chunks():
+    assert collect_lines([b'ab', b'c\nd', b'', b'e\n\nf'], 10) == [b'abc', b'de', b'', b'f']
+    assert collect_lines([b'abc\n'], 10) == [b'abc']
+
+
+def test_read_lines_drops_long_lines():
+    assert collect_lines([b'ab', b'cdef', b'gh\nij\n', b'abcde'], 4) == [None, b'ij', None]
+    assert collect_lines([b'abcd\nabcde\n'], 4) == [b'abcd', None]
+
+
+def ndjson(*lines) -> bytes:
+    return b'\n'.join(line if isinstance(line, bytes) else json.dumps(line).encode() for line in lines)
+
+
+def set_payload(id: int, cards: int = 2) -> dict:
+    return {
+        'id': id,
+        'name': f'Set {id}',
+        'type': 'Reading',
+        'max_question': 10,
+        'question_time': 30.0,
+        'cards': [{'id': i, 'question': f'Question {i}', 'answer': f'Answer {i}'} for i in range(cards)],
+    }
+
+
+def test_import_reports_each_line(auth_client, monkeypatch):
+    monkeypatch.setattr(Settings, 'IMPORT_MAX_LINE_SIZE', 1024)
+    duplicate_cards = dict(set_payload(3), cards=[set_payload(3)['cards'][0]] * 2)
+
+    body = ndjson(set_payload(1), b'{"id": "not a set"}', b'', duplicate_cards, set_payload(4, cards=100),
+                  set_payload(2))
+    response = auth_client.post('/sets/import', data=body, headers={'Content-Type': NDJSON_MEDIA_TYPE})
+    assert response.status_code == 200
+
+    results = [(result['line'], result['id'], result['code']) for result in response.json()]
+    assert results == [(1, 1, '200'), (2, None, '422'), (4, 3, '400'), (5, None, '413'), (6, 2, '200')]
+
+    stored = auth_client.get('/sets/').json()
+    assert [card_set['id'] for card_set in stored] == [1, 2]
+
+
+def test_export_streams_every_set(auth_client):
+    body = ndjson(*(set_payload(id) for id in range(3)))
+    auth_client.post('/sets/import', data=body, headers={'Content-Type': NDJSON_MEDIA_TYPE})
+
+    response = auth_client.get('/sets/export')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith(NDJSON_MEDIA_TYPE)
+
+    exported = [json.loads(line) for line in response.text.splitlines()]
+    assert [card_set['id'] for card_set in exported] == [0, 1, 2]
+    assert [(card['id'], card['question'], card['answer']) for card in exported[1]['cards']] == \
+        [(card['id'], card['question'], card['answer']) for card in set_payload(1)['cards']]
+
+
+def get_changes(client, since: int, **params) -> dict:
+    response = client.get('/sets/changes', params={'since': since, **params})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_changes_since_version(auth_client, card_set):
+    page = get_changes(auth_client, 0)
+    assert [change['id'] for change in page['changes']] == [1]
+    assert [card['id'] for card in page['changes'][0]['cards']] == [0, 1, 2]
+    assert not page['has_more']
+
+    # Nothing changed after the returned version
+    assert get_changes(auth_client, page['version']) == dict(page, changes=[])
+
+
+def test_changes_carry_upserted_and_deleted_cards(auth_client, card_set):
+    since = get_changes(auth_client, 0)['version']
+
+    batch = {'upsert': [{'id': 0, 'question': 'Changed', 'answer': 'Answer 0'},
+                        {'id': 5, 'question': 'New', 'answer': 'New'}],
+             'delete': [1]}
+    assert auth_client.patch('/sets/1/cards', json=batch).status_code == 200
+
+    [change] = get_changes(auth_client, since)['changes']
+    assert [(card['id'], card['question']) for card in change['cards']] == [(0, 'Changed'), (5, 'New')]
+    assert change['deleted_cards'] == [1]
+
+
+def test_changes_forget_deleted_cards_added_again(auth_client, user, card_set, db):
+    since = get_changes(auth_client, 0)['version']
+
+    assert auth_client.delete('/sets/1/cards/1').status_code == 200
+    assert auth_client.post('/sets/1/cards', json={'id': 1, 'question': 'Back', 'answer': 'Again'}).status_code == 200
+
+    [change] = get_changes(auth_client, since)['changes']
+    assert [card['id'] for card in change['cards']] == [1]
+    assert change['deleted_cards'] == []
+    assert db.query(sql_models.Tombstone).filter(sql_models.Tombstone.owner_id == user.id).count() == 0
+
+
+def test_changes_mark_deleted_sets(auth_client, card_set):
+    since = get_changes(auth_client, 0)['version']
+
+    assert auth_client.delete('/sets/1').status_code == 200
+
+    [change] = get_changes(auth_client, since)['changes']
+    assert (change['id'], change['deleted']) == (1, True)
+
+
+def test_changes_page_by_version(auth_client):
+    for id in range(3):
+        assert auth_client.post('/sets/', json=set_payload(id)).status_code == 200
+
+    ids = []
+    since = 0
+    while True:
+        page = get_changes(auth_client, since, limit=2)
+        ids += [change['id'] for change in page['changes']]
+        since = page['version']
+        if not page['has_more']:
+            break
+
+    assert ids == [0, 1, 2]
+
+
+def add_sets(client, *payloads) -> None:
+    for payload in payloads:
+        assert client.post('/sets/', json=payload).status_code == 200
+
+
+def get_pages(client, path: str, **params) -> List[List[int]]:
+    """
+    Follows X-Next-Cursor from the first page, returns the IDs on each page
+    """
+
+    pages = []
+    cursor = None
+    while True:
+        response = client.get(path, params=dict(params, **({'cursor': cursor} if cursor else {})))
+        assert response.status_code == 200
+        pages.append([card_set['id'] for card_set in response.json()])
+
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            return pages
+
+
+def test_get_sets_pages_with_cursor(auth_client):
+    add_sets(auth_client, *(set_payload(id) for id in (4, 1, 3, 0, 2)))
+
+    assert get_pages(auth_client, '/sets/', limit=2) == [[0, 1], [2, 3], [4]]
+    assert get_pages(auth_client, '/sets/', limit=5) == [[0, 1, 2, 3, 4]]
+
+
+def test_get_sets_filters_by_type_and_name(auth_client):
+    add_sets(auth_client, set_payload(1), dict(set_payload(2), type='Listening'), dict(set_payload(3), name='Kanji'))
+
+    assert get_pages(auth_client, '/sets/', type='Reading', limit=1) == [[1], [3]]
+    assert get_pages(auth_client, '/sets/', name='Set') == [[1, 2]]
+
+
+def test_get_sets_rejects_bad_cursor(auth_client):
+    assert auth_client.get('/sets/', params={'cursor': 'not a cursor'}).status_code == 400
+
+
+def test_get_set_summaries(auth_client):
+    add_sets(auth_client, set_payload(2, cards=0), set_payload(1, cards=3), dict(set_payload(3), type='Listening'))
+
+    response = auth_client.get('/sets/summaries')
+    assert response.status_code == 200
+    assert response.json() == [
+        {'id': 1, 'name': 'Set 1', 'type': 'Reading', 'card_count': 3},
+        {'id': 2, 'name': 'Set 2', 'type': 'Reading', 'card_count': 0},
+        {'id': 3, 'name': 'Set 3', 'type': 'Listening', 'card_count': 2},
+    ]
+
+    assert get_pages(auth_client, '/sets/summaries', type='Reading', limit=1) == [[1], [2]]
+
+
+def test_get_sets_returns_selected_fields(auth_client, card_set):
+    response = auth_client.get('/sets/', params={'fields': 'id,name'})
+    assert response.status_code == 200
+    assert response.json() == [{'id': 1, 'name': card_set['name']}]
+
+    response = auth_client.get('/sets/1', params={'fields': 'cards'})
+    assert response.status_code == 200
+    assert [card['id'] for card in response.json()['cards']] == [0, 1, 2]
+
+    assert auth_client.get('/sets/', params={'fields': 'id,owner_id'}).status_code == 400
+
+
+@pytest.mark.parametrize('path', ['/sets/', '/sets/summaries', '/sets/1'])
+def test_unchanged_sets_return_304(auth_client, card_set, path):
+    headers = {'Accept-Encoding': 'identity'}
+    etag = auth_client.get(path, headers=headers).headers['ETag']
+
+    for if_none_match in (etag, etag[2:], f'"0", {etag}', '*'):
+        cached = auth_client.get(path, headers=dict(headers, **{'If-None-Match': if_none_match}))
+        assert cached.status_code == 304
+        assert cached.headers['ETag'] == etag
+        assert cached.content == b''
+
+    assert auth_client.patch('/sets/1', json={'name': 'Renamed'}).status_code == 200
+
+    changed = auth_client.get(path, headers=dict(headers, **{'If-None-Match': etag}))
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+
+
+def test_if_none_match_on_missing_set_returns_404(auth_client):
+    assert auth_client.get('/sets/1', headers={'If-None-Match': '*'}).status_code == 404
+
+
+@pytest.fixture
+def searchable_sets(auth_client) -> None:
+    add_sets(auth_client,
+             dict(set_payload(1), cards=[{'id': 0, 'question': 'Tokyo tower', 'answer': 'Red'},
+                                         {'id': 1, 'question': 'Mount Fuji', 'answer': 'Near Tokyo'},
+                                         {'id': 2, 'question': 'Café', 'answer': '100% arabica_beans'}]),
+             dict(set_payload(2), cards=[{'id': 0, 'question': 'Kyoto', 'answer': 'Temples and tower'}]))
+
+
+def search(client, q: str, **params) -> List[tuple]:
+    response = client.get('/sets/search', params=dict(params, q=q))
+    assert response.status_code == 200
+    return [(card['set_id'], card['id']) for card in response.json()]
+
+
+@pytest.mark.skipif(engine.dialect.name != 'sqlite', reason='Search index is only used on SQLite')
+def test_search_ranks_question_matches_first(auth_client, searchable_sets):
+    assert search(auth_client, 'tokyo') == [(1, 0), (1, 1)]
+    assert search(auth_client, 'tow') == [(1, 0), (2, 0)]
+    assert search(auth_client, 'tokyo tower') == [(1, 0)]
+    assert search(auth_client, 'cafe') == [(1, 2)]
+
+
+def test_search_pages_with_cursor(auth_client, searchable_sets):
+    first = auth_client.get('/sets/search', params={'q': 'tower', 'limit': 1})
+    cursor = first.headers['X-Next-Cursor']
+    second = auth_client.get('/sets/search', params={'q': 'tower', 'limit': 1, 'cursor': cursor})
+
+    assert 'X-Next-Cursor' not in second.headers
+    assert sorted(card['set_id'] for card in first.json() + second.json()) == [1, 2]
+
+
+def test_search_only_finds_own_cards(client, user, searchable_sets, hashed_password, db):
+    other = sql_models.User(email=f'{uuid.uuid4().hex}@test.example.com', hashed_password=hashed_password, active=True)
+    db.add(other)
+    db.commit()
+    client.cookies.set('fc_authtoken', create_access_token(str(other.id)))
+
+    assert search(client, 'tokyo') == []
+
+
+@pytest.mark.parametrize('q', ['"', 'tokyo"', 'tower AND', 'NEAR(tokyo', 'question:red', '*', '-tokyo', '^red'])
+def test_search_treats_query_syntax_as_text(auth_client, searchable_sets, q):
+    auth_client.get('/sets/search', params={'q': q}).raise_for_status()
+
+
+def test_search_substrings(user, searchable_sets, db):
+    def search_substrings(query: str) -> List[tuple]:
+        return [(set_id, card.id) for card, set_id in set_crud._search_substrings(db, user.id, query, 0, 10)]
+
+    assert search_substrings('TOKYO') == [(1, 0), (1, 1)]
+    assert search_substrings('tower temples') == [(2, 0)]
+    assert search_substrings('100%') == [(1, 2)]
+    assert search_substrings('0%') == [(1, 2)]
+    assert search_substrings('a_b') == [(1, 2)]
+    assert search_substrings('%') == [(1, 2)]
+    assert search_substrings('_') == [(1, 2)]
+    assert search_substrings('tokyo%red') == []
+
+
+
+def stored_cards(db, user, id: int) -> dict:
+    """
+    Maps card ID to (uid, version, answer) of the set's stored cards
+    """
+
+    db.expire_all()
+    db_set = set_crud.get_set(db, user.id, id)
+    return {db_card.id: (db_card.uid, db_card.version, db_card.answer) for db_card in db_set.cards}
+
+
+def test_add_set_only_writes_changed_cards(auth_client, user, card_set, db):
+    before = stored_cards(db, user, 1)
+
+    cards = [card_set['cards'][0], dict(card_set['cards'][1], answer='Changed'),
+             {'id': 5, 'question': 'New', 'answer': 'New'}]
+    assert auth_client.post('/sets/', json=dict(card_set, cards=cards)).status_code == 200
+
+    after = stored_cards(db, user, 1)
+    version = after[5][1]
+    assert sorted(after) == [0, 1, 5]
+
+    # Unchanged cards are left alone, changed ones are updated in place
+    assert after[0] == before[0]
+    assert after[1] == (before[1][0], version, 'Changed')
+    assert version > before[1][1]
+
+    # Removed cards leave a tombstone, every stored card is still scheduled for review
+    tombstones = db.query(sql_models.Tombstone).filter(sql_models.Tombstone.owner_id == user.id).all()
+    assert [(tombstone.set_id, tombstone.card_id) for tombstone in tombstones] == [(1, 2)]
+    reviewed = db.query(sql_models.Review.card_uid).filter(sql_models.Review.card_uid.in_(
+        [uid for uid, _, _ in after.values()])).all()
+    assert sorted(uid for uid, in reviewed) == sorted(uid for uid, _, _ in after.values())
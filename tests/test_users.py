@@ -0,0 +1,165 @@
+import time
+import uuid
+
+from app.routers.users import create_user_token
+from app.settings import Settings
+from app.sql import models as sql_models
+from app.sql.crud import user as crud_user
+from app.sweeper import TokenSweeper
+
+
+def test_login(client, user, password):
+    response = client.post('/users/login', json={'email': user.email, 'password': password})
+    assert response.status_code == 200
+    assert 'fc_authtoken' in response.cookies
+
+
+def test_login_rejects_wrong_password(client, user):
+    response = client.post('/users/login', json={'email': user.email, 'password': 'wrong-password'})
+    assert response.status_code == 401
+    assert 'fc_authtoken' not in response.cookies
+
+
+def test_login_fails_fast_when_hash_queue_is_full(client, user, password, monkeypatch):
+    monkeypatch.setattr(Settings, 'HASH_QUEUE_LIMIT', 0)
+
+    response = client.post('/users/login', json={'email': user.email, 'password': password})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_create_user(client, password, db):
+    email = f'{uuid.uuid4().hex}@test.example.com'
+
+    response = client.post('/users/', json={'email': email, 'password': password})
+    assert response.status_code == 200
+    assert client.post('/users/', json={'email': email, 'password': password}).status_code == 400
+
+    db_user = crud_user.get_user_by_email(db, email)
+    assert db_user and not db_user.active
+
+
+def test_update_password(auth_client, user, password):
+    new_password = 'new-password'
+
+    response = auth_client.put('/users/me', json={'current_password': 'wrong-password', 'new_password': new_password})
+    assert response.status_code == 401
+
+    response = auth_client.put('/users/me', json={'current_password': password, 'new_password': new_password})
+    assert response.status_code == 200
+
+    assert auth_client.post('/users/login', json={'email': user.email, 'password': new_password}).status_code == 200
+    assert auth_client.post('/users/login', json={'email': user.email, 'password': password}).status_code == 401
+
+
+def test_update_password_fails_fast_when_hash_queue_is_full(auth_client, user, password, monkeypatch):
+    monkeypatch.setattr(Settings, 'HASH_QUEUE_LIMIT', 0)
+
+    response = auth_client.put('/users/me', json={'current_password': password, 'new_password': 'new-password'})
+    assert response.status_code == 503
+
+
+def test_pass_reset(client, user, password, db):
+    token = create_user_token(db, user.id)
+    new_password = 'new-password'
+
+    assert client.put(f'/users/password/{token}', json={'password': new_password}).status_code == 200
+    assert client.post('/users/login', json={'email': user.email, 'password': new_password}).status_code == 200
+
+    # Tokens are single use
+    assert client.put(f'/users/password/{token}', json={'password': password}).status_code == 400
+
+
+def test_pass_reset_keeps_token_when_hash_queue_is_full(client, user, db, monkeypatch):
+    token = create_user_token(db, user.id)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(Settings, 'HASH_QUEUE_LIMIT', 0)
+        assert client.put(f'/users/password/{token}', json={'password': 'new-password'}).status_code == 503
+
+    assert client.put(f'/users/password/{token}', json={'password': 'new-password'}).status_code == 200
+
+
+def user_tokens(db, user) -> list:
+    db.expire_all()
+    return db.query(sql_models.Token).filter(sql_models.Token.owner_id == user.id).all()
+
+
+def test_pass_reset_init_resends_live_token(client, user, db):
+    for _ in range(2):
+        assert client.post('/users/password', json={'email': user.email}).status_code == 200
+
+    [db_token] = user_tokens(db, user)
+    messages = [mail.message for mail in db.query(sql_models.Mail).filter(sql_models.Mail.to_addr == user.email)]
+    assert len(messages) == 2 and messages[0] == messages[1]
+    assert crud_user.hash_token(messages[0].split('token=')[1].split('"')[0]) == db_token.token_hash
+
+
+def test_create_user_token_skips_tokens_about_to_expire(user, db):
+    crud_user.add_user_token(db, 'short-lived', user.id, int(time.time()) + 60)
+
+    token = create_user_token(db, user.id, reuse=True)
+    assert token != 'short-lived'
+    assert crud_user.check_user_token(db, token, user.id)
+    assert len(user_tokens(db, user)) == 2
+
+
+def test_expired_tokens_are_rejected(client, user, db):
+    crud_user.add_user_token(db, 'expired', user.id, int(time.time()) - 1)
+
+    assert not crud_user.check_user_token(db, 'expired', user.id)
+    assert client.put('/users/password/expired', json={'password': 'new-password'}).status_code == 400
+
+
+def test_sweeper_purges_expired_tokens_in_batches(user, db, monkeypatch):
+    monkeypatch.setattr(Settings, 'TOKEN_SWEEP_BATCH_SIZE', 2)
+    for i in range(5):
+        crud_user.add_user_token(db, f'expired-{i}', user.id, int(time.time()) - 1)
+    live = create_user_token(db, user.id)
+
+    assert TokenSweeper().sweep() >= 5
+    assert [db_token.token_hash for db_token in user_tokens(db, user)] == [crud_user.hash_token(live)]
+
+
+def change_password(client, current: str, new: str) -> int:
+    return client.put('/users/me', json={'current_password': current, 'new_password': new}).status_code
+
+
+def test_password_update_invalidates_cached_user(auth_client, user, password):
+    assert auth_client.get('/users/me').status_code == 200
+    assert crud_user.user_cache.get(user.id)
+
+    assert change_password(auth_client, password, 'new-password') == 200
+    assert crud_user.user_cache.get(user.id) is None
+
+    # Checked against the new hash, not the cached one
+    assert change_password(auth_client, password, 'other-password') == 401
+    assert change_password(auth_client, 'new-password', 'other-password') == 200
+
+
+def test_pass_reset_invalidates_cached_user(auth_client, user, password, db):
+    assert auth_client.get('/users/me').status_code == 200
+
+    token = create_user_token(db, user.id)
+    assert auth_client.put(f'/users/password/{token}', json={'password': 'new-password'}).status_code == 200
+
+    assert change_password(auth_client, password, 'other-password') == 401
+    assert change_password(auth_client, 'new-password', 'other-password') == 200
+
+
+def test_delete_invalidates_cached_user(auth_client, user):
+    assert auth_client.get('/users/me').status_code == 200
+
+    assert auth_client.delete('/users/me').status_code == 200
+    assert auth_client.get('/users/me').status_code == 401
+
+
+def test_verify_invalidates_cached_user(auth_client, user, db):
+    db.query(sql_models.User).filter(sql_models.User.id == user.id).update({sql_models.User.active: False})
+    db.commit()
+    crud_user.user_cache.pop(user.id)
+    assert auth_client.get('/sets/').status_code == 401
+
+    token = create_user_token(db, user.id)
+    assert auth_client.put('/users/verify', json={'token': token}).status_code == 200
+    assert auth_client.get('/sets/').status_code == 200